@@ -0,0 +1,128 @@
+import argparse
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import nullcontext
+from os.path import join
+from benchmarks.dispatcher_benchmark import create_database
+from main.DBDriver import DBDriver, is_busy_error
+from main.ErrorPolicy import ErrorPolicy
+
+# Run from the repository root: python -m benchmarks.db_contention_benchmark
+#
+# Many writer processes drive apps through the status transitions a device
+# worker and its host stages make, all against one database. Any "database is
+# locked" error that escapes DBDriver is counted; in the pipeline it would have
+# been recorded as an app failure.
+
+
+def writer(device_serial, db_path, args, start, results):
+    db_driver = DBDriver(db_path, busy_timeout_secs=args.busy_timeout)
+    group = db_driver.transaction if not args.ungrouped else nullcontext
+    error_policy = ErrorPolicy(backoff_secs=0)
+    manifest = [(f"split_{i}.apk", 4 * 1024**2, "0" * 64) for i in range(3)]
+    latencies = []
+    locked = 0
+    claim_cursor = 0
+    start.wait()
+    while True:
+        started_at = time.perf_counter()
+        try:
+            app_id, claim_cursor = db_driver.claim_next_app(
+                device_serial, 3600, claim_cursor
+            )
+            if app_id is None:
+                break
+            db_driver.renew_lease(app_id, device_serial, 3600)
+            if args.failure_every and len(latencies) % args.failure_every == 0:
+                error_policy.record_failure(
+                    db_driver, app_id, device_serial, "Installation timeout"
+                )
+                db_driver.release_app(app_id, device_serial)
+            else:
+                db_driver.reserve_staging(app_id, device_serial, 1, 1024**4, 0)
+                with group():
+                    db_driver.record_apk_manifest(app_id, manifest)
+                    db_driver.mark_stage_complete(app_id, "pull", device_serial)
+                with group():
+                    db_driver.record_stage_durations(
+                        app_id, device_serial, {"pull": 1.0, "upload": 1.0}
+                    )
+                    db_driver.mark_apk_manifest_uploaded(app_id)
+                    db_driver.mark_stage_complete(app_id, "upload", device_serial)
+                    db_driver.release_staging(app_id)
+                    db_driver.mark_app_downloaded(app_id)
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+            locked += 1
+        latencies.append(time.perf_counter() - started_at)
+    db_driver.close_connection()
+    results.put((device_serial, latencies, locked))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=3000)
+    parser.add_argument("--writers", type=int, default=12)
+    parser.add_argument("--busy-timeout", type=float, default=30)
+    parser.add_argument("--failure-every", type=int, default=10)
+    parser.add_argument(
+        "--ungrouped",
+        action="store_true",
+        help="commit every write on its own instead of one commit per app transition",
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="db-contention-benchmark-")
+    db_path = join(work_dir, "db_contention_benchmark.db")
+    create_database(db_path, [f"com.example.app{i}" for i in range(args.apps)])
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=writer, args=(f"writer-{i}", db_path, args, start, results)
+        )
+        for i in range(args.writers)
+    ]
+    for p in processes:
+        p.start()
+    started_at = time.perf_counter()
+    start.set()
+    reports = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started_at
+    for p in processes:
+        p.join()
+    conn = sqlite3.connect(db_path)
+    journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    downloaded = conn.execute(
+        "SELECT COUNT(*) FROM input_apps WHERE downloaded = 1"
+    ).fetchone()[0]
+    conn.close()
+    shutil.rmtree(work_dir)
+
+    latencies = sorted(
+        l for _, report_latencies, _ in reports for l in report_latencies
+    )
+    locked = sum(report_locked for _, _, report_locked in reports)
+    print(
+        f"Writers: {args.writers}, apps: {args.apps}, journal mode: {journal_mode}, "
+        f"grouped: {not args.ungrouped}, wall time: {elapsed:.2f}s"
+    )
+    print(
+        f"Lifecycles: {len(latencies)} ({len(latencies) / elapsed:.0f}/s), "
+        f"downloaded: {downloaded}, locked errors: {locked}"
+    )
+    if latencies:
+        print(
+            f"Lifecycle latency p50: {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+            f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, "
+            f"max: {latencies[-1] * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from os.path import abspath, join, dirname, realpath
+from helpers.ErrorCatalog import APP_INCOMPATIBLE
+from main.AppDispatcher import AppDispatcher
+from main.DBDriver import DBDriver
+from main.ErrorPolicy import ErrorPolicy
+
+# Run from the repository root: python -m benchmarks.dispatcher_benchmark
+
+
+def create_database(db_path, app_ids, excluded=None):
+    # excluded maps device serials to apps that failed on them for good
+    # (incompatible), an error backlog every claim of that device has to skip
+    schema_path = abspath(
+        join(dirname(dirname(realpath(__file__))), "databases", "schema.sql")
+    )
+    conn = sqlite3.connect(db_path)
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        "INSERT INTO input_apps (app_id) VALUES (?)", [(a,) for a in app_ids]
+    )
+    for device_serial, excluded_app_ids in (excluded or {}).items():
+        conn.executemany(
+            "INSERT INTO error_apps (app_id, device, error_code) VALUES (?, ?, ?)",
+            [(a, device_serial, APP_INCOMPATIBLE) for a in excluded_app_ids],
+        )
+    conn.commit()
+    conn.close()
+
+
+def fake_worker(
+    device_serial, dispatch_client, failure_rate, work_secs, db_path, results
+):
+    rng = random.Random(device_serial)
+    db_driver = DBDriver(db_path)
+    # failed apps come back right away, the run measures dispatching, not backoff
+    error_policy = ErrorPolicy(backoff_secs=0)
+    idle_secs = 0.0
+    latencies = []
+    processed = 0
+    while True:
+        requested_at = time.perf_counter()
+        app_id = dispatch_client.next_app()
+        latency = time.perf_counter() - requested_at
+        if app_id is None:
+            idle_secs += latency
+            break
+        latencies.append(latency)
+        idle_secs += latency
+        time.sleep(work_secs)
+        processed += 1
+        if rng.random() < failure_rate:
+            decision = error_policy.record_failure(
+                db_driver, app_id, device_serial, "Installation timeout"
+            )
+            dispatch_client.report_failed(app_id, decision)
+        else:
+            db_driver.mark_app_downloaded(app_id)
+            dispatch_client.report_done(app_id)
+    db_driver.close_connection()
+    results.put((device_serial, processed, idle_secs, latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=6)
+    parser.add_argument("--failure-rate", type=float, default=0.3)
+    parser.add_argument("--work-ms", type=float, default=1.0)
+    parser.add_argument(
+        "--incompatible",
+        type=int,
+        default=0,
+        help="extra apps that stay undownloaded, incompatible with every device",
+    )
+    args = parser.parse_args()
+
+    device_serials = [f"fake-device-{i}" for i in range(args.devices)]
+    # the incompatible apps come first in the table, where every claim starts
+    incompatible_app_ids = [f"com.android.app{i}" for i in range(args.incompatible)]
+    app_ids = [f"com.example.app{i}" for i in range(args.apps)]
+    db_path = join(tempfile.mkdtemp(), "dispatcher_benchmark.db")
+    create_database(
+        db_path,
+        incompatible_app_ids + app_ids,
+        {device_serial: incompatible_app_ids for device_serial in device_serials},
+    )
+    dispatcher = AppDispatcher(device_serials, lease_seconds=3600, db_path=db_path)
+    results = multiprocessing.Queue()
+    started_at = time.perf_counter()
+    dispatcher.start()
+    processes = [
+        multiprocessing.Process(
+            target=fake_worker,
+            args=(
+                device_serial,
+                dispatcher.client(device_serial),
+                args.failure_rate,
+                args.work_ms / 1000,
+                db_path,
+                results,
+            ),
+        )
+        for device_serial in device_serials
+    ]
+    for p in processes:
+        p.start()
+    reports = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - started_at
+    dispatcher.stop()
+    os.remove(db_path)
+
+    all_latencies = sorted(
+        latency for _, _, _, latencies in reports for latency in latencies
+    )
+    total_processed = sum(processed for _, processed, _, _ in reports)
+    print(
+        f"Apps: {args.apps} (+{args.incompatible} incompatible), "
+        f"devices: {args.devices}, wall time: {elapsed:.2f}s"
+    )
+    print(f"Dispatched items (including retries): {total_processed}")
+    for device_serial, processed, idle_secs, _ in sorted(reports):
+        print(
+            f"[{device_serial}] processed: {processed}, "
+            f"idle: {idle_secs:.2f}s ({idle_secs / elapsed:.1%})"
+        )
+    if all_latencies:
+        p50 = all_latencies[len(all_latencies) // 2]
+        p99 = all_latencies[int(len(all_latencies) * 0.99)]
+        print(f"Dispatch latency p50: {p50 * 1000:.2f}ms, p99: {p99 * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    # same start method as main.py
+    multiprocessing.set_start_method("spawn")
+    main()
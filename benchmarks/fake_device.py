@@ -0,0 +1,338 @@
+import os
+import random
+import re
+import shutil
+import socket
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import Future
+from dataclasses import dataclass
+from os.path import basename, dirname, join, realpath
+
+# A simulated phone behind the adbutils device interface, so ADBCommands,
+# GooglePlay, the uiautomator backend and the logcat install watcher all run
+# their real code against it. The Play Store is a small state machine whose
+# screens are the uiautomator dumps in fixtures/play_store; every latency is
+# given in device seconds and multiplied by time_scale.
+
+FIXTURES_PATH = join(dirname(realpath(__file__)), "fixtures", "play_store")
+
+ShellResult = namedtuple("ShellResult", ["returncode", "output"])
+FileStat = namedtuple("FileStat", ["size"])
+
+
+def load_screens(path=FIXTURES_PATH):
+    screens = {}
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith(".xml"):
+            with open(join(path, file_name)) as f:
+                screens[file_name[: -len(".xml")]] = f.read()
+    return screens
+
+
+@dataclass
+class DeviceProfile:
+    shell_secs: float = 0.05
+    dump_secs: float = 1.5
+    store_load_secs: float = 3.0
+    install_secs: float = 25.0
+    pull_bytes_per_sec: float = 30 * 1024**2
+    apk_bytes: int = 24 * 1024**2
+    splits: int = 3
+    # share of apps that hit each failure; drawn per device and app
+    incompatible_rate: float = 0.05
+    update_rate: float = 0.02
+    timeout_rate: float = 0.01
+    rate_limit_rate: float = 0.0
+    time_scale: float = 1.0
+    seed: int = 0
+
+    def outcome(self, device_serial, app_id):
+        rng = random.Random(f"{self.seed}:{device_serial}:{app_id}")
+        roll = rng.random()
+        for outcome, rate in (
+            ("incompatible", self.incompatible_rate),
+            ("update", self.update_rate),
+            ("timeout", self.timeout_rate),
+            ("rate_limited", self.rate_limit_rate),
+        ):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+
+class FakeConnection:
+    # the end of a socket pair that ShellStream reads, fed by a device thread
+    def __init__(self):
+        self.conn, self.device_end = socket.socketpair()
+        self.closed = False
+
+    def feed(self, chunks, delay_secs=0.0):
+        def run():
+            try:
+                if delay_secs:
+                    time.sleep(delay_secs)
+                for chunk in chunks:
+                    self.device_end.sendall(chunk)
+            except OSError:
+                pass
+            finally:
+                self.device_end.close()
+
+        threading.Thread(target=run, daemon=True).start()
+        return self
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+
+class FakeSync:
+    def __init__(self, device):
+        self.device = device
+
+    def stat(self, path):
+        self.device.round_trip()
+        return FileStat(len(self.device.file_content(path)) & 0xFFFFFFFF)
+
+    def iter_content(self, path):
+        self.device.round_trip()
+        yield from self.device.transfer(self.device.file_content(path))
+
+    def pull(self, src, dst):
+        with open(dst, "wb") as f:
+            for chunk in self.iter_content(src):
+                f.write(chunk)
+        return os.stat(dst).st_size
+
+
+class FakeDevice:
+    def __init__(self, device_serial, profile=None, screens=None):
+        self.device_serial = device_serial
+        self.profile = profile or DeviceProfile()
+        self.screens = screens or load_screens()
+        self.sync = FakeSync(self)
+        self.lock = threading.Lock()
+        # package -> {path: content}
+        self.installed = {}
+        self.files = {}
+        self.store_app = None
+        self.store_opened_at = 0.0
+        # a throttled store turns an app away once, the next visit goes through
+        self.store_throttled = False
+        self.throttled_apps = set()
+        self.installing = {}
+        self.logcat_streams = []
+        self.installs = 0
+        self.round_trips = 0
+
+    def scaled(self, secs):
+        return secs * self.profile.time_scale
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        time.sleep(self.scaled(self.profile.shell_secs))
+
+    # adbutils device interface
+
+    def shell(self, command, stream=False, timeout=None):
+        if stream:
+            args = command if isinstance(command, list) else command.split()
+            return self.shell_stream(args)
+        self.round_trip()
+        return ""
+
+    def shell2(self, command, timeout=None):
+        self.round_trip()
+        args = command.split()
+        if args[:2] == ["am", "start"]:
+            self.open_store(args[-1].split("id=", 1)[1])
+        elif args[:2] == ["am", "force-stop"]:
+            with self.lock:
+                self.store_app = None
+        elif args[:2] == ["input", "tap"]:
+            self.tap(int(args[2]), int(args[3]))
+        elif args[:2] == ["pm", "path"]:
+            with self.lock:
+                paths = list(self.installed.get(args[2], ()))
+            if not paths:
+                return ShellResult(1, "")
+            return ShellResult(0, "".join(f"package:{path}\n" for path in paths))
+        elif args[:2] == ["uiautomator", "dump"]:
+            time.sleep(self.scaled(self.profile.dump_secs))
+            self.files[args[2]] = self.current_screen().encode()
+            return ShellResult(0, f"UI hierchary dumped to: {args[2]}\n")
+        return ShellResult(0, "")
+
+    def shell_stream(self, args):
+        connection = FakeConnection()
+        if args[:3] == ["uiautomator", "dump", "/dev/tty"]:
+            dump = self.current_screen().encode()
+            return connection.feed(
+                [dump, b"UI hierchary dumped to: /dev/tty\n"],
+                self.scaled(self.profile.dump_secs),
+            )
+        if args[:1] == ["logcat"]:
+            with self.lock:
+                self.logcat_streams.append(connection)
+            return connection
+        if args[:2] == ["tail", "-c"]:
+            offset = int(args[2].lstrip("+")) - 1
+            content = self.file_content(args[3])[offset:]
+            return connection.feed(self.transfer(content))
+        return connection.feed([])
+
+    def uninstall(self, package_name):
+        self.round_trip()
+        with self.lock:
+            removed = self.installed.pop(package_name, None)
+        return "Success" if removed else "Failure [DELETE_FAILED_INTERNAL_ERROR]"
+
+    # simulated phone
+
+    def open_store(self, app_id):
+        with self.lock:
+            self.store_app = app_id
+            self.store_opened_at = time.monotonic()
+            self.store_throttled = (
+                self.profile.outcome(self.device_serial, app_id) == "rate_limited"
+                and app_id not in self.throttled_apps
+            )
+            self.throttled_apps.add(app_id)
+
+    def current_screen(self):
+        with self.lock:
+            app_id = self.store_app
+            if app_id is None:
+                return self.render("loading", "")
+            if time.monotonic() < self.store_opened_at + self.scaled(
+                self.profile.store_load_secs
+            ):
+                return self.render("loading", app_id)
+            if app_id in self.installed:
+                return self.render("installed", app_id)
+            if app_id in self.installing:
+                return self.render(self.installing[app_id], app_id)
+            if self.store_throttled:
+                return self.render("rate_limited", app_id)
+        if self.profile.outcome(self.device_serial, app_id) == "incompatible":
+            return self.render("incompatible", app_id)
+        return self.render("details", app_id)
+
+    def render(self, screen, app_id):
+        return self.screens[screen].replace("{app_id}", app_id)
+
+    def tap(self, x, y):
+        with self.lock:
+            app_id = self.store_app
+            if app_id is None or app_id in self.installing:
+                return
+        if "Install" not in self.current_screen():
+            return
+        x1, y1, x2, y2 = (
+            int(c) for c in re.findall(r"\d+", self.screen_bounds("details", "Install"))
+        )
+        if not (x1 <= x <= x2 and y1 <= y <= y2):
+            return
+        with self.lock:
+            self.installing[app_id] = "installing"
+        timer = threading.Timer(
+            self.scaled(self.profile.install_secs), self.finish_install, (app_id,)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def screen_bounds(self, screen, content_desc):
+        match = re.search(
+            rf'content-desc="{content_desc}"[^>]*bounds="([^"]+)"',
+            self.screens[screen],
+        )
+        return match.group(1)
+
+    def finish_install(self, app_id):
+        outcome = self.profile.outcome(self.device_serial, app_id)
+        if outcome == "timeout":
+            # stuck at pending, nothing ever lands
+            return
+        with self.lock:
+            if outcome == "update":
+                self.installing[app_id] = "update"
+                return
+            del self.installing[app_id]
+            self.installed[app_id] = self.build_splits(app_id)
+            self.installs += 1
+            streams = list(self.logcat_streams)
+        line = (
+            f"I/PackageManager( 1021): installPackageLI: pkg={app_id} Install success\n"
+        )
+        for connection in streams:
+            try:
+                connection.device_end.sendall(line.encode())
+            except OSError:
+                with self.lock:
+                    self.logcat_streams.remove(connection)
+
+    def build_splits(self, app_id):
+        names = ["base.apk"] + [
+            f"split_config.{i}.apk" for i in range(self.profile.splits - 1)
+        ]
+        sizes = [self.profile.apk_bytes // 2] + [
+            self.profile.apk_bytes // 2 // max(self.profile.splits - 1, 1)
+        ] * (self.profile.splits - 1)
+        splits = {}
+        for name, size in zip(names, sizes):
+            seed = zlib.crc32(f"{app_id}/{name}".encode()).to_bytes(4, "little")
+            splits[f"/data/app/{app_id}-1/{name}"] = (seed * (size // 4 + 1))[:size]
+        return splits
+
+    def file_content(self, path):
+        if path in self.files:
+            return self.files[path]
+        with self.lock:
+            for splits in self.installed.values():
+                if path in splits:
+                    return splits[path]
+        raise FileNotFoundError(path)
+
+    def transfer(self, content, chunk_size=256 * 1024):
+        # paced to the configured USB throughput
+        seconds_per_chunk = self.scaled(chunk_size / self.profile.pull_bytes_per_sec)
+        for start in range(0, len(content), chunk_size):
+            time.sleep(seconds_per_chunk)
+            yield content[start : start + chunk_size]
+
+
+class SimulatedUploadService:
+    # stands in for UploadService: waits for the bytes to cross a link of the
+    # given throughput, then drops the staged copy like a verified upload does
+    def __init__(self, apk_source, bytes_per_sec, time_scale=1.0):
+        self.apk_source = apk_source
+        self.bytes_per_sec = bytes_per_sec
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+
+    def submit(self, source, destination, expected=None):
+        future = Future()
+        nbytes = sum(size for size, _ in (expected or {}).values())
+        with self.lock:
+            # one link, uploads queue behind each other
+            start = max(time.monotonic(), self.busy_until)
+            self.busy_until = start + nbytes / self.bytes_per_sec * self.time_scale
+            delay = self.busy_until - time.monotonic()
+
+        def finish():
+            shutil.rmtree(join(self.apk_source, basename(source)), ignore_errors=True)
+            future.set_result(source)
+
+        timer = threading.Timer(delay, finish)
+        timer.daemon = True
+        timer.start()
+        return future
+
+    def stop(self):
+        pass
@@ -0,0 +1,70 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import dirname, join, realpath
+from urllib.parse import parse_qs, urlparse
+
+# A local stand-in for the Play web store that MetadataEngine fetches from:
+# /store/apps/details?id=<app_id> answers with the canned page in
+# fixtures/play_web/details.html for the known apps and 404 for the rest.
+# Point METADATA_PLAY_BASE_URL (or MetadataEngine's base_url) at .url.
+
+DETAILS_PAGE_PATH = join(
+    dirname(realpath(__file__)), "fixtures", "play_web", "details.html"
+)
+
+
+class FakePlayWeb:
+    def __init__(self, app_ids=(), latency_secs=0.0):
+        with open(DETAILS_PAGE_PATH) as f:
+            self.details_page = f.read()
+        self.app_ids = set(app_ids)
+        self.latency_secs = latency_secs
+        self.lock = threading.Lock()
+        # (app_id, monotonic time) of every details request, in arrival order
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = None
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                request = urlparse(self.path)
+                app_id = parse_qs(request.query).get("id", [""])[0]
+                with fake.lock:
+                    fake.requests.append((app_id, time.monotonic()))
+                if fake.latency_secs:
+                    time.sleep(fake.latency_secs)
+                if request.path != "/store/apps/details" or app_id not in fake.app_ids:
+                    self.send_error(404)
+                    return
+                body = fake.details_page.replace("{app_id}", app_id).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,148 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from os.path import abspath, join, dirname, realpath
+from helpers.ErrorCatalog import (
+    APP_INCOMPATIBLE,
+    INSTALL_BUTTON_NOT_FOUND,
+    INSTALLATION_TIMEOUT,
+    NOT_AVAILABLE_IN_COUNTRY,
+)
+from main.DBDriver import DBDriver
+
+# Run from the repository root: python -m benchmarks.queue_state_benchmark
+
+ERRORS = [
+    APP_INCOMPATIBLE,
+    INSTALLATION_TIMEOUT,
+    INSTALL_BUTTON_NOT_FOUND,
+    NOT_AVAILABLE_IN_COUNTRY,
+]
+
+LEGACY_GET_APPS_TO_RUN = f"""
+SELECT DISTINCT i.app_id
+FROM input_apps i
+LEFT JOIN error_apps e ON i.app_id = e.app_id
+WHERE i.downloaded = 0
+GROUP BY e.error_code, i.app_id
+HAVING COUNT(DISTINCT e.device) < ? OR COUNT(e.device) = 0;
+"""
+
+LEGACY_CHECK_FOR_INCOMPATIBLE_APPS = f"""
+SELECT
+NOT EXISTS (
+    SELECT DISTINCT i.app_id
+    FROM input_apps i
+    LEFT JOIN error_apps e ON i.app_id = e.app_id
+    WHERE i.downloaded = 0
+    GROUP BY e.error_code, i.app_id
+    HAVING COUNT(DISTINCT e.device) < ? OR COUNT(e.device) = 0
+    EXCEPT
+    SELECT DISTINCT ea.app_id
+    FROM error_apps ea
+    WHERE ea.app_id IN (
+        SELECT app_id FROM input_apps WHERE downloaded = 0
+    )
+    AND ea.error_code = {APP_INCOMPATIBLE}
+    GROUP BY ea.error_code, ea.app_id
+    HAVING COUNT(DISTINCT ea.device) = ?
+) AS is_subset;
+"""
+
+
+def create_database(db_path, total_apps, error_ratio, total_devices):
+    schema_path = abspath(
+        join(dirname(dirname(realpath(__file__))), "databases", "schema.sql")
+    )
+    rng = random.Random(0)
+    conn = sqlite3.connect(db_path)
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        "INSERT INTO input_apps (app_id, downloaded) VALUES (?, ?)",
+        ((f"com.example.app{i}", int(rng.random() < 0.5)) for i in range(total_apps)),
+    )
+    error_rows = []
+    for i in range(total_apps):
+        if rng.random() < error_ratio:
+            error = rng.choice(ERRORS)
+            for device in rng.sample(
+                range(total_devices), rng.randint(1, total_devices)
+            ):
+                error_rows.append((f"com.example.app{i}", f"device-{device}", error))
+    conn.executemany(
+        "INSERT INTO error_apps (app_id, device, error_code) VALUES (?, ?, ?)",
+        error_rows,
+    )
+    conn.execute(
+        f"""
+        UPDATE input_apps
+        SET failed_devices = (
+                SELECT COUNT(DISTINCT e.device)
+                FROM error_apps e
+                WHERE e.app_id = input_apps.app_id
+            ),
+            incompatible_devices = (
+                SELECT COUNT(DISTINCT e.device)
+                FROM error_apps e
+                WHERE e.app_id = input_apps.app_id
+                AND e.error_code = {APP_INCOMPATIBLE}
+            )
+        WHERE app_id IN (SELECT app_id FROM error_apps);
+        """
+    )
+    conn.commit()
+    conn.close()
+    return len(error_rows)
+
+
+def timed(label, function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started_at)
+    print(f"{label}: best {min(durations) * 1000:.1f}ms over {repeat} runs")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=1_000_000)
+    parser.add_argument("--error-ratio", type=float, default=0.2)
+    parser.add_argument("--devices", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    db_path = join(tempfile.mkdtemp(), "queue_state_benchmark.db")
+    error_rows = create_database(db_path, args.apps, args.error_ratio, args.devices)
+    print(f"input_apps: {args.apps} rows, error_apps: {error_rows} rows")
+
+    conn = sqlite3.connect(db_path)
+    db_driver = DBDriver(db_path)
+    n = args.devices
+    timed(
+        "legacy get_apps_to_run",
+        lambda: conn.execute(LEGACY_GET_APPS_TO_RUN, (n,)).fetchall(),
+        args.repeat,
+    )
+    timed("get_apps_to_run", lambda: db_driver.get_apps_to_run(n), args.repeat)
+    timed(
+        "legacy check_for_incompatible_apps",
+        lambda: conn.execute(LEGACY_CHECK_FOR_INCOMPATIBLE_APPS, (n, n)).fetchone(),
+        args.repeat,
+    )
+    timed(
+        "check_for_incompatible_apps",
+        lambda: db_driver.check_for_incompatible_apps(n),
+        args.repeat,
+    )
+    conn.close()
+    db_driver.close_connection()
+    os.remove(db_path)
+
+
+if __name__ == "__main__":
+    main()
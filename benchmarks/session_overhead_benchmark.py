@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from os.path import abspath, join, dirname, realpath
+from benchmarks.fake_device import DeviceProfile, FakeDevice
+from helpers.ADBCommands import ADBCommands
+from helpers.GooglePlay import GooglePlay
+from main.DBDriver import DBDriver
+from main.MainClass import MainClass
+from main.RSyncer import RSyncer
+
+# Run from the repository root: python -m benchmarks.session_overhead_benchmark
+#
+# Drives the same apps through MainClass.main_entrypoint on a simulated phone
+# (benchmarks/fake_device.py) twice: once building everything per app the way
+# the worker used to, once with the long-lived session the worker keeps now.
+# Host stages are left out; the staged copy is dropped right after the pull.
+
+TIMINGS = (
+    "install_timeout",
+    "install_button_timeout",
+    "install_button_poll_secs",
+    "store_load_secs",
+    "install_poll_min_secs",
+    "install_poll_max_secs",
+)
+
+
+def create_database(db_path, app_ids):
+    schema_path = abspath(
+        join(dirname(dirname(realpath(__file__))), "databases", "schema.sql")
+    )
+    conn = sqlite3.connect(db_path)
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    conn.executemany(
+        "INSERT INTO input_apps (app_id) VALUES (?)", [(a,) for a in app_ids]
+    )
+    conn.commit()
+    conn.close()
+
+
+def scale_timings(main_class, scale):
+    for attribute in TIMINGS:
+        value = getattr(main_class.google_play, attribute)
+        setattr(main_class.google_play, attribute, value * scale)
+    main_class.settle_secs *= scale
+    main_class.staging_manager.poll_secs *= scale
+    main_class.staging_manager.timeout_secs *= scale
+
+
+def legacy_session(config, db_path, device, app_id, scale, opened):
+    # the per-app setup the worker did before: MainClass opened its own DBDriver
+    # (never closed) and built two ADBCommands, its own and GooglePlay's, plus an
+    # RSyncer for the app
+    db_driver = DBDriver(db_path)
+    opened.append(db_driver)
+    main_class = MainClass(
+        config, db_driver=db_driver, adb=ADBCommands(config, adb_utils=device)
+    )
+    main_class.google_play = GooglePlay(
+        config,
+        adb=ADBCommands(config, adb_utils=device),
+        stage_timer=main_class.stage_timer,
+    )
+    RSyncer(app_id)
+    scale_timings(main_class, scale)
+    return main_class
+
+
+def run(args, legacy):
+    work_dir = tempfile.mkdtemp(prefix="session-overhead-benchmark-")
+    db_path = join(work_dir, "session_overhead_benchmark.db")
+    apk_source = join(work_dir, "apks")
+    os.makedirs(apk_source)
+    app_ids = [f"com.example.app{i}" for i in range(args.apps)]
+    create_database(db_path, app_ids)
+    device_serial = "fake-device"
+    config = dict(
+        pipeline=dict(
+            ADB_BINARY="adb", apk_source=apk_source, device_serial=device_serial
+        )
+    )
+    profile = DeviceProfile(
+        incompatible_rate=0,
+        update_rate=0,
+        timeout_rate=0,
+        time_scale=args.time_scale,
+    )
+    device = FakeDevice(device_serial, profile)
+    db_driver = DBDriver(db_path)
+    opened = [db_driver]
+    if not legacy:
+        main_class = MainClass(
+            config, db_driver=db_driver, adb=ADBCommands(config, adb_utils=device)
+        )
+        scale_timings(main_class, args.time_scale)
+
+    setup_secs = 0.0
+    failed = 0
+    claim_cursor = 0
+    started_at = time.perf_counter()
+    for _ in app_ids:
+        app_id, claim_cursor = db_driver.claim_next_app(
+            device_serial, 3600, claim_cursor
+        )
+        if legacy:
+            setup_started_at = time.perf_counter()
+            main_class = legacy_session(
+                config, db_path, device, app_id, args.time_scale, opened
+            )
+            setup_secs += time.perf_counter() - setup_started_at
+        try:
+            main_class.main_entrypoint(app_id)
+        except Exception as e:
+            logging.getLogger().critical(f"[{app_id}] {e}")
+            failed += 1
+        # what the host stages do once the upload is confirmed
+        shutil.rmtree(join(apk_source, app_id), ignore_errors=True)
+        db_driver.release_staging(app_id)
+    elapsed = time.perf_counter() - started_at
+
+    for opened_db_driver in opened:
+        opened_db_driver.close_connection()
+    shutil.rmtree(work_dir)
+    return elapsed, setup_secs, failed, len(opened), device.round_trips
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=30)
+    parser.add_argument("--time-scale", type=float, default=0.01)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+
+    for name, legacy in (("per-app setup", True), ("long-lived session", False)):
+        elapsed, setup_secs, failed, connections, round_trips = run(args, legacy)
+        device_secs = elapsed / args.time_scale
+        print(
+            f"{name}: {elapsed / args.apps * 1000:.1f}ms per app "
+            f"({device_secs / args.apps:.1f} device seconds), "
+            f"setup {setup_secs / args.apps * 1000:.2f}ms per app, "
+            f"adb round trips: {round_trips / args.apps:.1f} per app, failed: {failed}, "
+            f"SQLite connections opened: {connections}"
+        )
+
+
+if __name__ == "__main__":
+    main()
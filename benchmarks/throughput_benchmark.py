@@ -0,0 +1,283 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from functools import partial
+from os.path import join
+from benchmarks.dispatcher_benchmark import create_database
+from benchmarks.fake_device import DeviceProfile, FakeDevice, SimulatedUploadService
+from helpers.ADBCommands import ADBCommands
+from main.AppDispatcher import AppDispatcher
+from main.DBDriver import DBDriver
+from main.DeviceWorker import run_device_worker
+from main.ErrorPolicy import ErrorPolicy
+from main.HostStagePool import HostStagePool
+from main.MainClass import MainClass
+from main.WorkerSupervisor import WorkerSupervisor
+
+# Run from the repository root: python -m benchmarks.throughput_benchmark
+#
+# Runs the real dispatcher, supervisor, device worker loop, GooglePlay flow and
+# host stage pool against simulated devices (benchmarks/fake_device.py). Every
+# wait, on the device and in the client, is multiplied by --time-scale, and the
+# throughput is reported in device time, so a run at 0.01 covers an hour of
+# device time in 36 seconds.
+
+
+class TimedDispatchClient:
+    # splits a worker's life into waiting on the dispatcher and working an app
+    def __init__(self, dispatch_client):
+        self.dispatch_client = dispatch_client
+        self.latencies = []
+        self.busy_secs = 0.0
+        self.returned_at = None
+
+    def next_app(self):
+        requested_at = time.perf_counter()
+        if self.returned_at is not None:
+            self.busy_secs += requested_at - self.returned_at
+        app_id = self.dispatch_client.next_app()
+        self.returned_at = time.perf_counter()
+        self.latencies.append(self.returned_at - requested_at)
+        return app_id
+
+    def report_done(self, app_id):
+        self.dispatch_client.report_done(app_id)
+
+    def report_failed(self, app_id, decision):
+        self.dispatch_client.report_failed(app_id, decision)
+
+
+class TimedDBDriver:
+    # times every DBDriver call and counts the ones SQLite turned away as locked
+    def __init__(self, db_driver):
+        self.db_driver = db_driver
+        self.latencies = []
+        self.locked = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.db_driver, name)
+        if not callable(method):
+            return method
+
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e):
+                    self.locked += 1
+                raise
+            finally:
+                self.latencies.append(time.perf_counter() - started_at)
+
+        return timed
+
+
+def simulated_worker(
+    device_serial, config, dispatch_client, db_path, profile, args, results
+):
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    scale = profile.time_scale
+    timed_client = TimedDispatchClient(dispatch_client)
+    db_driver = TimedDBDriver(DBDriver(db_path))
+    device = FakeDevice(device_serial, profile)
+    adb = ADBCommands(config, adb_utils=device)
+    main_class = MainClass(config, db_driver=db_driver, adb=adb)
+    google_play = main_class.google_play
+    for attribute in (
+        "install_timeout",
+        "install_button_timeout",
+        "install_button_poll_secs",
+        "store_load_secs",
+        "install_poll_min_secs",
+        "install_poll_max_secs",
+    ):
+        setattr(google_play, attribute, getattr(google_play, attribute) * scale)
+    main_class.settle_secs *= scale
+    main_class.staging_manager.poll_secs *= scale
+    main_class.staging_manager.timeout_secs *= scale
+    if args.staging_quota_mb:
+        main_class.staging_manager.quota_bytes = args.staging_quota_mb * 1024**2
+    default_policy = ErrorPolicy()
+    error_policy = ErrorPolicy(
+        retry_budget=default_policy.retry_budget,
+        backoff_secs=default_policy.backoff_secs * scale,
+        backoff_max_secs=default_policy.backoff_max_secs * scale,
+        device_pause_secs=default_policy.device_pause_secs * scale,
+        staging_path=config["pipeline"]["apk_source"],
+    )
+    upload_service = SimulatedUploadService(
+        config["pipeline"]["apk_source"], args.upload_mbps * 1024**2 / 8, scale
+    )
+    host_stage_pool = HostStagePool(
+        device_serial,
+        dispatch_client,
+        args.host_workers,
+        args.host_queue,
+        upload_service=upload_service,
+        db_path=db_path,
+        error_policy=error_policy,
+    )
+    run_device_worker(
+        device_serial,
+        timed_client,
+        db_driver,
+        main_class,
+        host_stage_pool,
+        args.devices,
+        error_policy,
+    )
+    results.put(
+        (
+            device_serial,
+            timed_client.busy_secs,
+            timed_client.latencies,
+            db_driver.latencies,
+            db_driver.locked,
+            device.installs,
+        )
+    )
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+def summarize(db_path):
+    conn = sqlite3.connect(db_path)
+    downloaded = conn.execute(
+        "SELECT COUNT(*) FROM input_apps WHERE downloaded = 1"
+    ).fetchone()[0]
+    errors = Counter(
+        dict(
+            conn.execute(
+                """
+                SELECT c.name, COUNT(*)
+                FROM error_apps e
+                JOIN error_codes c ON c.code = e.error_code
+                GROUP BY e.error_code
+                """
+            )
+        )
+    )
+    abandoned, retries = conn.execute(
+        "SELECT COUNT(*) FILTER (WHERE abandoned = 1), SUM(retries) FROM input_apps"
+    ).fetchone()
+    stages = conn.execute(
+        "SELECT stage, AVG(seconds), COUNT(*) FROM app_stage_durations GROUP BY stage ORDER BY stage"
+    ).fetchall()
+    conn.close()
+    return downloaded, abandoned, retries, errors, stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=60)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--time-scale", type=float, default=0.02)
+    parser.add_argument("--install-secs", type=float, default=25.0)
+    parser.add_argument("--apk-mb", type=float, default=24.0)
+    parser.add_argument("--pull-mbps", type=float, default=240.0)
+    parser.add_argument("--upload-mbps", type=float, default=100.0)
+    parser.add_argument("--incompatible-rate", type=float, default=0.05)
+    parser.add_argument("--update-rate", type=float, default=0.02)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--host-workers", type=int, default=2)
+    parser.add_argument("--host-queue", type=int, default=2)
+    parser.add_argument("--staging-quota-mb", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    profile = DeviceProfile(
+        install_secs=args.install_secs,
+        pull_bytes_per_sec=args.pull_mbps * 1024**2 / 8,
+        apk_bytes=int(args.apk_mb * 1024**2),
+        incompatible_rate=args.incompatible_rate,
+        update_rate=args.update_rate,
+        timeout_rate=args.timeout_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        time_scale=args.time_scale,
+        seed=args.seed,
+    )
+    device_serials = [f"fake-device-{i}" for i in range(args.devices)]
+    app_ids = [f"com.example.app{i}" for i in range(args.apps)]
+    work_dir = tempfile.mkdtemp(prefix="throughput-benchmark-")
+    db_path = join(work_dir, "throughput_benchmark.db")
+    apk_source = join(work_dir, "apks")
+    os.makedirs(apk_source)
+    create_database(db_path, app_ids)
+
+    results = multiprocessing.Queue()
+    dispatcher = AppDispatcher(device_serials, lease_seconds=3600, db_path=db_path)
+    supervisor = WorkerSupervisor(
+        dispatcher,
+        partial(
+            simulated_worker,
+            db_path=db_path,
+            profile=profile,
+            args=args,
+            results=results,
+        ),
+        dict(pipeline=dict(ADB_BINARY="adb", apk_source=apk_source)),
+        health_check_interval=1,
+    )
+    started_at = time.perf_counter()
+    dispatcher.start()
+    try:
+        supervisor.run()
+        reports = [results.get() for _ in device_serials]
+    finally:
+        supervisor.stop()
+        dispatcher.stop()
+    elapsed = time.perf_counter() - started_at
+    downloaded, abandoned, retries, errors, stages = summarize(db_path)
+    shutil.rmtree(work_dir)
+
+    device_hours = elapsed / args.time_scale / 3600
+    print(
+        f"Apps: {args.apps}, devices: {args.devices}, wall time: {elapsed:.1f}s "
+        f"({device_hours * 60:.1f} device minutes at time scale {args.time_scale})"
+    )
+    print(
+        f"Downloaded: {downloaded}, throughput: {downloaded / device_hours:.0f} apps/hour "
+        f"({downloaded / device_hours / args.devices:.1f} apps/hour per device)"
+    )
+    print(f"Given up: {abandoned}, retries: {retries}")
+    for error, count in errors.most_common():
+        print(f"Failed: {count} x {error}")
+    for device_serial, busy_secs, _, _, _, installs in sorted(reports):
+        print(
+            f"[{device_serial}] installs: {installs}, utilization: {busy_secs / elapsed:.1%}"
+        )
+    dispatch_latencies = [l for report in reports for l in report[2]]
+    db_latencies = [l for report in reports for l in report[3]]
+    print(
+        f"Dispatch latency p50: {percentile(dispatch_latencies, 0.5) * 1000:.1f}ms, "
+        f"p99: {percentile(dispatch_latencies, 0.99) * 1000:.1f}ms"
+    )
+    print(
+        f"DB calls: {len(db_latencies)}, p50: {percentile(db_latencies, 0.5) * 1000:.2f}ms, "
+        f"p99: {percentile(db_latencies, 0.99) * 1000:.2f}ms, "
+        f"max: {max(db_latencies, default=0) * 1000:.1f}ms, "
+        f"locked: {sum(report[4] for report in reports)}"
+    )
+    for stage, seconds, count in stages:
+        print(
+            f"Stage {stage}: {seconds / args.time_scale:.1f} device seconds on average over {count} apps"
+        )
+
+
+if __name__ == "__main__":
+    # same start method as main.py
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import re
+import time
+from xml.etree import ElementTree
+from helpers.GooglePlay import ERROR_MATCHER, ERROR_MESSAGES
+from helpers.UIHierarchy import UIHierarchy
+
+# Run from the repository root: python -m benchmarks.ui_hierarchy_benchmark
+# Pass recorded `uiautomator dump` files with --fixtures; without them a Play Store
+# details page of realistic size (a few hundred nodes) is generated.
+
+POLL_LOOKUPS = [
+    ("content-desc", "Uninstall"),
+    ("text", "Uninstall"),
+    ("content-desc", "Update"),
+    ("text", "Got it"),
+    ("text", "Complete account setup"),
+]
+
+
+def generate_fixture(cards=60):
+    node = (
+        '<node index="{i}" text="{text}" resource-id="{rid}" class="android.widget.TextView" '
+        'package="com.android.vending" content-desc="{desc}" checkable="false" checked="false" '
+        'clickable="false" enabled="true" focusable="false" focused="false" scrollable="false" '
+        'long-clickable="false" password="false" selected="false" bounds="[{x},{y}][{x2},{y2}]">'
+    )
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><hierarchy rotation="0">']
+    depth = 0
+    for i in range(cards):
+        # every card is a small subtree, like the recommendation rows on a details page
+        for j, (text, desc) in enumerate(
+            [
+                ("", f"Similar app {i}"),
+                (f"Similar app {i}", ""),
+                (f"Developer {i}", ""),
+                (f"{i % 5}.{i % 10} star", ""),
+                ("", f"Rated {i % 5} stars out of five"),
+            ]
+        ):
+            parts.append(
+                node.format(
+                    i=j,
+                    text=text,
+                    desc=desc,
+                    rid="com.android.vending:id/0_resource_name_obfuscated_card",
+                    x=j * 10,
+                    y=i * 100,
+                    x2=j * 10 + 300,
+                    y2=i * 100 + 90,
+                )
+            )
+            depth += 1
+        parts.append("</node>" * depth)
+        depth = 0
+    parts.append(
+        node.format(i=0, text="", desc="Install", rid="", x=40, y=900, x2=1040, y2=1000)
+        + "</node>"
+    )
+    parts.append("</hierarchy>")
+    return "".join(parts)
+
+
+def legacy_get_coordinates(root_node, attribute, value):
+    for node in root_node.iter("node"):
+        if node.attrib.get(attribute) == value:
+            return re.findall(r"\d+", node.attrib["bounds"])
+    return None
+
+
+def legacy_poll_cycle(xml):
+    root_node = ElementTree.fromstring(xml)
+    for attribute, value in POLL_LOOKUPS:
+        legacy_get_coordinates(root_node, attribute, value)
+    legacy_get_coordinates(root_node, "content-desc", "Install")
+    # check_app_incompatible pulled and parsed a second dump
+    for node in ElementTree.fromstring(xml).iter("node"):
+        text_content = node.attrib.get("text", "") + node.attrib.get("content-desc", "")
+        for error_type, errors in ERROR_MESSAGES.items():
+            if any(error in text_content for error in errors):
+                return error_type
+
+
+def indexed_poll_cycle(xml):
+    hierarchy = UIHierarchy.from_string(xml)
+    for attribute, value in POLL_LOOKUPS:
+        hierarchy.get_coordinates(attribute, value)
+    hierarchy.get_coordinates("content-desc", "Install")
+    return hierarchy.find_error(ERROR_MATCHER)
+
+
+def measure(poll_cycle, fixtures, rounds):
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        for xml in fixtures:
+            poll_cycle(xml)
+    return (time.perf_counter() - started_at) / (rounds * len(fixtures))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", nargs="*", default=[])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    fixtures = []
+    for path in args.fixtures:
+        with open(path) as f:
+            fixtures.append(f.read())
+    if not fixtures:
+        fixtures.append(generate_fixture())
+
+    for xml in fixtures:
+        assert legacy_poll_cycle(xml) == indexed_poll_cycle(xml)
+    nodes = sum(xml.count("<node ") for xml in fixtures) // len(fixtures)
+    print(f"Fixtures: {len(fixtures)}, average nodes per dump: {nodes}")
+    legacy = measure(legacy_poll_cycle, fixtures, args.rounds)
+    indexed = measure(indexed_poll_cycle, fixtures, args.rounds)
+    print(f"Per poll cycle, repeated scans: {legacy * 1e3:.2f}ms")
+    print(f"Per poll cycle, single-pass index: {indexed * 1e3:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,3 +12,31 @@ SSH_PORT = "<>"
 APP_METADATA_LOCAL_STORE_PATH = "<>"
 APP_METADATA_REMOTE_STORE_PATH = "<>"
 SQLITE_DB_NAME = "<>"
+SQLITE_BUSY_TIMEOUT_SECS = 30  # how long a connection waits for a locked database
+APP_LEASE_SECONDS = 3600
+APP_RETRY_BUDGET = 3  # transient failures an app may have before it is given up
+APP_RETRY_BACKOFF_SECS = 300  # wait before the first retry, doubled after every failure
+APP_RETRY_BACKOFF_MAX_SECS = 6 * 3600
+DEVICE_PAUSE_SECS = 900  # how long a rate-limited or unreachable device gets no apps
+HOST_STAGE_WORKERS = 2
+HOST_STAGE_QUEUE_SIZE = 2
+UPLOAD_BATCH_SIZE = 8
+UPLOAD_BATCH_LATENCY_SECS = 5
+SSH_CONTROL_PERSIST_SECS = 600
+METADATA_CONCURRENCY = 8
+METADATA_REQUESTS_PER_SECOND = 4
+METADATA_BATCH_SIZE = 200
+METADATA_PLAY_BASE_URL = "https://play.google.com"
+METADATA_SHARD_MAX_BYTES = 64 * 1024 * 1024
+METADATA_SHARD_MAX_AGE_SECS = 900
+UI_BACKEND = "uiautomator"  # or "agent" for the on-device UI agent
+UI_AGENT_SOCKET = "gpsd-ui-agent"
+UI_AGENT_START_COMMAND = ""
+ADB_SHELL_TIMEOUT_SECS = 120
+APK_PULL_CONCURRENCY = 3
+# pipe splits from the device straight into the remote store
+APK_STREAM_TO_ARCHIVE = False
+STAGING_QUOTA_BYTES = 50 * 1024**3
+STAGING_WAIT_POLL_SECS = 10
+STAGING_WAIT_TIMEOUT_SECS = 1800  # then the app goes back and the device moves on
+METRICS_PORT = 9108
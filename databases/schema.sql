@@ -4,20 +4,108 @@ CREATE TABLE input_apps (
             app_id TEXT NOT NULL PRIMARY KEY,
             downloaded BOOLEAN DEFAULT 0,
             metadata BOOLEAN DEFAULT 0, -- this indicates if the metadata of the app has been downloaded
-            device TEXT DEFAULT NULL -- this is the device that the app is currently downloaded on
+            device TEXT DEFAULT NULL, -- this is the device that the app is currently downloaded on
+            lease_expires_at REAL DEFAULT NULL, -- epoch seconds until which the device holds the app
+            failed_devices INTEGER DEFAULT 0, -- number of distinct devices the app failed on
+            incompatible_devices INTEGER DEFAULT 0, -- number of distinct devices the app is incompatible with
+            metadata_attempted_at REAL DEFAULT NULL, -- last failed metadata fetch, retried after a day
+            retries INTEGER DEFAULT 0, -- transient failures so far, counted against the retry budget
+            retry_at REAL DEFAULT NULL, -- epoch seconds before which no device gets the app again
+            abandoned BOOLEAN DEFAULT 0 -- given up after a permanent error or the last retry
         );
 
 CREATE INDEX idx2_app_id ON input_apps (app_id);
+CREATE INDEX idx_input_apps_lease ON input_apps (downloaded, lease_expires_at);
+CREATE INDEX idx_input_apps_failed_devices ON input_apps (downloaded, failed_devices);
+CREATE INDEX idx_input_apps_incompatible_devices ON input_apps (downloaded, incompatible_devices);
+CREATE INDEX idx_input_apps_metadata ON input_apps (downloaded, metadata);
+CREATE INDEX idx_input_apps_retry ON input_apps (retry_at) WHERE retry_at IS NOT NULL;
+
+-- error_codes definition
+
+CREATE TABLE error_codes (
+            code INTEGER PRIMARY KEY, -- see helpers/ErrorCatalog.py
+            name TEXT NOT NULL
+        );
 
 -- error_apps definition
 
 CREATE TABLE error_apps (
             app_id TEXT NOT NULL,
             device TEXT NOT NULL,
-            error TEXT NOT NULL,
-            PRIMARY KEY (app_id, device, error),
+            error_code INTEGER NOT NULL,
+            PRIMARY KEY (app_id, device, error_code),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE,
+            FOREIGN KEY (error_code) REFERENCES error_codes (code)
+        );
+
+CREATE INDEX idx_error_code ON error_apps (error_code);
+
+-- error_messages definition
+
+CREATE TABLE error_messages (
+            app_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            error_code INTEGER NOT NULL,
+            message TEXT NOT NULL, -- raw exception text of the latest failure, adb/rsync stderr included
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (app_id, device, error_code),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+
+-- app_stages definition
+
+CREATE TABLE app_stages (
+            app_id TEXT NOT NULL,
+            stage TEXT NOT NULL, -- pull or upload
+            device TEXT NOT NULL,
+            completed_at REAL NOT NULL,
+            PRIMARY KEY (app_id, stage),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+
+-- apk_manifest definition
+
+CREATE TABLE apk_manifest (
+            app_id TEXT NOT NULL,
+            split_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            uploaded BOOLEAN DEFAULT 0, -- this indicates the split was verified in the remote store
+            PRIMARY KEY (app_id, split_name),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+-- metadata_index definition
+
+CREATE TABLE metadata_index (
+            app_id TEXT PRIMARY KEY,
+            shard TEXT NOT NULL, -- JSONL shard file that holds the app's metadata record
+            offset INTEGER NOT NULL, -- byte offset of the record inside the shard
+            length INTEGER NOT NULL, -- byte length of the record, including the newline
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+
+CREATE INDEX idx_metadata_index_shard ON metadata_index (shard);
+
+-- staging definition
+
+CREATE TABLE staging (
+            app_id TEXT PRIMARY KEY,
+            device TEXT NOT NULL, -- device whose pull reserved the space
+            bytes INTEGER NOT NULL, -- bytes the app occupies in the local staging area
+            reserved_at REAL NOT NULL,
+            waited_secs REAL DEFAULT 0, -- time the device waited for the quota before pulling
             FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
         );
 
-CREATE INDEX idx_error ON error_apps (error);
-CREATE INDEX idx_app_id ON error_apps (app_id);
\ No newline at end of file
+-- app_stage_durations definition
+
+CREATE TABLE app_stage_durations (
+            app_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            device TEXT NOT NULL, -- device (or host) that ran the stage
+            seconds REAL NOT NULL, -- time spent in the stage on its latest run
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (app_id, stage),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
@@ -1,136 +1,223 @@
 import logging
-import multiprocessing
+import os
+import signal
+import socket
 import subprocess
+import threading
 import time
-from datetime import datetime, timedelta
-from adbutils import adb
+from collections import Counter
+from contextlib import contextmanager
+from adbutils import adb, AdbError, AdbTimeout
+from config.Config import ADB_SHELL_TIMEOUT_SECS
+from helpers.Metrics import ADB_CALL_SECONDS
 
 logger = logging.getLogger(f"ADBCommands:")
 
 
+class ShellStream:
+    def __init__(self, connection, chunk_size):
+        self.connection = connection
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            try:
+                chunk = self.connection.conn.recv(self.chunk_size)
+            except OSError:
+                if self.connection.closed:
+                    return
+                raise
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        # safe from another thread: shutdown wakes up a reader blocked in recv,
+        # and dropping the connection ends the command on the device
+        try:
+            self.connection.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
 class ADBCommands:
-    def __init__(self, config):
+    def __init__(self, config, adb_utils=None):
         self.config = config
         self.device_serial = self.config["pipeline"]["device_serial"]
         self.adb = self.config["pipeline"]["ADB_BINARY"]
-        self.adb_utils = adb.device(self.device_serial)
-
-    def adb_simple_shell(self, *args):
-        process = subprocess.run(
-            [
-                self.adb,
-                "-s",
-                self.device_serial,
-                "shell",
-                *args,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        return process.returncode, process.stdout.decode()
-
-    def adb_simple(self, *args):
-        process = subprocess.run(
-            [
-                self.adb,
-                "-s",
-                self.device_serial,
-                *args,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        return process.returncode, process.stdout.decode()
+        # adb_utils stands in for the adbutils device, e.g. a simulated one
+        self.adb_utils = adb_utils or adb.device(self.device_serial)
+        # package -> split paths, only for packages known to be installed; a
+        # miss is always probed again since the store installs behind our back
+        self.installed = {}
+        # adb round trips per kind since the last reset, used for per-app stats
+        self.call_counts = Counter()
+        self.call_counts_lock = threading.Lock()
+
+    @contextmanager
+    def track_call(self, kind):
+        with self.call_counts_lock:
+            self.call_counts[kind] += 1
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            ADB_CALL_SECONDS.labels(self.device_serial, kind).observe(
+                time.monotonic() - started_at
+            )
 
-    def installed_packages(self) -> list:
-        status, ret = self.adb_simple_shell("pm", "list", "packages")
-        if ret is None:
-            return []
-        package_output = [package for package in ret.split("\n") if package]
-        package_list = []
-        for item in package_output:
-            if item.startswith("package"):
-                package_list.append(item.replace("package:", ""))
+    def reset_call_counts(self):
+        with self.call_counts_lock:
+            call_counts = self.call_counts
+            self.call_counts = Counter()
+        return call_counts
 
-        return package_list
+    def adb_utils_shell(self, command):
+        with self.track_call("shell"):
+            return self.adb_utils.shell(command)
+
+    def adb_simple_shell(self, *args, timeout_secs=ADB_SHELL_TIMEOUT_SECS):
+        # talks to the adb server socket instead of spawning an adb client; the
+        # args are joined unquoted, the same way the adb binary passes them on
+        try:
+            with self.track_call("shell"):
+                result = self.adb_utils.shell2(" ".join(args), timeout=timeout_secs)
+        except AdbError as e:
+            logger.error(f"[{self.device_serial}] adb shell {args} failed: {e}")
+            return 1, str(e)
+        return result.returncode, result.output
+
+    def adb_simple(self, *args, timeout_secs=None):
+        if len(args) == 3 and args[0] == "pull":
+            try:
+                with self.track_call("pull"):
+                    size = self.adb_utils.sync.pull(args[1], args[2])
+            except AdbError as e:
+                return 1, str(e)
+            return 0, f"{args[1]}: 1 file pulled, {size} bytes"
+        # anything without a socket-level equivalent still goes through the binary
+        with self.track_call(args[0] if args else "adb"):
+            returncode, stdout, stderr = self.run_adb(*args, timeout_secs=timeout_secs)
+        if returncode is None:
+            return 1, f"Timed out after {timeout_secs}s: {stdout}{stderr}"
+        return returncode, stdout + stderr
+
+    def adb_shell_stream(self, *args, timeout_secs=30, chunk_size=64 * 1024):
+        # one adb transport, output handed over as it arrives
+        with self.track_call("shell_stream"):
+            connection = self.adb_utils.shell(list(args), stream=True)
+        connection.conn.settimeout(timeout_secs)
+        return ShellStream(connection, chunk_size)
 
     def is_package_installed(self, package_name: str) -> bool:
-        packages = self.installed_packages()
-        if package_name in packages:
-            return True
+        return bool(self.package_paths(package_name))
+
+    def package_paths(self, package_name: str) -> list:
+        if package_name in self.installed:
+            return self.installed[package_name]
+        status, ret = self.adb_simple_shell("pm", "path", package_name)
+        paths = [
+            line.split("package:", 1)[1].strip()
+            for line in ret.splitlines()
+            if line.startswith("package:")
+        ]
+        if status == 0 and paths:
+            self.installed[package_name] = paths
+        return paths
+
+    def forget_package(self, package_name=None):
+        # call after anything that installs or removes packages
+        if package_name is None:
+            self.installed.clear()
         else:
-            return False
+            self.installed.pop(package_name, None)
 
     def adb_install_multiple(self, apk_files):
-        process = subprocess.run(
-            [
-                self.adb,
-                "-s",
-                self.device_serial,
+        # the package name is inside the APKs, so drop everything we know
+        self.forget_package()
+        with self.track_call("install-multiple"):
+            returncode, stdout, stderr = self.run_adb(
                 "install-multiple",
                 "-r",
                 "-g",
                 *apk_files,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            timeout=60,  # set timeout to 1 minutes so that it will not hang on harmful apps
-        )
-        if process.returncode != 0:
-            logger.error(process.stdout.decode())
+                timeout_secs=60,  # set timeout to 1 minutes so that it will not hang on harmful apps
+            )
+        if returncode is None:
+            raise Exception("Timed out installing multiple APKs")
+        if returncode != 0:
+            logger.error(stdout + stderr)
             raise Exception("Failed to install multiple APKs")
-        if process.returncode == 0:
-            logger.info(f"Installed multiple APKs: {apk_files}")
+        logger.info(f"Installed multiple APKs: {apk_files}")
 
-    def adb_init(self, command, *args, process_queue=None):
+    def run_adb(self, *args, timeout_secs=None):
+        # returns (returncode, stdout, stderr); returncode is None on a timeout
         if self.device_serial is not None:
-            adb_cmd = [self.adb, "-s", self.device_serial, command]
+            adb_cmd = [self.adb, "-s", self.device_serial, *args]
         else:
-            adb_cmd = [self.adb, command]
-        adb_cmd.extend(args)
-
+            adb_cmd = [self.adb, *args]
         logger.debug(adb_cmd)
-
+        # own process group, so a timeout also takes down anything adb forked
+        process = subprocess.Popen(
+            adb_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
         try:
-            result = subprocess.check_output(adb_cmd, stderr=subprocess.STDOUT).decode(
-                "UTF-8", "backslashreplace"
-            )
-        except Exception as e:
-            result = None
-
-        if process_queue is not None:
-            process_queue.put(result)
+            stdout, stderr = process.communicate(timeout=timeout_secs)
+            returncode = process.returncode
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            stdout, stderr = process.communicate()
+            returncode = None
+        return (
+            returncode,
+            stdout.decode("UTF-8", "backslashreplace"),
+            stderr.decode("UTF-8", "backslashreplace"),
+        )
 
-        return result
+    def adb_init(self, command, *args):
+        if command == "shell":
+            returncode, result = self.adb_simple_shell(*args)
+            return result if returncode == 0 else None
+        returncode, stdout, stderr = self.run_adb(command, *args)
+        return stdout + stderr if returncode == 0 else None
 
     def adb_command_timeout(
         self, command, *args, timeout_secs: int = 120, quit_on_fail: bool = False
     ):
-        ret = multiprocessing.Queue()
-        proc = multiprocessing.Process(
-            target=self.adb_init, args=(command, *args), kwargs={"process_queue": ret}
-        )
-
-        proc.start()
-
-        end_time = datetime.now() + timedelta(seconds=timeout_secs)
-        success = True
-
-        while proc.is_alive():
-            time.sleep(2)
-            if datetime.now() > end_time:
-                proc.terminate()
-                proc.join()
+        result = None
+        if command == "shell":
+            try:
+                with self.track_call(command):
+                    shell_return = self.adb_utils.shell2(
+                        " ".join(args), timeout=timeout_secs
+                    )
+                success = True
+                if shell_return.returncode == 0:
+                    result = shell_return.output
+            except AdbTimeout:
                 success = False
+            except AdbError:
+                success = True
+        else:
+            with self.track_call(command):
+                returncode, stdout, stderr = self.run_adb(
+                    command, *args, timeout_secs=timeout_secs
+                )
+            success = returncode is not None
+            if returncode == 0:
+                result = stdout + stderr
 
         if not success and quit_on_fail:
             raise Exception(f"Failed to run adb command: {command} {args}")
 
-        if success:
-            return success, ret.get_nowait()
-        else:
-            return success, None
+        return success, result
 
     def adb_uninstall_apk(self, package_name) -> None:
-        ret = self.adb_utils.uninstall(package_name)
+        self.forget_package(package_name)
+        with self.track_call("uninstall"):
+            ret = self.adb_utils.uninstall(package_name)
         logger.info(f"Uninstalled {package_name}: {ret}")
@@ -0,0 +1,118 @@
+import re
+
+# Integer codes stored in error_apps. A code is never reused for another error;
+# the raw exception text of each failure goes to error_messages instead.
+UNKNOWN_ERROR = 0
+APP_INCOMPATIBLE = 1
+NOT_AVAILABLE_IN_COUNTRY = 2
+INSTALLATION_TIMEOUT = 3
+INSTALL_BUTTON_NOT_FOUND = 4
+UPDATE_AVAILABLE = 5
+AGE_VERIFICATION_REQUIRED = 6
+APP_NOT_INSTALLED = 7
+LEASE_LOST = 8
+APK_PULL_FAILED = 9
+UPLOAD_FAILED = 10
+UI_DUMP_FAILED = 11
+UI_AGENT_FAILED = 12
+ADB_FAILED = 13
+DATABASE_BUSY = 14
+RATE_LIMITED = 15
+DEVICE_UNREACHABLE = 16
+STAGING_FULL = 17
+
+# the names match the messages GooglePlay raises, so rows written before the
+# catalog existed keep reading the same
+ERROR_NAMES = {
+    UNKNOWN_ERROR: "Unknown error",
+    APP_INCOMPATIBLE: "App is incompatible",
+    NOT_AVAILABLE_IN_COUNTRY: "This item isn't available in your country.",
+    INSTALLATION_TIMEOUT: "Installation timeout",
+    INSTALL_BUTTON_NOT_FOUND: "Failed to find install button",
+    UPDATE_AVAILABLE: "Update available",
+    AGE_VERIFICATION_REQUIRED: "Age verification required",
+    APP_NOT_INSTALLED: "App is not installed",
+    LEASE_LOST: "Lost the lease",
+    APK_PULL_FAILED: "APK pull failed",
+    UPLOAD_FAILED: "Upload failed",
+    UI_DUMP_FAILED: "UI dump failed",
+    UI_AGENT_FAILED: "UI agent failed",
+    ADB_FAILED: "adb failed",
+    DATABASE_BUSY: "Database busy",
+    RATE_LIMITED: "Rate limited",
+    DEVICE_UNREACHABLE: "Device unreachable",
+    STAGING_FULL: "Staging area full",
+}
+
+# first match wins, so the specific messages come before the catch-alls
+ERROR_PATTERNS = [
+    (APP_INCOMPATIBLE, r"^App is incompatible"),
+    (NOT_AVAILABLE_IN_COUNTRY, r"isn't available in your country"),
+    (INSTALLATION_TIMEOUT, r"^Installation timeout"),
+    (INSTALL_BUTTON_NOT_FOUND, r"^Failed to find install button"),
+    (UPDATE_AVAILABLE, r"^Update available"),
+    (AGE_VERIFICATION_REQUIRED, r"^Age verification required"),
+    (APP_NOT_INSTALLED, r"^App: \[.*\] is not installed"),
+    (LEASE_LOST, r"^Lost the lease"),
+    (APK_PULL_FAILED, r"^(Pulled|Streamed) \S+ is \d+ bytes, expected"),
+    (
+        UPLOAD_FAILED,
+        r"^(An error occurred in \[|Remote copy of \[|Source path: \[|Streaming \[)",
+    ),
+    (STAGING_FULL, r"^Staging area full"),
+    (UI_DUMP_FAILED, r"UI hierarchy"),
+    (UI_AGENT_FAILED, r"UI agent"),
+    (DATABASE_BUSY, r"database is (locked|busy)"),
+    (RATE_LIMITED, r"^Rate limited|(?i:try again later|too many (requests|attempts))"),
+    (
+        DEVICE_UNREACHABLE,
+        r"(?i)device( '?\S+'?)? (not found|offline)|no devices/emulators found"
+        r"|connection (refused|reset)|broken pipe",
+    ),
+    (ADB_FAILED, r"(?i)\badb\b|multiple APKs|timed out"),
+]
+ERROR_PATTERNS = [(code, re.compile(pattern)) for code, pattern in ERROR_PATTERNS]
+
+
+# What a failure says about the app and the device it happened on. Errors the
+# table leaves out are transient: the app is retried after a backoff, on any
+# device, until its retry budget is spent.
+
+# no device will ever get the app, it is given up
+APP_PERMANENT = "app_permanent"
+# this device will never get the app, the others still try it
+DEVICE_PERMANENT = "device_permanent"
+TRANSIENT = "transient"
+# the store is throttling the device; the device is left alone for a while and
+# the app goes to the other devices without waiting for a backoff
+DEVICE_PAUSE = "device_pause"
+
+# the device itself is gone (unplugged, offline, its adb connection dropped):
+# it is left alone for a while and the app goes back to the others untouched,
+# otherwise a dead device would spend the retries of every app it claims
+DEVICE_FAULT = "device_fault"
+
+# another device holds the app now; nothing is held against the app, this
+# device only lets go of it
+HANDED_OVER = "handed_over"
+
+ERROR_POLICIES = {
+    # compatibility depends on the device's Android version and ABI
+    APP_INCOMPATIBLE: DEVICE_PERMANENT,
+    NOT_AVAILABLE_IN_COUNTRY: APP_PERMANENT,
+    AGE_VERIFICATION_REQUIRED: APP_PERMANENT,
+    RATE_LIMITED: DEVICE_PAUSE,
+    DEVICE_UNREACHABLE: DEVICE_FAULT,
+    LEASE_LOST: HANDED_OVER,
+}
+
+
+def error_policy(error_code):
+    return ERROR_POLICIES.get(error_code, TRANSIENT)
+
+
+def classify_error(message):
+    for code, pattern in ERROR_PATTERNS:
+        if pattern.search(message):
+            return code
+    return UNKNOWN_ERROR
@@ -1,69 +1,91 @@
+import hashlib
 import logging
 import os
-import re
-import tempfile
 import time
-from os.path import abspath, join
+from os.path import abspath, exists, join
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import humanize
-from xml.etree import ElementTree
+from config.Config import APK_PULL_CONCURRENCY
 from helpers.ADBCommands import ADBCommands
+from helpers.InstallWatcher import InstallWatcher
+from helpers.UIBackend import create_ui_backend
+from helpers.UIHierarchy import ErrorMatcher
 
 logger = logging.getLogger("GooglePlay:")
 
+ERROR_MESSAGES = {
+    "App is incompatible": {
+        "Your device isn't compatible with this version.",
+        "This app isn't available for your device because it was made for an older version of Android.",
+        "This phone isn't compatible with this app.",
+        "Item not found.",
+    },
+    "This item isn't available in your country.": {
+        "This item isn't available in your country.",
+    },
+    # the store's answer when it throttles the account or device
+    "Rate limited": {
+        "Error retrieving information from server. [DF-DFERH-01]",
+        "Something went wrong. Try again later.",
+        "Too many attempts. Try again later.",
+    },
+}
+ERROR_MATCHER = ErrorMatcher(ERROR_MESSAGES)
+
 
 class GooglePlay:
-    def __init__(self, config):
+    def __init__(self, config, adb=None, ui_backend=None, stage_timer=None):
         self.config = config
         self.device_serial = config["pipeline"]["device_serial"]
-        self.adb = ADBCommands(config)
+        self.adb = adb or ADBCommands(config)
         self.install_timeout = 1800
         self.install_button_timeout = 20
+        self.install_button_poll_secs = 10
+        # time the store gets to render the details page before the first dump
+        self.store_load_secs = 5
+        # the UI poll backs off between these while waiting for an install
+        self.install_poll_min_secs = 2
+        self.install_poll_max_secs = 30
+        self.pull_concurrency = APK_PULL_CONCURRENCY
+        self.stage_timer = stage_timer
+        self.ui_backend = ui_backend or create_ui_backend(self.adb)
 
-    def pull_ui_hierarchy(self):
-        temp_file_path = abspath(
-            join(tempfile.gettempdir(), f"{self.device_serial}_ui.xml")
-        )
-        self.adb.adb_simple_shell("uiautomator", "dump", "/sdcard/ui.xml")
-        self.adb.adb_simple("pull", "/sdcard/ui.xml", temp_file_path)
-        if not os.path.exists(temp_file_path) or os.stat(temp_file_path).st_size == 0:
-            raise Exception("Failed to retrieve UI hierarchy")
-        return ElementTree.parse(temp_file_path).getroot()
+    def pull_ui_hierarchy(self, stop_on=()):
+        return self.ui_backend.snapshot(stop_on)
 
-    @staticmethod
-    def get_coordinates(root_node, attribute, value):
-        for node in root_node.iter("node"):
-            if node.attrib.get(attribute) == value:
-                return re.findall(r"\d+", node.attrib["bounds"])
-        return None
-
-    def check_app_incompatible(self):
-        error_messages = {
-            "App is incompatible": {
-                "Your device isn't compatible with this version.",
-                "This app isn't available for your device because it was made for an older version of Android.",
-                "This phone isn't compatible with this app.",
-                "Item not found.",
-            },
-            "This item isn't available in your country.": {
-                "This item isn't available in your country.",
-            },
-        }
-
-        for node in self.pull_ui_hierarchy().iter("node"):
-            text_content = node.attrib.get("text", "") + node.attrib.get(
-                "content-desc", ""
-            )
-            for error_type, errors in error_messages.items():
-                if any(error in text_content for error in errors):
-                    raise Exception(error_type)
-            # for a special case, where no messages in the UI hierarchy
-            if (
-                node.attrib.get("resource-id", "")
-                == "com.android.vending:id/0_resource_name_obfuscated"
-            ):
-                raise Exception("App is incompatible")
+    def tap(self, coords):
+        x = round((int(coords[0]) + int(coords[2])) / 2)
+        y = round((int(coords[1]) + int(coords[3])) / 2)
+        self.ui_backend.tap(x, y)
+
+    def check_app_incompatible(self, hierarchy=None):
+        hierarchy = hierarchy or self.pull_ui_hierarchy()
+        error_type = hierarchy.find_error(ERROR_MATCHER)
+        if error_type:
+            raise Exception(error_type)
+        # for a special case, where no messages in the UI hierarchy
+        if hierarchy.get_coordinates(
+            "resource-id", "com.android.vending:id/0_resource_name_obfuscated"
+        ):
+            raise Exception("App is incompatible")
 
     def download_from_store(self, app_id):
+        with self.span("store_open"):
+            install_button_cord = self.wait_for_install_button(app_id)
+        # watch before tapping so a fast install cannot slip past
+        self.adb.forget_package(app_id)
+        watcher = self.watch_install(app_id)
+        try:
+            self.tap(install_button_cord)
+            logger.info(f"Install button clicked: {app_id}")
+            with self.span("install_wait"):
+                return self.check_for_install_complete(app_id, watcher)
+        finally:
+            if watcher:
+                watcher.stop()
+
+    def wait_for_install_button(self, app_id):
         self.adb.adb_simple_shell(
             "am",
             "start",
@@ -72,87 +94,202 @@ class GooglePlay:
             "-d",
             f"market://details?id={app_id}",
         )
-        time.sleep(5)
+        time.sleep(self.store_load_secs)
         timeout = 0
         while timeout <= self.install_button_timeout:
             logger.info(
-                f"[{self.device_serial}] Waiting for install button (10s) [time left: {self.install_button_timeout - timeout}]"
+                f"[{self.device_serial}] Waiting for install button ({self.install_button_poll_secs}s) [time left: {self.install_button_timeout - timeout}]"
             )
-            root_node = self.pull_ui_hierarchy()
-            install_button_cord = self.get_coordinates(
-                root_node, "content-desc", "Install"
-            )
-
+            hierarchy = self.pull_ui_hierarchy(stop_on=[("content-desc", "Install")])
+            install_button_cord = hierarchy.get_coordinates("content-desc", "Install")
             if install_button_cord:
-                x = round(
-                    (int(install_button_cord[0]) + int(install_button_cord[2])) / 2
-                )
-                y = round(
-                    (int(install_button_cord[1]) + int(install_button_cord[3])) / 2
-                )
-                self.adb.adb_simple_shell("input", "tap", str(x), str(y))
-                logger.info(f"Install button clicked: {app_id}")
-                return self.check_for_install_complete(app_id)
-            self.check_app_incompatible()
-            time.sleep(10)
-            timeout += 10
+                return install_button_cord
+            self.check_app_incompatible(hierarchy)
+            time.sleep(self.install_button_poll_secs)
+            timeout += self.install_button_poll_secs
         raise Exception("Failed to find install button")
 
-    def check_for_install_complete(self, app_id):
-        timeout = 0
-        while timeout < self.install_timeout:
+    def span(self, stage):
+        return self.stage_timer.span(stage) if self.stage_timer else nullcontext()
+
+    def watch_install(self, app_id):
+        try:
+            return InstallWatcher.from_logcat(self.adb, app_id)
+        except Exception as e:
+            logger.error(
+                f"[{self.device_serial}] Failed to follow logcat, polling only: {e}"
+            )
+            return None
+
+    def check_for_install_complete(self, app_id, watcher=None):
+        deadline = time.monotonic() + self.install_timeout
+        delay = self.install_poll_min_secs
+        while time.monotonic() < deadline:
             logger.info(
-                f"[{self.device_serial}] Waiting for install to complete (10s) [time left: {self.install_timeout - timeout}]"
+                f"[{self.device_serial}] Waiting for install to complete ({delay}s) [time left: {round(deadline - time.monotonic())}]"
             )
-            time.sleep(10)
-            root_node = self.pull_ui_hierarchy()
-            if self.get_coordinates(
-                root_node, "content-desc", "Uninstall"
-            ) or self.get_coordinates(root_node, "text", "Uninstall"):
+            watching = watcher is not None and watcher.alive
+            if watching:
+                if watcher.wait(delay) and self.adb.is_package_installed(app_id):
+                    return
+            else:
+                time.sleep(delay)
+            # the UI poll stays as a fallback for dialogs the log does not show
+            # only the success buttons may cut the dump short, the others need all of it
+            hierarchy = self.pull_ui_hierarchy(
+                stop_on=[("content-desc", "Uninstall"), ("text", "Uninstall")]
+            )
+            if hierarchy.get_coordinates(
+                "content-desc", "Uninstall"
+            ) or hierarchy.get_coordinates("text", "Uninstall"):
                 return
-            if self.get_coordinates(root_node, "content-desc", "Update"):
+            if hierarchy.get_coordinates("content-desc", "Update"):
                 raise Exception("Update available")
-            if self.get_coordinates(root_node, "text", "Got it"):
+            if hierarchy.get_coordinates("text", "Got it"):
                 raise Exception("Age verification required")
-            if self.get_coordinates(root_node, "text", "Complete account setup"):
+            if hierarchy.get_coordinates("text", "Complete account setup"):
                 self.handle_account_setup(app_id)
+            # the log can miss the install (a rotated buffer, a restarted
+            # logcat), so the package manager is asked on every cycle as well
             if self.adb.is_package_installed(app_id):
                 return
-            timeout += 10
+            delay = min(delay * 2, self.install_poll_max_secs)
         raise Exception("Installation timeout")
 
     def handle_account_setup(self, app_id):
-        root_node = self.pull_ui_hierarchy()
+        hierarchy = self.pull_ui_hierarchy()
         for button in ["Continue", "Skip", "Install"]:
-            coords = self.get_coordinates(root_node, "text", button)
+            coords = hierarchy.get_coordinates("text", button)
             if coords:
-                x = round((int(coords[0]) + int(coords[2])) / 2)
-                y = round((int(coords[1]) + int(coords[3])) / 2)
-                self.adb.adb_simple_shell("input", "tap", str(x), str(y))
+                self.tap(coords)
                 logger.info(f"{button} button clicked: {app_id}")
                 time.sleep(10)
-                root_node = self.pull_ui_hierarchy()
-
-    def _get_apk_path(self, app_id):
-        paths = []
-        status, res = self.adb.adb_simple_shell("pm", "path", app_id)
-        for line in res.splitlines():
-            if line.startswith("package:"):
-                paths.append(line.split("package:")[1])
-        return paths
-
-    def pull_apk(self, app_id):
-        paths = self._get_apk_path(app_id)
+                hierarchy = self.pull_ui_hierarchy()
+
+    def pull_apk(self, app_id, known_manifest=None, sink=None):
+        # known_manifest is what the DB recorded for an earlier pull:
+        # {split_name: (size, sha256, uploaded)}; used to validate leftover files
+        paths = self.adb.package_paths(app_id)
+        if sink:
+            with ThreadPoolExecutor(max_workers=self.pull_concurrency) as executor:
+                return list(
+                    executor.map(
+                        lambda path: self._stream_split(path, app_id, sink), paths
+                    )
+                )
         app_pull_path = abspath(join(self.config["pipeline"]["apk_source"], app_id))
         os.makedirs(app_pull_path, exist_ok=True)
-        _, _, files = next(os.walk(app_pull_path))
-        if len(files) != len(paths):
-            for path in paths:
-                file_name = path.split("/")[-1]
-                size = self.adb.adb_utils.sync.pull(
-                    path, abspath(join(app_pull_path, file_name))
+        with ThreadPoolExecutor(max_workers=self.pull_concurrency) as executor:
+            return list(
+                executor.map(
+                    lambda path: self._pull_split(
+                        path, app_pull_path, known_manifest or {}
+                    ),
+                    paths,
+                )
+            )
+
+    def remote_apk_size(self, app_id):
+        total = 0
+        for path in self.adb.package_paths(app_id):
+            with self.adb.track_call("stat"):
+                total += self.adb.adb_utils.sync.stat(path).size
+        return total
+
+    def _pull_split(self, path, app_pull_path, known_manifest):
+        file_name = path.split("/")[-1]
+        local_path = abspath(join(app_pull_path, file_name))
+        with self.adb.track_call("stat"):
+            remote_size = self.adb.adb_utils.sync.stat(path).size
+        if exists(local_path) and self._size_matches(
+            os.stat(local_path).st_size, remote_size
+        ):
+            entry = self._hash_local_file(file_name, local_path)
+            known = known_manifest.get(file_name)
+            if known is None or known[:2] == entry[1:]:
+                logger.info(f"Reusing already pulled {local_path}")
+                return entry
+            logger.info(
+                f"Local {local_path} does not match its manifest, pulling again"
+            )
+        return self._pull_file(path, file_name, local_path, remote_size)
+
+    def _stream_split(self, path, app_id, sink):
+        # device straight into the archive, nothing is staged on the local disk
+        file_name = path.split("/")[-1]
+        with self.adb.track_call("stat"):
+            remote_size = self.adb.adb_utils.sync.stat(path).size
+        sha256 = hashlib.sha256()
+        size = 0
+        writer = sink.open(app_id, file_name)
+        try:
+            with self.adb.track_call("sync_pull"):
+                for chunk in self.adb.adb_utils.sync.iter_content(path):
+                    writer.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+            if not self._size_matches(size, remote_size):
+                raise Exception(
+                    f"Streamed {path} is {size} bytes, expected {remote_size} bytes"
                 )
-                logger.info(f"Pulled {path} with size {humanize.naturalsize(size)}")
+            writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+        logger.info(f"Streamed {path} with size {humanize.naturalsize(size)}")
+        return file_name, size, sha256.hexdigest()
+
+    @staticmethod
+    def _size_matches(local_size, remote_size):
+        # sync STAT reports the size in 32 bits
+        return local_size & 0xFFFFFFFF == remote_size
+
+    def _pull_file(self, path, file_name, local_path, remote_size, resume=True):
+        # written to a .part file and renamed once complete, so a crash never
+        # leaves a file that looks finished; a .part left behind is resumed
+        part_path = f"{local_path}.part"
+        sha256 = hashlib.sha256()
+        offset = 0
+        if resume and exists(part_path):
+            offset = os.stat(part_path).st_size
+            if offset >= remote_size:
+                offset = 0
+            else:
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        sha256.update(chunk)
+        if offset:
+            chunks = self.adb.adb_shell_stream("tail", "-c", f"+{offset + 1}", path)
+        else:
+            chunks = self.adb.adb_utils.sync.iter_content(path)
+        size = offset
+        with self.adb.track_call("resume_pull" if offset else "sync_pull"), open(
+            part_path, "ab" if offset else "wb"
+        ) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        if not self._size_matches(size, remote_size):
+            if offset:
+                logger.info(f"Resuming {path} at {offset} bytes failed, pulling again")
+                return self._pull_file(
+                    path, file_name, local_path, remote_size, resume=False
+                )
+            raise Exception(
+                f"Pulled {path} is {size} bytes, expected {remote_size} bytes"
+            )
+        os.replace(part_path, local_path)
+        logger.info(f"Pulled {path} with size {humanize.naturalsize(size)}")
+        return file_name, size, sha256.hexdigest()
+
+    @staticmethod
+    def _hash_local_file(file_name, local_path):
+        sha256 = hashlib.sha256()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return file_name, os.stat(local_path).st_size, sha256.hexdigest()
 
     def close(self):
         self.adb.adb_simple_shell("am", "force-stop", "com.android.vending")
@@ -0,0 +1,70 @@
+import logging
+import re
+import threading
+
+logger = logging.getLogger("InstallWatcher:")
+
+# log lines that show up when a package lands; they only wake the waiter,
+# the install itself is confirmed against the package manager
+INSTALL_MARKERS = (
+    b"PACKAGE_ADDED",
+    b"PACKAGE_REPLACED",
+    b"installPackageLI",
+    b"Install success",
+)
+
+
+class InstallWatcher:
+    def __init__(self, stream, package_name, markers=INSTALL_MARKERS):
+        # stream is an iterable of raw log bytes with a close() that ends it
+        self.stream = stream
+        self.package_name = package_name
+        self.package_pattern = re.compile(
+            rb"(?<![\w.])" + re.escape(package_name.encode()) + rb"(?![\w.])"
+        )
+        self.markers = markers
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.alive = True
+
+    @classmethod
+    def from_logcat(cls, adb, package_name):
+        # -T 1 starts at the tail so only lines written from now on are matched
+        stream = adb.adb_shell_stream(
+            "logcat", "-v", "brief", "-T", "1", timeout_secs=None
+        )
+        return cls(stream, package_name).start()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait(self, timeout):
+        # True when a matching line arrived; the event is consumed so a false
+        # alarm does not keep waking the waiter
+        if self.event.wait(timeout):
+            self.event.clear()
+            return True
+        return False
+
+    def stop(self):
+        self.stream.close()
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        buffer = b""
+        try:
+            for chunk in self.stream:
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                if any(self.matches(line) for line in lines):
+                    self.event.set()
+        except Exception as e:
+            logger.error(f"Install watcher for [{self.package_name}] stopped: {e}")
+        finally:
+            self.alive = False
+
+    def matches(self, line):
+        return any(marker in line for marker in self.markers) and bool(
+            self.package_pattern.search(line)
+        )
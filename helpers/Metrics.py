@@ -0,0 +1,54 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+# Device workers run in their own processes, so main.py points
+# PROMETHEUS_MULTIPROC_DIR at a scratch directory before anything imports this
+# module; every process then writes its samples there and the exporter in the
+# parent process merges them.
+
+STAGE_SECONDS = Histogram(
+    "gpsd_stage_duration_seconds",
+    "Time spent in each stage of the download pipeline",
+    ["device", "stage"],
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600),
+)
+ADB_CALL_SECONDS = Histogram(
+    "gpsd_adb_call_duration_seconds",
+    "Time spent in adb round trips",
+    ["device", "kind"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+
+
+def start_exporter(port):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+
+
+class StageTimer:
+    def __init__(self, device_serial):
+        self.device_serial = device_serial
+        # stage -> seconds for the current app, persisted by the caller
+        self.durations = {}
+
+    @contextmanager
+    def span(self, stage):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started_at
+            STAGE_SECONDS.labels(self.device_serial, stage).observe(seconds)
+            self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    def reset(self):
+        durations = self.durations
+        self.durations = {}
+        return durations
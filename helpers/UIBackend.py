@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+from os.path import abspath, join
+from config.Config import UI_AGENT_SOCKET, UI_AGENT_START_COMMAND, UI_BACKEND
+from helpers.UIHierarchy import UIHierarchy
+
+logger = logging.getLogger("UIBackend:")
+
+
+# what GooglePlay needs from the screen: a view to query and a way to tap
+class UIBackend:
+    def snapshot(self, stop_on=()):
+        # returns an object with get_coordinates(attribute, value) and find_error(matcher)
+        raise NotImplementedError
+
+    def tap(self, x, y):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UIAutomatorBackend(UIBackend):
+    def __init__(self, adb, max_stream_failures=3):
+        self.adb = adb
+        self.device_serial = adb.device_serial
+        # consecutive streaming failures before falling back to file dumps for good
+        self.stream_failures = 0
+        self.max_stream_failures = max_stream_failures
+
+    def snapshot(self, stop_on=()):
+        # stop_on lists (attribute, value) pairs that end the read as soon as one shows up
+        if self.stream_failures < self.max_stream_failures:
+            stream = None
+            try:
+                stream = self.adb.adb_shell_stream("uiautomator", "dump", "/dev/tty")
+                hierarchy = UIHierarchy.from_stream(stream, stop_on)
+                self.stream_failures = 0
+                return hierarchy
+            except Exception as e:
+                self.stream_failures += 1
+                logger.warning(
+                    f"[{self.device_serial}] Streaming UI dump failed, using the file dump: {e}"
+                )
+            finally:
+                if stream:
+                    stream.close()
+        return self.snapshot_file()
+
+    def snapshot_file(self):
+        temp_file_path = abspath(
+            join(tempfile.gettempdir(), f"{self.device_serial}_ui.xml")
+        )
+        self.adb.adb_simple_shell("uiautomator", "dump", "/sdcard/ui.xml")
+        self.adb.adb_simple("pull", "/sdcard/ui.xml", temp_file_path)
+        if not os.path.exists(temp_file_path) or os.stat(temp_file_path).st_size == 0:
+            raise Exception("Failed to retrieve UI hierarchy")
+        return UIHierarchy.from_file(temp_file_path)
+
+    def tap(self, x, y):
+        self.adb.adb_simple_shell("input", "tap", str(x), str(y))
+
+
+class AgentView:
+    # answers the same questions as UIHierarchy, one targeted query at a time
+    def __init__(self, backend):
+        self.backend = backend
+        self.bounds = {}
+
+    def get_coordinates(self, attribute, value):
+        if (attribute, value) not in self.bounds:
+            self.bounds[(attribute, value)] = self.backend.find(attribute, value)
+        return self.bounds[(attribute, value)]
+
+    def find_error(self, error_matcher):
+        phrase = self.backend.search(sorted(error_matcher.error_types))
+        return error_matcher.error_types.get(phrase)
+
+
+# Talks to an on-device UI agent over an adb-forwarded abstract socket. The agent
+# reads one JSON request per line and answers with one JSON line:
+#   {"op": "ping"}
+#   {"op": "find", "attribute": ..., "value": ...} -> {"bounds": [x1, y1, x2, y2] | null}
+#   {"op": "search", "phrases": [...]} -> {"phrase": ... | null}
+#   {"op": "tap", "x": ..., "y": ...}
+# A response carrying "error" fails the request.
+class AgentBackend(UIBackend):
+    def __init__(
+        self,
+        adb,
+        socket_name=UI_AGENT_SOCKET,
+        start_command=UI_AGENT_START_COMMAND,
+        timeout_secs=10,
+        connect_attempts=5,
+    ):
+        self.adb = adb
+        self.device_serial = adb.device_serial
+        self.socket_name = socket_name
+        self.start_command = start_command
+        self.timeout_secs = timeout_secs
+        self.connect_attempts = connect_attempts
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        if self.start_command:
+            self.adb.adb_simple_shell(self.start_command)
+        port = self.adb.adb_utils.forward_port(f"localabstract:{self.socket_name}")
+        for attempt in range(self.connect_attempts):
+            try:
+                self.sock = socket.create_connection(
+                    ("127.0.0.1", port), timeout=self.timeout_secs
+                )
+                self.reader = self.sock.makefile("rb")
+                # adb accepts the forward even when nothing listens, so ask for a reply
+                self.request({"op": "ping"})
+                logger.info(f"[{self.device_serial}] Connected to the UI agent")
+                return self
+            except Exception as e:
+                self.close()
+                if attempt == self.connect_attempts - 1:
+                    raise Exception(f"Failed to reach the UI agent: {e}")
+                time.sleep(1)
+
+    def request(self, payload):
+        self.sock.sendall((json.dumps(payload) + "\n").encode())
+        line = self.reader.readline()
+        if not line:
+            raise Exception("UI agent closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise Exception(f"UI agent error: {response['error']}")
+        return response
+
+    def snapshot(self, stop_on=()):
+        return AgentView(self)
+
+    def find(self, attribute, value):
+        bounds = self.request({"op": "find", "attribute": attribute, "value": value})
+        return [str(c) for c in bounds["bounds"]] if bounds.get("bounds") else None
+
+    def search(self, phrases):
+        return self.request({"op": "search", "phrases": phrases}).get("phrase")
+
+    def tap(self, x, y):
+        self.request({"op": "tap", "x": x, "y": y})
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+# Plays back scripted screens so the store flow runs without a phone. Each screen is
+# a UIHierarchy or a list of node attribute dicts; the last one repeats once the
+# script runs out. Taps are recorded in order.
+class FakeBackend(UIBackend):
+    def __init__(self, screens):
+        self.screens = [
+            screen if isinstance(screen, UIHierarchy) else UIHierarchy(screen)
+            for screen in screens
+        ]
+        self.position = 0
+        self.taps = []
+
+    def snapshot(self, stop_on=()):
+        screen = self.screens[min(self.position, len(self.screens) - 1)]
+        self.position += 1
+        return screen
+
+    def tap(self, x, y):
+        self.taps.append((x, y))
+
+
+def create_ui_backend(adb, kind=UI_BACKEND):
+    if kind == "agent":
+        try:
+            return AgentBackend(adb).connect()
+        except Exception as e:
+            logger.error(
+                f"[{adb.device_serial}] {e}, falling back to uiautomator dumps"
+            )
+    return UIAutomatorBackend(adb)
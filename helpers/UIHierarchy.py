@@ -0,0 +1,90 @@
+import re
+from xml.etree import ElementTree
+
+INDEXED_ATTRIBUTES = ("text", "content-desc", "resource-id")
+
+
+class ErrorMatcher:
+    def __init__(self, error_messages):
+        # error_messages maps an error type to the UI phrases that signal it
+        self.error_types = {}
+        for error_type, phrases in error_messages.items():
+            for phrase in phrases:
+                self.error_types.setdefault(phrase, error_type)
+        # longest phrases first so a phrase never shadows a longer one it prefixes
+        self.pattern = re.compile(
+            "|".join(
+                re.escape(phrase)
+                for phrase in sorted(self.error_types, key=len, reverse=True)
+            )
+        )
+
+    def search(self, text):
+        match = self.pattern.search(text)
+        return self.error_types[match.group(0)] if match else None
+
+
+class UIHierarchy:
+    def __init__(self, nodes=()):
+        # (attribute, value) -> bounds of the first node carrying it
+        self.index = {}
+        self.texts = []
+        for attrib in nodes:
+            self.add_node(attrib)
+
+    @classmethod
+    def from_root(cls, root_node):
+        return cls(node.attrib for node in root_node.iter("node"))
+
+    @classmethod
+    def from_file(cls, path):
+        return cls.from_root(ElementTree.parse(path).getroot())
+
+    @classmethod
+    def from_string(cls, xml):
+        return cls.from_root(ElementTree.fromstring(xml))
+
+    @classmethod
+    def from_stream(cls, chunks, stop_on=()):
+        # chunks is an iterable of raw dump bytes; anything after </hierarchy>
+        # (uiautomator prints a status line there) is never fed to the parser
+        hierarchy = cls()
+        parser = ElementTree.XMLPullParser(events=("start", "end"))
+        started = False
+        for chunk in chunks:
+            if not started:
+                start = chunk.find(b"<?xml")
+                if start == -1:
+                    start = chunk.find(b"<hierarchy")
+                if start == -1:
+                    continue
+                chunk = chunk[start:]
+                started = True
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == "end" and element.tag == "hierarchy":
+                    return hierarchy
+                if event != "start" or element.tag != "node":
+                    continue
+                hierarchy.add_node(element.attrib)
+                # callers only look at the sought node in a dump cut short here
+                if any(target in hierarchy.index for target in stop_on):
+                    return hierarchy
+        raise Exception("UI hierarchy stream ended before the dump was complete")
+
+    def add_node(self, attrib):
+        for attribute in INDEXED_ATTRIBUTES:
+            value = attrib.get(attribute)
+            if value:
+                self.index.setdefault((attribute, value), attrib.get("bounds"))
+        self.texts.append(attrib.get("text", ""))
+        self.texts.append(attrib.get("content-desc", ""))
+
+    def get_coordinates(self, attribute, value):
+        bounds = self.index.get((attribute, value))
+        if bounds is None:
+            return None
+        return re.findall(r"\d+", bounds)
+
+    def find_error(self, error_matcher):
+        return error_matcher.search("\n".join(self.texts))
@@ -1,11 +1,39 @@
+import atexit
 import logging
 import multiprocessing
+import os
+import shutil
 import sys
-import time
-from copy import deepcopy
-from config.Config import ADB_BINARY, apk_source, pipeline_device_map
+import tempfile
+from functools import partial
+
+# must be set before prometheus_client is imported so every worker process
+# writes its samples where the exporter can merge them. Spawned workers import
+# this module again and inherit the variable, so only the parent makes the
+# directory, and removes it on exit.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    metrics_dir = tempfile.mkdtemp(prefix="gpsd-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    atexit.register(shutil.rmtree, metrics_dir, ignore_errors=True)
+
+from config.Config import (
+    ADB_BINARY,
+    APP_LEASE_SECONDS,
+    HOST_STAGE_QUEUE_SIZE,
+    HOST_STAGE_WORKERS,
+    METRICS_PORT,
+    apk_source,
+    pipeline_device_map,
+)
+from helpers.Metrics import start_exporter
+from main.AppDispatcher import AppDispatcher
 from main.DBDriver import DBDriver
+from main.DeviceWorker import run_device_worker
+from main.HostStagePool import HostStagePool
 from main.MainClass import MainClass
+from main.MetadataEngine import MetadataEngine
+from main.UploadService import UploadHub, UploadService
+from main.WorkerSupervisor import WorkerSupervisor
 
 logger = logging.getLogger("Main:")
 formatter = logging.Formatter("[%(asctime)s] [%(name)s] %(message)s")
@@ -18,130 +46,70 @@ for _, serials in pipeline_device_map.items():
     device_serials.extend(serials)
 
 
-def worker(device_serial, config, app_queue):
-    logger.info(
-        f"Worker [{device_serial}] started with app queue size: {app_queue.qsize()}"
-    )
+def worker(device_serial, config, dispatch_client, upload_clients):
+    logger.info(f"Worker [{device_serial}] started")
     db_driver = DBDriver()
-    all_devices = set(device_serials)
-    total_devices = len(all_devices)
-    main_class = None
-    try:
-        while True:
-            if app_queue.empty():
-                time.sleep(2)
-                continue
-            item = app_queue.get()
-            if item is None:
-                continue
-            app_id, error_message = item
-            if error_message:
-                error_devices = set(
-                    db_driver.get_error_devices_for_app(app_id, error_message)
-                )
-                available_devices = all_devices - error_devices
-                if not available_devices:
-                    logger.info(
-                        f"App [{app_id}] failed with error [{error_message}] on all devices. Skipping..."
-                    )
-                    continue
-                if device_serial in error_devices:
-                    app_queue.put((app_id, error_message))
-                    time.sleep(1)
-                    continue
-            if db_driver.check_app_is_downloaded(app_id):
-                logger.info(f"App [{app_id}] is already downloaded. Skipping...")
-                continue
-            if db_driver.is_app_incompatible_on_all_devices(app_id, total_devices):
-                logger.info(
-                    f"App [{app_id}] marked as incompatible on all devices. Skipping..."
-                )
-                continue
-            config_copy = deepcopy(config)
-            config_copy["pipeline"]["device_serial"] = device_serial
-            try:
-                main_class = MainClass(config_copy, app_id)
-                main_class.main_entrypoint()
-            except Exception as e:
-                error_message = str(e)
-                logger.error(
-                    f"Error processing app [{app_id}] on device [{device_serial}]: {error_message}"
-                )
-                existing_devices = db_driver.get_error_devices_for_app(
-                    app_id, error_message
-                )
-                if device_serial not in existing_devices:
-                    db_driver.write_error(app_id, device_serial, error_message)
-                error_devices = set(
-                    db_driver.get_error_devices_for_app(app_id, error_message)
-                )
-                available_devices = all_devices - error_devices
-                if available_devices:
-                    app_queue.put((app_id, error_message))
-                else:
-                    logger.info(
-                        f"App [{app_id}] failed with error [{error_message}] on all devices. Skipping..."
-                    )
-            time.sleep(1)
-    finally:
-        db_driver.close_connection()
-        logger.info(f"Database connection closed for worker [{device_serial}]")
-        if main_class:
-            main_class.google_play.close()
-            logger.info(f"Google Play Store closed in worker [{device_serial}]")
-        logger.info(f"Worker [{device_serial}] terminated")
+    main_class = MainClass(config, db_driver=db_driver)
+    host_stage_pool = HostStagePool(
+        device_serial,
+        dispatch_client,
+        HOST_STAGE_WORKERS,
+        HOST_STAGE_QUEUE_SIZE,
+        upload_service=upload_clients[device_serial],
+    )
+    run_device_worker(
+        device_serial,
+        dispatch_client,
+        db_driver,
+        main_class,
+        host_stage_pool,
+        len(set(device_serials)),
+    )
 
 
 def distribute_apps():
     logger.info("Starting the app download process...")
+    start_exporter(METRICS_PORT)
+    logger.info(f"Serving metrics on port {METRICS_PORT}")
     db_driver = DBDriver()
-    apps_to_run = db_driver.get_apps_to_run(len(set(device_serials)))
-
-    if not apps_to_run:
-        logger.info("No apps to run. Exiting...")
-        db_driver.close_connection()
-        sys.exit(0)
-
-    logger.info(f"Apps to run: [{len(apps_to_run)}]")
     base_config = dict(pipeline=dict(ADB_BINARY=ADB_BINARY, apk_source=apk_source))
-    manager = multiprocessing.Manager()
-    app_queue = manager.Queue()
-    for app_id in apps_to_run:
-        app_queue.put((app_id, None))
-    processes = []
-    for device_serial in device_serials:
-        config_copy = deepcopy(base_config)
-        config_copy["pipeline"]["device_serial"] = device_serial
-        p = multiprocessing.Process(
-            target=worker, args=(device_serial, config_copy, app_queue), daemon=True
-        )
-        p.start()
-        processes.append(p)
-        logger.info(f"Starting worker for device [{device_serial}]")
+    dispatcher = AppDispatcher(device_serials, APP_LEASE_SECONDS)
+    dispatcher.start()
+    # every device's uploads go through one service so they share its batches
+    upload_service = UploadService()
+    upload_hub = UploadHub(device_serials, upload_service)
+    upload_hub.start()
+    upload_clients = {
+        device_serial: upload_hub.client(device_serial)
+        for device_serial in dispatcher.device_serials
+    }
+    supervisor = WorkerSupervisor(
+        dispatcher, partial(worker, upload_clients=upload_clients), base_config
+    )
+    metadata_engine = MetadataEngine(upload_service)
+    metadata_engine.start()
     try:
-        while True:
-            apps_to_run = db_driver.get_apps_to_run(len(set(device_serials)))
-            is_all_apps_incompatible = db_driver.check_for_incompatible_apps(
-                len(set(device_serials))
-            )
-            if not apps_to_run:
-                logger.info("All apps are downloaded. Exiting...")
-                break
-            if is_all_apps_incompatible:
-                logger.info("All apps are incompatible. Exiting...")
-                break
-            time.sleep(600)
+        supervisor.run()
+        total_devices = len(set(device_serials))
+        if not db_driver.get_apps_to_run(total_devices):
+            logger.info("All apps are downloaded. Exiting...")
+        elif db_driver.check_for_incompatible_apps(total_devices):
+            logger.info("All apps are incompatible. Exiting...")
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt detected. Terminating workers...")
     finally:
-        for p in processes:
-            p.terminate()
-        for p in processes:
-            p.join()
+        supervisor.stop()
+        dispatcher.stop()
+        metadata_engine.stop()
+        upload_hub.stop()
+        upload_service.stop()
         db_driver.close_connection()
         logger.info("Terminating the app download process...")
         sys.exit(0)
 
 
 if __name__ == "__main__":
+    # a forked worker inherits whatever locks the dispatcher thread holds at that
+    # moment (SQLite's among them) and can hang on its first query
+    multiprocessing.set_start_method("spawn")
     distribute_apps()
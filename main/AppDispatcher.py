@@ -0,0 +1,234 @@
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from helpers.ErrorCatalog import ERROR_NAMES
+from helpers.Logger import EpochFormatter
+from main.DBDriver import DBDriver
+
+logger = logging.getLogger("AppDispatcher:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+class DispatchClient:
+    def __init__(self, device_serial, request_queue, device_queue):
+        self.device_serial = device_serial
+        self.request_queue = request_queue
+        self.device_queue = device_queue
+
+    def next_app(self):
+        self.request_queue.put(("ready", self.device_serial))
+        return self.device_queue.get()
+
+    def report_done(self, app_id):
+        self.request_queue.put(("done", self.device_serial, app_id))
+
+    def report_failed(self, app_id, decision):
+        # decision is the ErrorPolicy's FailureDecision for the failure
+        self.request_queue.put(("failed", self.device_serial, app_id, decision))
+
+
+class AppDispatcher:
+    def __init__(self, device_serials, lease_seconds, db_path=None):
+        self.device_serials = list(dict.fromkeys(device_serials))
+        self.lease_seconds = lease_seconds
+        self.db_path = db_path
+        self.request_queue = multiprocessing.Queue()
+        self.device_queues = {
+            device_serial: multiprocessing.Queue()
+            for device_serial in self.device_serials
+        }
+        self.in_flight = {}
+        self.waiting_devices = {}
+        self.lost_workers = {}
+        # devices whose worker died and has not asked for an app since
+        self.lost_devices = set()
+        # device -> epoch seconds until which it gets no apps
+        self.paused_until = {}
+        # device -> rowid its scan for pending apps resumes after
+        self.claim_cursors = {}
+        # earliest backoff or lease that ends while devices wait, to hand the
+        # app out then
+        self.next_claim_at = None
+        self.finished = threading.Event()
+        self.db_driver = None
+        self._thread = None
+
+    def client(self, device_serial):
+        return DispatchClient(
+            device_serial, self.request_queue, self.device_queues[device_serial]
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.request_queue.put(None)
+        if self._thread:
+            self._thread.join()
+
+    def wait_finished(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def report_worker_lost(self, device_serial, timeout=30):
+        handled = threading.Event()
+        self.lost_workers[device_serial] = handled
+        self.request_queue.put(("lost", device_serial))
+        return handled.wait(timeout)
+
+    def _run(self):
+        # sqlite connections are bound to the thread that created them
+        self.db_driver = DBDriver(self.db_path)
+        try:
+            # a crashed run of these devices would otherwise keep its apps until
+            # the leases expire
+            released = self.db_driver.release_device_leases(self.device_serials)
+            if released:
+                logger.info(f"Released {released} apps leased by a previous run")
+            while True:
+                wake_at = self._wake_at()
+                try:
+                    message = self.request_queue.get(
+                        timeout=(
+                            None if wake_at is None else max(wake_at - time.time(), 0)
+                        )
+                    )
+                except queue.Empty:
+                    message = ("wake", None)
+                if message is None:
+                    break
+                kind, device_serial, *payload = message
+                if kind == "ready":
+                    self.lost_devices.discard(device_serial)
+                    self._assign(device_serial)
+                elif kind == "done":
+                    self._handle_done(device_serial, *payload)
+                elif kind == "failed":
+                    self._handle_failed(device_serial, *payload)
+                elif kind == "lost":
+                    self._handle_lost(device_serial)
+                if wake_at is not None and time.time() >= wake_at:
+                    self._wake()
+                self._check_finished()
+        finally:
+            self.db_driver.close_connection()
+
+    def _assign(self, device_serial):
+        if self.paused_until.get(device_serial, 0) > time.time():
+            self.waiting_devices[device_serial] = True
+            return
+        app_id, self.claim_cursors[device_serial] = self.db_driver.claim_next_app(
+            device_serial, self.lease_seconds, self.claim_cursors.get(device_serial, 0)
+        )
+        if app_id is None:
+            self.waiting_devices[device_serial] = True
+            self.next_claim_at = self.db_driver.get_next_claim_at()
+            return
+        self.waiting_devices.pop(device_serial, None)
+        self.in_flight[app_id] = device_serial
+        self.device_queues[device_serial].put(app_id)
+
+    def _release(self, device_serial, app_id):
+        # a device that lost its lease reports an app another device holds now
+        if self.in_flight.get(app_id) == device_serial:
+            del self.in_flight[app_id]
+        self.db_driver.release_app(app_id, device_serial)
+
+    def _handle_done(self, device_serial, app_id):
+        self._release(device_serial, app_id)
+
+    def _handle_failed(self, device_serial, app_id, decision):
+        self._release(device_serial, app_id)
+        if decision.pause_secs:
+            self.paused_until[device_serial] = time.time() + decision.pause_secs
+            logger.info(
+                f"Pausing device [{device_serial}] for {decision.pause_secs}s: {ERROR_NAMES[decision.error_code]}"
+            )
+        if decision.abandoned:
+            return
+        if decision.retry_at is not None:
+            self.next_claim_at = min(
+                self.next_claim_at or decision.retry_at, decision.retry_at
+            )
+            return
+        self._rewind_claim_cursors(app_id)
+        # claim_next_app leaves out the devices the app can never run on
+        for waiting_device in list(self.waiting_devices):
+            self._assign(waiting_device)
+
+    def _rewind_claim_cursors(self, app_id):
+        # a handed back app is free right away, also for the devices whose
+        # scan has already passed it
+        rowid = self.db_driver.get_app_rowid(app_id)
+        if rowid is None:
+            return
+        for device_serial, after_rowid in self.claim_cursors.items():
+            self.claim_cursors[device_serial] = min(after_rowid, rowid - 1)
+
+    def _wake_at(self):
+        times = list(self.paused_until.values())
+        if self.next_claim_at is not None:
+            times.append(self.next_claim_at)
+        return min(times, default=None)
+
+    def _wake(self):
+        # a pause, a backoff or a lease ran out, hand apps to the devices left waiting
+        now = time.time()
+        for device_serial, until in list(self.paused_until.items()):
+            if until <= now:
+                del self.paused_until[device_serial]
+                logger.info(f"Device [{device_serial}] resumed")
+        self.next_claim_at = None
+        for waiting_device in list(self.waiting_devices):
+            self._assign(waiting_device)
+
+    def _handle_lost(self, device_serial):
+        device_queue = self.device_queues[device_serial]
+        while True:
+            try:
+                device_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.waiting_devices.pop(device_serial, None)
+        self.lost_devices.add(device_serial)
+        for app_id, assigned_device in list(self.in_flight.items()):
+            if assigned_device == device_serial:
+                self.in_flight.pop(app_id)
+                self.db_driver.release_app(app_id, device_serial)
+                self._rewind_claim_cursors(app_id)
+                logger.info(
+                    f"Released app [{app_id}] held by lost worker [{device_serial}]"
+                )
+        for waiting_device in list(self.waiting_devices):
+            self._assign(waiting_device)
+        handled = self.lost_workers.pop(device_serial, None)
+        if handled:
+            handled.set()
+
+    def _check_finished(self):
+        if self.finished.is_set() or self.in_flight:
+            return
+        # a dead or restarting worker has nothing in flight, it must not keep
+        # the run going
+        if len(self.waiting_devices) + len(self.lost_devices) < len(
+            self.device_serials
+        ):
+            return
+        # paused devices, apps in backoff or leased elsewhere may still find work.
+        # The lease a device saw when it came up empty may have been one of this
+        # run's own, released since, so look again rather than wait it out
+        if self.paused_until:
+            return
+        self.next_claim_at = self.db_driver.get_next_claim_at()
+        if self.next_claim_at is not None:
+            return
+        logger.info("No apps left to dispatch.")
+        self.finished.set()
+        for device_queue in self.device_queues.values():
+            device_queue.put(None)
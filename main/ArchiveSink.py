@@ -0,0 +1,106 @@
+import logging
+import os
+import shlex
+import subprocess
+import sys
+from os.path import join
+from config.Config import APK_REMOTE_STORE_PATH, SSH_HOST
+from helpers.Logger import EpochFormatter
+from main.UploadService import ssh_options
+
+logger = logging.getLogger("ArchiveSink:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+# A sink receives split APKs straight from the device. open() returns a writer
+# with write(chunk), commit() and abort(); a committed file lands under
+# <root>/<app_id>/<file_name>, the same layout the rsync upload produces.
+class ArchiveSink:
+    def open(self, app_id, file_name):
+        raise NotImplementedError
+
+
+class LocalFileWriter:
+    def __init__(self, path):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.file = open(self.part_path, "wb")
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+class LocalDirectorySink(ArchiveSink):
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, app_id, file_name):
+        os.makedirs(join(self.root, app_id), exist_ok=True)
+        return LocalFileWriter(join(self.root, app_id, file_name))
+
+
+class SSHFileWriter:
+    def __init__(self, host, path):
+        self.path = path
+        part_path = shlex.quote(f"{path}.part")
+        # the file only takes its final name once every byte has arrived
+        remote_command = (
+            f"mkdir -p {shlex.quote(os.path.dirname(path))} "
+            f"&& cat > {part_path} && mv {part_path} {shlex.quote(path)}"
+        )
+        self.host = host
+        self.process = subprocess.Popen(
+            ["ssh", *ssh_options(), host, remote_command],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    def write(self, chunk):
+        self.process.stdin.write(chunk)
+
+    def commit(self):
+        self.process.stdin.close()
+        stderr = self.process.stderr.read().decode()
+        if self.process.wait() != 0:
+            raise Exception(
+                f"Streaming [{self.path}] to [{self.host}] failed: {stderr}"
+            )
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+        subprocess.run(
+            ["ssh", *ssh_options(), self.host, f"rm -f {shlex.quote(self.path)}.part"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+class SSHSink(ArchiveSink):
+    # one ssh session per split, all multiplexed over the shared master connection
+    def __init__(self, host, root):
+        self.host = host
+        self.root = root
+
+    def open(self, app_id, file_name):
+        return SSHFileWriter(self.host, join(self.root, app_id, file_name))
+
+
+def create_archive_sink():
+    # without an SSH host the store path is treated as a local directory
+    if SSH_HOST:
+        return SSHSink(SSH_HOST, APK_REMOTE_STORE_PATH)
+    return LocalDirectorySink(APK_REMOTE_STORE_PATH)
@@ -1,25 +1,115 @@
+import random
 import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
 from os.path import abspath, join, dirname, realpath
-from config.Config import SQLITE_DB_NAME
+from config.Config import SQLITE_BUSY_TIMEOUT_SECS, SQLITE_DB_NAME
+from helpers.ErrorCatalog import (
+    APP_INCOMPATIBLE,
+    DEVICE_PERMANENT,
+    ERROR_NAMES,
+    ERROR_POLICIES,
+    classify_error,
+)
+
+# WAL lets readers run next to the single writer; NORMAL only syncs at checkpoints,
+# which is safe with WAL. cache_size is in KiB when negative.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -16384;",
+    "PRAGMA temp_store = MEMORY;",
+)
+
+# a device never gets an app back after one of these; other errors are retried
+DEVICE_PERMANENT_CODES = ", ".join(
+    str(code) for code, policy in ERROR_POLICIES.items() if policy == DEVICE_PERMANENT
+)
+
+
+def is_busy_error(e):
+    return isinstance(e, sqlite3.OperationalError) and (
+        "locked" in str(e) or "busy" in str(e)
+    )
+
+
+def write(method):
+    # runs the method in a write transaction, or inside the caller's one
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class DBDriver:
-    def __init__(self):
-        main_db_path = abspath(
+    def __init__(
+        self,
+        db_path=None,
+        busy_timeout_secs=SQLITE_BUSY_TIMEOUT_SECS,
+        busy_retries=5,
+    ):
+        main_db_path = db_path or abspath(
             join(dirname(dirname(realpath(__file__))), "databases", SQLITE_DB_NAME)
         )
-        self.connection = sqlite3.connect(main_db_path)
+        # transactions are opened explicitly by transaction(); the timeout is
+        # SQLite's own busy handler, so a locked database is waited on first
+        self.connection = sqlite3.connect(
+            main_db_path, timeout=busy_timeout_secs, isolation_level=None
+        )
+        self.busy_retries = busy_retries
+        self.transaction_depth = 0
+        # WAL is a property of the database file, so only the first connection
+        # converts it; the switch needs every other connection to be idle and
+        # fails right away instead of waiting on the busy handler
+        if self.connection.execute("PRAGMA journal_mode;").fetchone()[0] != "wal":
+            self._retry_busy("PRAGMA journal_mode = WAL;")
+        for pragma in CONNECTION_PRAGMAS:
+            self.connection.execute(pragma)
+
+    @contextmanager
+    def transaction(self):
+        # Groups every write made inside it into one commit, e.g. all status
+        # transitions of an app. BEGIN IMMEDIATE takes the write lock up front, so
+        # a busy database can only turn us away here, where retrying is safe.
+        if self.transaction_depth:
+            self.transaction_depth += 1
+            try:
+                yield
+            finally:
+                self.transaction_depth -= 1
+            return
+        self._retry_busy("BEGIN IMMEDIATE;")
+        self.transaction_depth = 1
+        try:
+            yield
+        except BaseException:
+            self.connection.rollback()
+            raise
+        else:
+            self.connection.commit()
+        finally:
+            self.transaction_depth = 0
+
+    def _retry_busy(self, statement):
+        for attempt in range(self.busy_retries + 1):
+            try:
+                self.connection.execute(statement)
+                return
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == self.busy_retries:
+                    raise
+                # the busy timeout already ran out once, back off before the next wait
+                time.sleep(min(0.1 * 2**attempt, 5) * (1 + random.random()))
 
     def get_apps_to_run(self, total_devices):
         cursor = self.connection.cursor()
         cursor.execute(
             """
-            SELECT DISTINCT i.app_id
-            FROM input_apps i
-            LEFT JOIN error_apps e ON i.app_id = e.app_id
-            WHERE i.downloaded = 0
-            GROUP BY e.error, i.app_id
-            HAVING COUNT(DISTINCT e.device) < ? OR COUNT(e.device) = 0;
+            SELECT app_id
+            FROM input_apps
+            WHERE downloaded = 0 AND abandoned = 0 AND incompatible_devices < ?;
             """,
             (total_devices,),
         )
@@ -45,28 +135,75 @@ class DBDriver:
         cursor = self.connection.cursor()
         cursor.execute(
             """
-            SELECT COUNT(DISTINCT device)
-            FROM error_apps
-            WHERE app_id = ? AND error = 'App is incompatible';
+            SELECT incompatible_devices
+            FROM input_apps
+            WHERE app_id = ?;
             """,
             (app_id,),
         )
-        count = cursor.fetchone()[0]
+        row = cursor.fetchone()
         cursor.close()
-        return count >= total_devices
+        return bool(row) and row[0] >= total_devices
 
+    @write
     def write_error(self, app_id, device_serial, error):
+        # error is the raw exception text; error_apps only keeps its code
+        error_code = classify_error(error)
         cursor = self.connection.cursor()
         cursor.execute(
             """
-            INSERT INTO error_apps (app_id, device, error)
+            SELECT
+                NOT EXISTS (
+                    SELECT 1 FROM error_apps WHERE app_id = ? AND device = ?
+                ),
+                ? = ? AND NOT EXISTS (
+                    SELECT 1
+                    FROM error_apps
+                    WHERE app_id = ? AND device = ? AND error_code = ?
+                );
+            """,
+            (
+                app_id,
+                device_serial,
+                error_code,
+                APP_INCOMPATIBLE,
+                app_id,
+                device_serial,
+                error_code,
+            ),
+        )
+        new_failed_device, new_incompatible_device = cursor.fetchone()
+        cursor.execute(
+            "INSERT OR IGNORE INTO error_codes (code, name) VALUES (?, ?);",
+            (error_code, ERROR_NAMES[error_code]),
+        )
+        cursor.execute(
+            """
+            INSERT OR IGNORE INTO error_apps (app_id, device, error_code)
             VALUES (?, ?, ?);
             """,
-            (app_id, device_serial, error),
+            (app_id, device_serial, error_code),
+        )
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO error_messages
+            (app_id, device, error_code, message, recorded_at)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            (app_id, device_serial, error_code, error, time.time()),
+        )
+        cursor.execute(
+            """
+            UPDATE input_apps
+            SET failed_devices = failed_devices + ?,
+                incompatible_devices = incompatible_devices + ?
+            WHERE app_id = ?;
+            """,
+            (new_failed_device, new_incompatible_device, app_id),
         )
-        self.connection.commit()
         cursor.close()
 
+    @write
     def mark_app_downloaded(self, app_id, is_metadata_downloaded=False):
         cursor = self.connection.cursor()
 
@@ -74,7 +211,8 @@ class DBDriver:
             cursor.execute(
                 """
                 UPDATE input_apps
-                SET downloaded = 1, metadata = 1
+                SET downloaded = 1, metadata = 1, lease_expires_at = NULL,
+                    failed_devices = 0, incompatible_devices = 0, retry_at = NULL
                 WHERE app_id = ?;
                 """,
                 (app_id,),
@@ -83,7 +221,8 @@ class DBDriver:
             cursor.execute(
                 """
                 UPDATE input_apps
-                SET downloaded = 1
+                SET downloaded = 1, lease_expires_at = NULL,
+                    failed_devices = 0, incompatible_devices = 0, retry_at = NULL
                 WHERE app_id = ?;
                 """,
                 (app_id,),
@@ -96,10 +235,11 @@ class DBDriver:
             """,
             (app_id,),
         )
+        cursor.execute("DELETE FROM error_messages WHERE app_id = ?;", (app_id,))
 
-        self.connection.commit()
         cursor.close()
 
+    @write
     def set_app_downloading(self, app_id, device_serial):
         cursor = self.connection.cursor()
         cursor.execute(
@@ -110,40 +250,403 @@ class DBDriver:
             """,
             (device_serial, app_id),
         )
-        self.connection.commit()
         cursor.close()
 
-    def get_error_devices_for_app(self, app_id, error):
+    @write
+    def claim_next_app(self, device_serial, lease_seconds, after_rowid=0):
+        # Returns (app_id, cursor); the caller passes the cursor back on the
+        # device's next claim. Apps the device can never run stay pending for the
+        # others, and a scan from the front of the table would step over every one
+        # of them on every claim, so pending apps are scanned from the cursor on
+        # and only once per pass. Apps whose backoff or lease ran out may sit
+        # behind the cursor; they are looked up through their own indexes first.
+        now = time.time()
+        cursor = self.connection.cursor()
+        claimable = f"""
+            i.downloaded = 0 AND i.abandoned = 0
+            AND (i.lease_expires_at IS NULL OR i.lease_expires_at < :now)
+            AND (i.retry_at IS NULL OR i.retry_at <= :now)
+            AND NOT EXISTS (
+                SELECT 1
+                FROM error_apps e
+                WHERE e.app_id = i.app_id AND e.device = :device
+                AND e.error_code IN ({DEVICE_PERMANENT_CODES})
+            )
+        """
+        due_queries = (
+            f"""
+            SELECT i.rowid FROM input_apps i INDEXED BY idx_input_apps_retry
+            WHERE i.retry_at <= :now AND {claimable}
+            LIMIT 1;
+            """,
+            f"""
+            SELECT i.rowid FROM input_apps i INDEXED BY idx_input_apps_lease
+            WHERE i.downloaded = 0 AND i.lease_expires_at < :now AND {claimable}
+            LIMIT 1;
+            """,
+        )
+        # NOT INDEXED keeps the planner on the rowid range; through the downloaded
+        # index it would sort every pending app to find the first one
+        pending_query = f"""
+            SELECT i.rowid FROM input_apps i NOT INDEXED
+            WHERE i.rowid > :after AND {claimable}
+            ORDER BY i.rowid
+            LIMIT 1;
+        """
+        params = dict(now=now, device=device_serial)
+        rowid = None
+        for query in due_queries:
+            row = cursor.execute(query, params).fetchone()
+            if row:
+                rowid = row[0]
+                break
+        if rowid is None:
+            row = cursor.execute(
+                pending_query, dict(params, after=after_rowid)
+            ).fetchone()
+            if row is None and after_rowid:
+                # past the end of the table the device starts its next pass
+                row = cursor.execute(pending_query, dict(params, after=0)).fetchone()
+            rowid = after_rowid = row[0] if row else 0
+        app_id = None
+        if rowid:
+            # the claim clears the backoff, so only apps in backoff carry a retry_at
+            cursor.execute(
+                """
+                UPDATE input_apps
+                SET device = ?, lease_expires_at = ?, retry_at = NULL
+                WHERE rowid = ?
+                RETURNING app_id;
+                """,
+                (device_serial, now + lease_seconds, rowid),
+            )
+            app_id = cursor.fetchone()[0]
+        cursor.close()
+        return app_id, after_rowid
+
+    def get_app_rowid(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT rowid FROM input_apps WHERE app_id = ?;", (app_id,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+
+    @write
+    def renew_lease(self, app_id, device_serial, lease_seconds):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            UPDATE input_apps
+            SET lease_expires_at = ?
+            WHERE app_id = ? AND device = ? AND downloaded = 0;
+            """,
+            (time.time() + lease_seconds, app_id, device_serial),
+        )
+        renewed = cursor.rowcount == 1
+        cursor.close()
+        return renewed
+
+    @write
+    def release_device_leases(self, device_serials):
+        # leases a crashed run left behind; no worker of these devices holds an app yet
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            """
+            UPDATE input_apps
+            SET lease_expires_at = NULL
+            WHERE device = ? AND downloaded = 0 AND lease_expires_at IS NOT NULL;
+            """,
+            [(device_serial,) for device_serial in device_serials],
+        )
+        released = cursor.rowcount
+        cursor.close()
+        return released
+
+    @write
+    def release_app(self, app_id, device_serial):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            UPDATE input_apps
+            SET lease_expires_at = NULL
+            WHERE app_id = ? AND device = ?;
+            """,
+            (app_id, device_serial),
+        )
+        cursor.close()
+
+    @write
+    def increment_app_retries(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            UPDATE input_apps
+            SET retries = retries + 1
+            WHERE app_id = ?
+            RETURNING retries;
+            """,
+            (app_id,),
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else 0
+
+    @write
+    def schedule_app_retry(self, app_id, retry_at):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "UPDATE input_apps SET retry_at = ? WHERE app_id = ?;",
+            (retry_at, app_id),
+        )
+        cursor.close()
+
+    @write
+    def abandon_app(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            UPDATE input_apps
+            SET abandoned = 1, retry_at = NULL
+            WHERE app_id = ?;
+            """,
+            (app_id,),
+        )
+        cursor.close()
+
+    def get_next_claim_at(self):
+        # earliest time a pending app may become claimable again: a backoff or a
+        # lease running out. Only apps in backoff carry a retry_at, the planner
+        # would otherwise walk every pending app by downloaded
+        now = time.time()
         cursor = self.connection.cursor()
         cursor.execute(
-            "SELECT device FROM error_apps WHERE app_id = ? AND error = ?;",
-            (app_id, error),
+            """
+            SELECT MIN(retry_at)
+            FROM input_apps INDEXED BY idx_input_apps_retry
+            WHERE retry_at > ? AND downloaded = 0 AND abandoned = 0;
+            """,
+            (now,),
+        )
+        retry_at = cursor.fetchone()[0]
+        cursor.execute(
+            """
+            SELECT MIN(lease_expires_at)
+            FROM input_apps INDEXED BY idx_input_apps_lease
+            WHERE downloaded = 0 AND lease_expires_at > ? AND abandoned = 0;
+            """,
+            (now,),
+        )
+        lease_expires_at = cursor.fetchone()[0]
+        cursor.close()
+        return min(
+            (t for t in (retry_at, lease_expires_at) if t is not None), default=None
+        )
+
+    @write
+    def mark_stage_complete(self, app_id, stage, device_serial):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO app_stages (app_id, stage, device, completed_at)
+            VALUES (?, ?, ?, ?);
+            """,
+            (app_id, stage, device_serial, time.time()),
+        )
+        cursor.close()
+
+    def get_completed_stages(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT stage FROM app_stages WHERE app_id = ?;",
+            (app_id,),
+        )
+        stages = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        return stages
+
+    @write
+    def record_apk_manifest(self, app_id, manifest):
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            """
+            INSERT INTO apk_manifest (app_id, split_name, size, sha256)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (app_id, split_name) DO UPDATE
+            SET size = excluded.size, sha256 = excluded.sha256, uploaded = 0
+            WHERE size != excluded.size OR sha256 != excluded.sha256;
+            """,
+            [
+                (app_id, split_name, size, sha256)
+                for split_name, size, sha256 in manifest
+            ],
+        )
+        cursor.close()
+
+    def get_apk_manifest(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            SELECT split_name, size, sha256, uploaded
+            FROM apk_manifest
+            WHERE app_id = ?;
+            """,
+            (app_id,),
+        )
+        manifest = {
+            split_name: (size, sha256, bool(uploaded))
+            for split_name, size, sha256, uploaded in cursor.fetchall()
+        }
+        cursor.close()
+        return manifest
+
+    @write
+    def mark_apk_manifest_uploaded(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "UPDATE apk_manifest SET uploaded = 1 WHERE app_id = ?;",
+            (app_id,),
+        )
+        cursor.close()
+
+    def get_apps_missing_metadata(self, limit, retry_after_secs=86400):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            SELECT app_id
+            FROM input_apps
+            WHERE downloaded = 1 AND metadata = 0
+            AND (metadata_attempted_at IS NULL OR metadata_attempted_at < ?)
+            AND NOT EXISTS (
+                SELECT 1 FROM metadata_index
+                WHERE metadata_index.app_id = input_apps.app_id
+            )
+            LIMIT ?;
+            """,
+            (time.time() - retry_after_secs, limit),
+        )
+        app_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return app_ids
+
+    @write
+    def mark_metadata_downloaded(self, app_ids, failed_app_ids=()):
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            "UPDATE input_apps SET metadata = 1 WHERE app_id = ?;",
+            [(app_id,) for app_id in app_ids],
+        )
+        cursor.executemany(
+            "UPDATE input_apps SET metadata_attempted_at = ? WHERE app_id = ?;",
+            [(time.time(), app_id) for app_id in failed_app_ids],
+        )
+        cursor.close()
+
+    @write
+    def record_metadata_index(self, entries):
+        # entries are (app_id, shard, offset, length) tuples from the shard writer
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO metadata_index (app_id, shard, offset, length)
+            VALUES (?, ?, ?, ?);
+            """,
+            entries,
+        )
+        cursor.close()
+
+    @write
+    def mark_metadata_shard_uploaded(self, shard):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            UPDATE input_apps SET metadata = 1
+            WHERE app_id IN (SELECT app_id FROM metadata_index WHERE shard = ?);
+            """,
+            (shard,),
+        )
+        cursor.close()
+
+    @write
+    def reserve_staging(self, app_id, device_serial, nbytes, quota_bytes, waited_secs):
+        # all or nothing: the app gets its space only if the quota still holds;
+        # an empty staging area always admits one app so a huge one cannot stall
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """
+            INSERT INTO staging (app_id, device, bytes, reserved_at, waited_secs)
+            SELECT ?, ?, ?, ?, ?
+            WHERE (
+                SELECT COALESCE(SUM(bytes), 0) FROM staging WHERE app_id != ?
+            ) + ? <= ?
+            OR NOT EXISTS (SELECT 1 FROM staging WHERE app_id != ?)
+            ON CONFLICT (app_id) DO UPDATE
+            SET device = excluded.device, bytes = excluded.bytes,
+                reserved_at = excluded.reserved_at, waited_secs = excluded.waited_secs;
+            """,
+            (
+                app_id,
+                device_serial,
+                nbytes,
+                time.time(),
+                waited_secs,
+                app_id,
+                nbytes,
+                quota_bytes,
+                app_id,
+            ),
+        )
+        reserved = cursor.rowcount == 1
+        cursor.close()
+        return reserved
+
+    @write
+    def release_staging(self, app_id):
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM staging WHERE app_id = ?;", (app_id,))
+        cursor.close()
+
+    def get_staging_usage(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM staging;")
+        apps, staged_bytes = cursor.fetchone()
+        cursor.close()
+        return apps, staged_bytes
+
+    def record_stage_durations(self, app_id, device_serial, durations):
+        # durations maps stage -> seconds; the latest run of a stage wins
+        self.record_stage_durations_bulk(
+            [
+                (app_id, stage, device_serial, seconds)
+                for stage, seconds in durations.items()
+            ]
+        )
+
+    @write
+    def record_stage_durations_bulk(self, rows):
+        # rows are (app_id, stage, device, seconds) tuples
+        cursor = self.connection.cursor()
+        recorded_at = time.time()
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO app_stage_durations
+            (app_id, stage, device, seconds, recorded_at)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            [row + (recorded_at,) for row in rows],
         )
-        devices = [row[0] for row in cursor.fetchall()]
         cursor.close()
-        return devices
 
     def check_for_incompatible_apps(self, total_devices):
         cursor = self.connection.cursor()
         cursor.execute(
             """
-            SELECT 
-            NOT EXISTS (
-                SELECT DISTINCT i.app_id
-                FROM input_apps i
-                LEFT JOIN error_apps e ON i.app_id = e.app_id
-                WHERE i.downloaded = 0
-                GROUP BY e.error, i.app_id
-                HAVING COUNT(DISTINCT e.device) < ? OR COUNT(e.device) = 0
-                EXCEPT
-                SELECT DISTINCT ea.app_id
-                FROM error_apps ea
-                WHERE ea.app_id IN (
-                    SELECT app_id FROM input_apps WHERE downloaded = 0
-                )
-                AND ea.error = 'App is incompatible'
-                GROUP BY ea.error, ea.app_id
-                HAVING COUNT(DISTINCT ea.device) = ?
+            SELECT NOT EXISTS (
+                SELECT 1
+                FROM input_apps
+                WHERE downloaded = 0
+                AND abandoned = 0
+                AND failed_devices < ?
+                AND incompatible_devices < ?
             ) AS is_subset;
             """,
             (total_devices, total_devices),
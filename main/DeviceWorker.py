@@ -0,0 +1,60 @@
+import logging
+import sys
+from helpers.Logger import EpochFormatter
+from main.ErrorPolicy import ErrorPolicy
+
+logger = logging.getLogger("DeviceWorker:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+def run_device_worker(
+    device_serial,
+    dispatch_client,
+    db_driver,
+    main_class,
+    host_stage_pool,
+    total_devices,
+    error_policy=None,
+):
+    # pulls apps from the dispatcher until it runs dry; the caller builds the
+    # device and host side so a simulated device can run the same loop
+    error_policy = error_policy or ErrorPolicy()
+    try:
+        while True:
+            app_id = dispatch_client.next_app()
+            if app_id is None:
+                break
+            if db_driver.check_app_is_downloaded(app_id):
+                logger.info(f"App [{app_id}] is already downloaded. Skipping...")
+                dispatch_client.report_done(app_id)
+                continue
+            if db_driver.is_app_incompatible_on_all_devices(app_id, total_devices):
+                logger.info(
+                    f"App [{app_id}] marked as incompatible on all devices. Skipping..."
+                )
+                dispatch_client.report_done(app_id)
+                continue
+            try:
+                main_class.main_entrypoint(app_id)
+            except Exception as e:
+                error_message = str(e)
+                logger.error(
+                    f"Error processing app [{app_id}] on device [{device_serial}]: {error_message}"
+                )
+                decision = error_policy.record_failure(
+                    db_driver, app_id, device_serial, error_message
+                )
+                dispatch_client.report_failed(app_id, decision)
+                continue
+            host_stage_pool.submit(app_id)
+    finally:
+        host_stage_pool.join()
+        logger.info(f"Host stages drained in worker [{device_serial}]")
+        main_class.close()
+        logger.info(f"Google Play Store closed in worker [{device_serial}]")
+        db_driver.close_connection()
+        logger.info(f"Database connection closed for worker [{device_serial}]")
+        logger.info(f"Worker [{device_serial}] terminated")
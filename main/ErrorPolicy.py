@@ -0,0 +1,113 @@
+import logging
+import shutil
+import sys
+import time
+from collections import namedtuple
+from os.path import abspath, join
+from config.Config import (
+    APP_RETRY_BACKOFF_MAX_SECS,
+    APP_RETRY_BACKOFF_SECS,
+    APP_RETRY_BUDGET,
+    DEVICE_PAUSE_SECS,
+    apk_source,
+)
+from helpers.ErrorCatalog import (
+    APP_PERMANENT,
+    DEVICE_FAULT,
+    DEVICE_PAUSE,
+    DEVICE_PERMANENT,
+    ERROR_NAMES,
+    HANDED_OVER,
+    classify_error,
+    error_policy,
+)
+from helpers.Logger import EpochFormatter
+
+logger = logging.getLogger("ErrorPolicy:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+# what happens to a failed app, sent to the dispatcher with the failure:
+# abandoned apps are never handed out again, retry_at is when any device may
+# take it again (None: right away), pause_secs how long the failing device rests
+FailureDecision = namedtuple(
+    "FailureDecision", ["error_code", "abandoned", "retry_at", "pause_secs"]
+)
+
+
+class ErrorPolicy:
+    def __init__(
+        self,
+        retry_budget=APP_RETRY_BUDGET,
+        backoff_secs=APP_RETRY_BACKOFF_SECS,
+        backoff_max_secs=APP_RETRY_BACKOFF_MAX_SECS,
+        device_pause_secs=DEVICE_PAUSE_SECS,
+        staging_path=apk_source,
+    ):
+        self.retry_budget = retry_budget
+        self.backoff_secs = backoff_secs
+        self.backoff_max_secs = backoff_max_secs
+        self.device_pause_secs = device_pause_secs
+        self.staging_path = staging_path
+
+    def backoff(self, retries):
+        return min(self.backoff_secs * 2 ** (retries - 1), self.backoff_max_secs)
+
+    def abandon(self, db_driver, app_id):
+        # nothing will upload an abandoned app's pulled files, so they and their
+        # staging reservation go now or the quota shrinks for good
+        with db_driver.transaction():
+            db_driver.abandon_app(app_id)
+            db_driver.release_staging(app_id)
+        shutil.rmtree(abspath(join(self.staging_path, app_id)), ignore_errors=True)
+
+    def record_failure(self, db_driver, app_id, device_serial, error_message):
+        error_code = classify_error(error_message)
+        policy = error_policy(error_code)
+        if policy == HANDED_OVER:
+            # the failure belongs to the device that holds the app now, not to
+            # the app: no error row, no retry spent, no backoff
+            logger.info(
+                f"App [{app_id}] is held by another device now, [{device_serial}] lets go of it"
+            )
+            return FailureDecision(error_code, False, None, 0)
+        if policy == DEVICE_FAULT:
+            # no error row either: it would count the device against the app
+            # in failed_devices
+            logger.info(
+                f"Device [{device_serial}] is unreachable, app [{app_id}] goes back untouched: {ERROR_NAMES[error_code]}"
+            )
+            return FailureDecision(error_code, False, None, self.device_pause_secs)
+        # the error row and the app's retry state land in one commit
+        with db_driver.transaction():
+            db_driver.write_error(app_id, device_serial, error_message)
+            if policy == APP_PERMANENT:
+                self.abandon(db_driver, app_id)
+                logger.info(
+                    f"App [{app_id}] gave up: {ERROR_NAMES[error_code]} on [{device_serial}]"
+                )
+                return FailureDecision(error_code, True, None, 0)
+            if policy == DEVICE_PERMANENT:
+                return FailureDecision(error_code, False, None, 0)
+            # a throttled app still spends its budget, so one that always trips
+            # the limit cannot pause device after device forever
+            retries = db_driver.increment_app_retries(app_id)
+            if retries > self.retry_budget:
+                self.abandon(db_driver, app_id)
+                logger.info(
+                    f"App [{app_id}] gave up after {retries} failures, the last one: {ERROR_NAMES[error_code]}"
+                )
+                return FailureDecision(error_code, True, None, 0)
+            if policy == DEVICE_PAUSE:
+                # the device is at fault, the others may take the app right away
+                return FailureDecision(error_code, False, None, self.device_pause_secs)
+            backoff_secs = self.backoff(retries)
+            retry_at = time.time() + backoff_secs
+            db_driver.schedule_app_retry(app_id, retry_at)
+        logger.info(
+            f"App [{app_id}] will be retried in {backoff_secs:.0f}s "
+            f"[{retries}/{self.retry_budget} retries]: {ERROR_NAMES[error_code]}"
+        )
+        return FailureDecision(error_code, False, retry_at, 0)
@@ -0,0 +1,108 @@
+import logging
+import queue
+import sys
+import threading
+from config.Config import APP_LEASE_SECONDS
+from helpers.Logger import EpochFormatter
+from helpers.Metrics import StageTimer
+from main.DBDriver import DBDriver
+from main.ErrorPolicy import ErrorPolicy
+from main.RSyncer import RSyncer
+from main.UploadService import UploadService
+
+logger = logging.getLogger("HostStagePool:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+class HostStagePool:
+    def __init__(
+        self,
+        device_serial,
+        dispatch_client,
+        workers,
+        queue_size,
+        upload_service=None,
+        db_path=None,
+        error_policy=None,
+    ):
+        self.device_serial = device_serial
+        self.dispatch_client = dispatch_client
+        self.db_path = db_path
+        self.error_policy = error_policy or ErrorPolicy()
+        self.app_queue = queue.Queue(maxsize=queue_size)
+        self.owns_upload_service = upload_service is None
+        self.upload_service = upload_service or UploadService()
+        self.threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, app_id):
+        # blocks while the pool is full so the device cannot run too far ahead
+        self.app_queue.put(app_id)
+
+    def join(self):
+        for _ in self.threads:
+            self.app_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.owns_upload_service:
+            self.upload_service.stop()
+
+    def _run(self):
+        db_driver = DBDriver(self.db_path)
+        try:
+            while True:
+                app_id = self.app_queue.get()
+                if app_id is None:
+                    break
+                try:
+                    self.run_host_stages(app_id, db_driver)
+                    self.dispatch_client.report_done(app_id)
+                except Exception as e:
+                    error_message = str(e)
+                    logger.error(
+                        f"Error in host stages of app [{app_id}] from device [{self.device_serial}]: {error_message}"
+                    )
+                    decision = self.error_policy.record_failure(
+                        db_driver, app_id, self.device_serial, error_message
+                    )
+                    self.dispatch_client.report_failed(app_id, decision)
+        finally:
+            db_driver.close_connection()
+
+    def renew_lease(self, app_id, db_driver):
+        if not db_driver.renew_lease(app_id, self.device_serial, APP_LEASE_SECONDS):
+            raise Exception(f"Lost the lease for app: [{app_id}]")
+
+    def run_host_stages(self, app_id, db_driver):
+        self.renew_lease(app_id, db_driver)
+        completed_stages = db_driver.get_completed_stages(app_id)
+        upload = None
+        stage_timer = StageTimer(self.device_serial)
+        if "upload" not in completed_stages:
+            upload = RSyncer(app_id, self.upload_service).submit_apk_files(
+                db_driver.get_apk_manifest(app_id)
+            )
+        if upload:
+            with stage_timer.span("upload"):
+                upload.result()
+        # the app's closing transitions land in one commit, and only while this
+        # device still holds the app: the upload may have outlasted the lease
+        with db_driver.transaction():
+            self.renew_lease(app_id, db_driver)
+            if upload:
+                db_driver.record_stage_durations(
+                    app_id, self.device_serial, stage_timer.reset()
+                )
+                db_driver.mark_apk_manifest_uploaded(app_id)
+                db_driver.mark_stage_complete(app_id, "upload", self.device_serial)
+            # the local copies are gone once the upload is confirmed
+            db_driver.release_staging(app_id)
+            # metadata is fetched separately by the MetadataEngine
+            db_driver.mark_app_downloaded(app_id)
+        logger.info(f"[{self.device_serial}] Finished host stages of app: [{app_id}]")
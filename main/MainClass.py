@@ -1,12 +1,16 @@
 import logging
+import shutil
 import sys
 import time
+from os.path import abspath, exists, join
+from config.Config import APK_STREAM_TO_ARCHIVE, APP_LEASE_SECONDS
 from helpers.ADBCommands import ADBCommands
 from helpers.GooglePlay import GooglePlay
 from helpers.Logger import EpochFormatter
-from helpers.MetadataDownloader import MetadataDownloader
+from helpers.Metrics import StageTimer
+from main.ArchiveSink import create_archive_sink
 from main.DBDriver import DBDriver
-from main.RSyncer import RSyncer
+from main.StagingManager import StagingManager
 
 logger = logging.getLogger("GooglePlayDownloader:")
 formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
@@ -16,43 +20,129 @@ logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
 
 
 class MainClass:
-    def __init__(self, config, app_id):
-        self.app_id = app_id
+    def __init__(self, config, db_driver=None, adb=None):
+        self.app_id = None
         self.device_serial = config["pipeline"]["device_serial"]
         self.config = config
-        self.adb = ADBCommands(config=self.config)
-        self.google_play = GooglePlay(self.config)
-        self.db_driver = DBDriver()
-        self.rsyncer = RSyncer(self.app_id)
-        self.metadata_downloader = MetadataDownloader(self.app_id)
-
-    def main_entrypoint(self):
-        self.db_driver.set_app_downloading(self.app_id, self.device_serial)
-        self.turn_on_the_device_screen()
+        self.adb = adb or ADBCommands(config=self.config)
+        self.stage_timer = StageTimer(self.device_serial)
+        self.google_play = GooglePlay(
+            self.config, adb=self.adb, stage_timer=self.stage_timer
+        )
+        self.owns_db_driver = db_driver is None
+        self.db_driver = db_driver or DBDriver()
+        # splits go straight from the device into the archive when set
+        self.archive_sink = create_archive_sink() if APK_STREAM_TO_ARCHIVE else None
+        self.staging_manager = StagingManager(self.db_driver, self.device_serial)
+        # pause after each app so the store settles before the next one
+        self.settle_secs = 10
+
+    def reset(self, app_id):
+        self.app_id = app_id
+
+    def main_entrypoint(self, app_id):
+        self.reset(app_id)
+        self.adb.reset_call_counts()
+        self.stage_timer.reset()
+        try:
+            self.run_device_stages()
+        finally:
+            call_counts = self.adb.reset_call_counts()
+            logger.info(
+                f"[{self.device_serial}] adb calls for app [{self.app_id}]: {sum(call_counts.values())} {dict(call_counts)}"
+            )
+            durations = self.stage_timer.reset()
+            if durations:
+                self.db_driver.record_stage_durations(
+                    self.app_id, self.device_serial, durations
+                )
+
+    def run_device_stages(self):
+        self.renew_lease()
+        if self.is_already_pulled():
+            logger.info(
+                f"[{self.device_serial}] App [{self.app_id}] is already pulled. Skipping device stages..."
+            )
+            return
+        with self.stage_timer.span("screen_wake"):
+            self.turn_on_the_device_screen()
         logger.info(f"[{self.device_serial}] Processing app: [{self.app_id}]")
         if not self.adb.is_package_installed(self.app_id):
             self.google_play.download_from_store(self.app_id)
+        self.renew_lease()
         self.pull_application()
-        self.uninstall_app()
-        self.rsyncer.move_apk_files()
-        is_metadata_downloaded = self.metadata_downloader.get_apps_metadata()
-        self.db_driver.mark_app_downloaded(self.app_id, is_metadata_downloaded)
+        with self.stage_timer.span("uninstall"):
+            self.uninstall_app()
         self.google_play.close()
-        time.sleep(10)
-        logger.info(f"[{self.device_serial}] Finished processing app: [{self.app_id}]")
+        time.sleep(self.settle_secs)
+        logger.info(
+            f"[{self.device_serial}] Finished device stages of app: [{self.app_id}]"
+        )
+
+    def app_pull_path(self):
+        return abspath(join(self.config["pipeline"]["apk_source"], self.app_id))
+
+    def is_already_pulled(self):
+        app_pull_path = self.app_pull_path()
+        completed_stages = self.db_driver.get_completed_stages(self.app_id)
+        return "pull" in completed_stages and (
+            exists(app_pull_path) or "upload" in completed_stages
+        )
+
+    def close(self):
+        self.google_play.close()
+        self.google_play.ui_backend.close()
+        if self.owns_db_driver:
+            self.db_driver.close_connection()
+
+    def renew_lease(self):
+        if not self.db_driver.renew_lease(
+            self.app_id, self.device_serial, APP_LEASE_SECONDS
+        ):
+            raise Exception(f"Lost the lease for app: [{self.app_id}]")
 
     def turn_on_the_device_screen(self):
-        screen_off = self.adb.adb_utils.shell(
+        screen_off = self.adb.adb_utils_shell(
             'dumpsys power | grep "mHoldingDisplay" | grep "false"'
         )
         if screen_off:
-            self.adb.adb_utils.shell("input keyevent KEYCODE_POWER")
+            self.adb.adb_utils_shell("input keyevent KEYCODE_POWER")
             time.sleep(1)
-            self.adb.adb_utils.shell("input keyevent 82")
+            self.adb.adb_utils_shell("input keyevent 82")
 
     def pull_application(self):
         if self.adb.is_package_installed(self.app_id):
-            self.google_play.pull_apk(self.app_id)
+            if not self.archive_sink:
+                with self.stage_timer.span("staging_wait"):
+                    self.staging_manager.acquire(
+                        self.app_id,
+                        self.google_play.remote_apk_size(self.app_id),
+                        keep_alive=self.renew_lease,
+                    )
+            try:
+                with self.stage_timer.span("pull"):
+                    manifest = self.google_play.pull_apk(
+                        self.app_id,
+                        self.db_driver.get_apk_manifest(self.app_id),
+                        self.archive_sink,
+                    )
+            except Exception:
+                if not self.archive_sink:
+                    # give the space back instead of holding it for a broken pull
+                    shutil.rmtree(self.app_pull_path(), ignore_errors=True)
+                    self.staging_manager.release(self.app_id)
+                raise
+            with self.db_driver.transaction():
+                self.db_driver.record_apk_manifest(self.app_id, manifest)
+                if self.archive_sink:
+                    # already in the archive, the host upload stage has nothing to do
+                    self.db_driver.mark_apk_manifest_uploaded(self.app_id)
+                    self.db_driver.mark_stage_complete(
+                        self.app_id, "upload", self.device_serial
+                    )
+                self.db_driver.mark_stage_complete(
+                    self.app_id, "pull", self.device_serial
+                )
         else:
             raise Exception(f"App: [{self.app_id}] is not installed")
 
@@ -0,0 +1,202 @@
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from google_play_scraper.features.app import parse_dom
+from config.Config import (
+    APP_METADATA_REMOTE_STORE_PATH,
+    METADATA_BATCH_SIZE,
+    METADATA_CONCURRENCY,
+    METADATA_PLAY_BASE_URL,
+    METADATA_REQUESTS_PER_SECOND,
+)
+from helpers.Logger import EpochFormatter
+from helpers.Metrics import STAGE_SECONDS
+from main.DBDriver import DBDriver
+from main.MetadataShardWriter import MetadataShardWriter
+from main.RSyncer import RSyncer
+
+logger = logging.getLogger("MetadataEngine:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(self.next_slot, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class MetadataEngine:
+    def __init__(
+        self,
+        upload_service=None,
+        concurrency=METADATA_CONCURRENCY,
+        requests_per_second=METADATA_REQUESTS_PER_SECOND,
+        batch_size=METADATA_BATCH_SIZE,
+        base_url=METADATA_PLAY_BASE_URL,
+        db_path=None,
+        idle_secs=30,
+        shard_writer=None,
+    ):
+        self.upload_service = upload_service
+        self.shard_writer = shard_writer or MetadataShardWriter()
+        # shard name -> upload future, settled on the engine thread
+        self.shard_uploads = {}
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_url = base_url.rstrip("/")
+        self.db_path = db_path
+        self.idle_secs = idle_secs
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        db_driver = DBDriver(self.db_path)
+        try:
+            for shard_name in self.shard_writer.recover_shards():
+                self._ship_shard(shard_name, db_driver)
+            while not self.stop_event.is_set():
+                if not self.run_once(db_driver):
+                    self._roll_shard(db_driver, force=False)
+                    self.stop_event.wait(self.idle_secs)
+            # no final sweep: at the rate limit a backlog takes hours, and the
+            # apps still missing metadata are picked up on the next start
+            self.finish(db_driver)
+        finally:
+            db_driver.close_connection()
+
+    def backfill(self, db_driver):
+        total = 0
+        while not self.stop_event.is_set():
+            fetched = self.run_once(db_driver)
+            if not fetched:
+                return total
+            total += fetched
+        return total
+
+    def finish(self, db_driver):
+        # ships the open shard and waits for every upload, which is what sets
+        # the metadata flag of the apps in them
+        self._roll_shard(db_driver, force=True)
+        self._settle_shard_uploads(db_driver, wait=True)
+
+    def run_once(self, db_driver):
+        app_ids = db_driver.get_apps_missing_metadata(self.batch_size)
+        if not app_ids:
+            self._settle_shard_uploads(db_driver)
+            return 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self._timed_fetch, app_ids))
+        entries = []
+        failed = []
+        durations = []
+        for app_id, (data, seconds) in zip(app_ids, results):
+            if seconds is None:
+                # skipped because we are stopping, not a failed attempt
+                continue
+            durations.append((app_id, "metadata", "host", seconds))
+            if data is None:
+                failed.append(app_id)
+                continue
+            try:
+                entries.append(self.shard_writer.append(app_id, data))
+            except Exception as e:
+                logger.error(f"Failed to store metadata of app [{app_id}]: {e}")
+                failed.append(app_id)
+        self.shard_writer.flush()
+        # indexed apps are not picked up again; the flag follows the shard upload
+        with db_driver.transaction():
+            db_driver.record_metadata_index(entries)
+            db_driver.mark_metadata_downloaded([], failed)
+            db_driver.record_stage_durations_bulk(durations)
+        logger.info(
+            f"Fetched metadata for [{len(entries)}/{len(app_ids)}] apps in this batch"
+        )
+        self._roll_shard(db_driver, force=False)
+        self._settle_shard_uploads(db_driver)
+        return len(app_ids)
+
+    def _roll_shard(self, db_driver, force):
+        if force:
+            shard_name = self.shard_writer.roll()
+        else:
+            shard_name = self.shard_writer.roll_if_due()
+        if shard_name:
+            self._ship_shard(shard_name, db_driver)
+
+    def _ship_shard(self, shard_name, db_driver):
+        if not self.upload_service:
+            db_driver.mark_metadata_shard_uploaded(shard_name)
+            return
+        self.shard_uploads[shard_name] = self.upload_service.submit(
+            self.shard_writer.shard_path(shard_name),
+            RSyncer.remote_path(f"{APP_METADATA_REMOTE_STORE_PATH}/"),
+        )
+
+    def _settle_shard_uploads(self, db_driver, wait=False):
+        for shard_name, upload in list(self.shard_uploads.items()):
+            if not wait and not upload.done():
+                continue
+            del self.shard_uploads[shard_name]
+            try:
+                upload.result()
+            except Exception as e:
+                logger.error(f"Failed to upload metadata shard [{shard_name}]: {e}")
+                # the shard stays on disk and is shipped again on the next start
+                continue
+            db_driver.mark_metadata_shard_uploaded(shard_name)
+
+    def _timed_fetch(self, app_id):
+        # a stop drops the rest of the batch instead of waiting out the limiter
+        if self.stop_event.is_set():
+            return None, None
+        # rate limiter waits count too, they are part of what an app costs
+        started_at = time.monotonic()
+        data = self._fetch(app_id)
+        seconds = time.monotonic() - started_at
+        STAGE_SECONDS.labels("host", "metadata").observe(seconds)
+        return data, seconds
+
+    def _fetch(self, app_id, lang="en", country="us"):
+        url = f"{self.base_url}/store/apps/details?id={app_id}&hl={lang}&gl={country}"
+        try:
+            self.rate_limiter.acquire()
+            response = self.session.get(url, timeout=30)
+            if response.status_code == 404:
+                url = f"{self.base_url}/store/apps/details?id={app_id}&hl={lang}"
+                self.rate_limiter.acquire()
+                response = self.session.get(url, timeout=30)
+            response.raise_for_status()
+            return parse_dom(dom=response.text, app_id=app_id, url=url)
+        except Exception as e:
+            logger.error(f"Failed to fetch metadata of app [{app_id}]: {e}")
+            return None
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import sys
+import time
+from os.path import join
+from config.Config import (
+    APP_METADATA_LOCAL_STORE_PATH,
+    METADATA_SHARD_MAX_AGE_SECS,
+    METADATA_SHARD_MAX_BYTES,
+)
+from helpers.Logger import EpochFormatter
+
+logger = logging.getLogger("MetadataShardWriter:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+def owner_is_running(file_name):
+    # shard names end in the pid of the process that wrote them
+    try:
+        pid = int(file_name.split(".", 1)[0].rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # alive, only owned by another user
+        return True
+    return True
+
+
+class MetadataShardWriter:
+    def __init__(
+        self,
+        directory=APP_METADATA_LOCAL_STORE_PATH,
+        max_bytes=METADATA_SHARD_MAX_BYTES,
+        max_age_secs=METADATA_SHARD_MAX_AGE_SECS,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_secs = max_age_secs
+        self.shard_name = None
+        self.file = None
+        self.opened_at = None
+        self.size = 0
+
+    def shard_path(self, shard_name):
+        return join(self.directory, shard_name)
+
+    def recover_shards(self):
+        # shards left behind by a previous run: close the open ones and report all.
+        # Shards of an engine that is still running (a backfill next to main.py)
+        # are its own to roll and ship
+        shard_names = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.startswith("metadata-") or owner_is_running(file_name):
+                continue
+            if file_name.endswith(".jsonl.part"):
+                shard_name = file_name[: -len(".part")]
+                os.replace(self.shard_path(file_name), self.shard_path(shard_name))
+                shard_names.append(shard_name)
+            elif file_name.endswith(".jsonl"):
+                shard_names.append(file_name)
+        return shard_names
+
+    def append(self, app_id, data):
+        if self.file is None:
+            self._open()
+        line = (json.dumps(data) + "\n").encode()
+        offset = self.size
+        self.file.write(line)
+        self.size += len(line)
+        return app_id, self.shard_name, offset, len(line)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def roll_if_due(self):
+        if self.file is None:
+            return None
+        if self.size >= self.max_bytes or (
+            time.time() - self.opened_at >= self.max_age_secs
+        ):
+            return self.roll()
+        return None
+
+    def roll(self):
+        if self.file is None:
+            return None
+        self.flush()
+        self.file.close()
+        shard_name = self.shard_name
+        os.replace(self.shard_path(f"{shard_name}.part"), self.shard_path(shard_name))
+        logger.info(f"Rolled metadata shard [{shard_name}] ({self.size} bytes)")
+        self.file = None
+        self.shard_name = None
+        self.size = 0
+        return shard_name
+
+    def _open(self):
+        self.shard_name = f"metadata-{int(time.time() * 1000)}-{os.getpid()}.jsonl"
+        self.file = open(self.shard_path(f"{self.shard_name}.part"), "ab")
+        self.opened_at = time.time()
+        self.size = 0
@@ -1,67 +1,35 @@
-import logging
+import os
 import shutil
-import subprocess
-import sys
+from concurrent.futures import Future
 from os.path import abspath, join, exists
-from config.Config import (
-    SSH_KEY_PATH,
-    APK_LOCAL_STORE_PATH,
-    APK_REMOTE_STORE_PATH,
-    SSH_HOST,
-    SSH_PORT,
-    APP_METADATA_REMOTE_STORE_PATH,
-    APP_METADATA_LOCAL_STORE_PATH,
-)
-from helpers.Logger import EpochFormatter
-
-logger = logging.getLogger("RSyncer:")
-formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setFormatter(formatter)
-logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+from config.Config import APK_LOCAL_STORE_PATH, APK_REMOTE_STORE_PATH, SSH_HOST
 
 
 class RSyncer:
-    def __init__(self, app_id):
+    def __init__(self, app_id, upload_service=None):
         self.app_id = app_id
+        self.upload_service = upload_service
 
-    def _rsync(self, source, destination):
-        if not exists(source):
-            raise Exception(f"Source path: [{source}] does not exist")
-
-        command = [
-            "rsync",
-            "-avz",
-            "--checksum",
-            "--no-group",
-            "--no-owner",
-            "-e",
-            f"ssh -i {SSH_KEY_PATH} -p {SSH_PORT}",
-            source,
-            destination,
-        ]
-
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    @staticmethod
+    def remote_path(path):
+        # without an SSH host the store path is treated as a local directory
+        return f"{SSH_HOST}:{path}" if SSH_HOST else path
 
-        if result.returncode == 0:
-            logger.info("Transfer completed successfully.")
-            shutil.rmtree(source) if not source.endswith(".json") else os.remove(source)
-            logger.info(f"Deleted source path: [{source}]")
-        else:
-            raise Exception(
-                f"An error occurred in [{self.app_id}]: {result.stderr.decode()}"
-            )
-
-    def move_apk_files(self):
-        logger.info(f"Moving APK files to remote: for app: [{self.app_id}]")
+    def submit_apk_files(self, manifest=None):
         source = abspath(join(APK_LOCAL_STORE_PATH, self.app_id))
-        destination = f"{SSH_HOST}:{APK_REMOTE_STORE_PATH}"
-        self._rsync(source, destination)
-
-    def move_app_metadata(self):
-        logger.info(
-            f"Moving app metadata JSON files to remote: for app: [{self.app_id}]"
+        expected = {}
+        for split_name, (size, sha256, uploaded) in (manifest or {}).items():
+            split_path = join(source, split_name)
+            if uploaded and exists(split_path):
+                # already verified in the remote store by an earlier run
+                os.remove(split_path)
+            elif not uploaded:
+                expected[split_name] = (size, sha256)
+        if manifest and not expected:
+            shutil.rmtree(source, ignore_errors=True)
+            future = Future()
+            future.set_result(source)
+            return future
+        return self.upload_service.submit(
+            source, self.remote_path(APK_REMOTE_STORE_PATH), expected
         )
-        source = abspath(join(APP_METADATA_LOCAL_STORE_PATH, f"{self.app_id}.json"))
-        destination = f"{SSH_HOST}:{APP_METADATA_REMOTE_STORE_PATH}/"
-        self._rsync(source, destination)
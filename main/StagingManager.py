@@ -0,0 +1,74 @@
+import logging
+import sys
+import time
+import humanize
+from config.Config import (
+    STAGING_QUOTA_BYTES,
+    STAGING_WAIT_POLL_SECS,
+    STAGING_WAIT_TIMEOUT_SECS,
+)
+from helpers.Logger import EpochFormatter
+
+logger = logging.getLogger("StagingManager:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+class StagingManager:
+    # the accounting lives in the shared DB so every device worker sees one quota
+    def __init__(
+        self,
+        db_driver,
+        device_serial,
+        quota_bytes=STAGING_QUOTA_BYTES,
+        poll_secs=STAGING_WAIT_POLL_SECS,
+        timeout_secs=STAGING_WAIT_TIMEOUT_SECS,
+    ):
+        self.db_driver = db_driver
+        self.device_serial = device_serial
+        self.quota_bytes = quota_bytes
+        self.poll_secs = poll_secs
+        self.timeout_secs = timeout_secs
+        self.waits = 0
+        self.total_wait_secs = 0.0
+
+    def acquire(self, app_id, nbytes, keep_alive=None):
+        # blocks until the app fits; keep_alive runs between polls (lease renewal).
+        # The space is only given back by uploads, and a failed upload keeps it
+        # until its app is claimed again, which needs a device that is not stuck
+        # here: past timeout_secs the app fails as transient and the device moves on
+        started_at = time.monotonic()
+        logged = False
+        while True:
+            waited_secs = time.monotonic() - started_at
+            if self.db_driver.reserve_staging(
+                app_id, self.device_serial, nbytes, self.quota_bytes, waited_secs
+            ):
+                break
+            if waited_secs >= self.timeout_secs:
+                raise Exception(
+                    f"Staging area full for {waited_secs:.0f}s, giving up on [{app_id}]"
+                )
+            if not logged:
+                apps, staged_bytes = self.db_driver.get_staging_usage()
+                logger.info(
+                    f"[{self.device_serial}] Staging quota reached ({humanize.naturalsize(staged_bytes)} in {apps} apps, "
+                    f"quota {humanize.naturalsize(self.quota_bytes)}), waiting to pull [{app_id}] ({humanize.naturalsize(nbytes)})"
+                )
+                logged = True
+            if keep_alive:
+                keep_alive()
+            time.sleep(self.poll_secs)
+        if logged:
+            self.waits += 1
+            self.total_wait_secs += waited_secs
+            logger.info(
+                f"[{self.device_serial}] Waited {waited_secs:.0f}s for staging space "
+                f"[{self.waits} waits, {self.total_wait_secs:.0f}s in total]"
+            )
+        return waited_secs
+
+    def release(self, app_id):
+        self.db_driver.release_staging(app_id)
@@ -0,0 +1,299 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from os.path import basename, expanduser, exists, join
+from config.Config import (
+    SSH_KEY_PATH,
+    SSH_PORT,
+    SSH_CONTROL_PERSIST_SECS,
+    UPLOAD_BATCH_SIZE,
+    UPLOAD_BATCH_LATENCY_SECS,
+)
+from helpers.Logger import EpochFormatter
+
+logger = logging.getLogger("UploadService:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+def ssh_options():
+    # every ssh/rsync call multiplexes over one master connection per host
+    control_path = expanduser("~/.ssh/gpsd-%r@%h:%p")
+    return [
+        "-i",
+        SSH_KEY_PATH,
+        "-p",
+        str(SSH_PORT),
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={control_path}",
+        "-o",
+        f"ControlPersist={SSH_CONTROL_PERSIST_SECS}",
+    ]
+
+
+class UploadService:
+    def __init__(
+        self, batch_size=UPLOAD_BATCH_SIZE, max_latency=UPLOAD_BATCH_LATENCY_SECS
+    ):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, source, destination, expected=None):
+        # expected maps file names under source to the (size, sha256) in the manifest
+        future = Future()
+        if not exists(source):
+            future.set_exception(Exception(f"Source path: [{source}] does not exist"))
+            return future
+        with self.condition:
+            self.pending.append((time.time(), source, destination, expected, future))
+            self.condition.notify()
+        return future
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                batch = self._wait_for_batch()
+            if batch is None:
+                return
+            try:
+                self._ship(batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _wait_for_batch(self):
+        while True:
+            if self.pending:
+                age = time.time() - self.pending[0][0]
+                if (
+                    len(self.pending) >= self.batch_size
+                    or age >= self.max_latency
+                    or self.stopped
+                ):
+                    batch = self.pending[: self.batch_size]
+                    del self.pending[: self.batch_size]
+                    return batch
+                self.condition.wait(self.max_latency - age)
+            elif self.stopped:
+                return None
+            else:
+                self.condition.wait()
+
+    def _ship(self, batch):
+        by_destination = {}
+        for _, source, destination, expected, future in batch:
+            by_destination.setdefault(destination, []).append(
+                (source, expected, future)
+            )
+        for destination, items in by_destination.items():
+            sources = [source for source, _, _ in items]
+            returncode, stderr = self._rsync(sources, destination)
+            if returncode == 0:
+                logger.info(
+                    f"Transferred batch of [{len(items)}] items to [{destination}]"
+                )
+                self._verify_and_confirm(items, destination)
+                continue
+            if len(items) > 1:
+                logger.error(
+                    f"Batch transfer to [{destination}] failed, retrying items one by one"
+                )
+            # the batch result does not say which items made it, so settle each one
+            for item in items:
+                if len(items) > 1:
+                    returncode, stderr = self._rsync([item[0]], destination)
+                if returncode == 0:
+                    self._verify_and_confirm([item], destination)
+                else:
+                    item[2].set_exception(
+                        Exception(f"An error occurred in [{item[0]}]: {stderr}")
+                    )
+
+    def _verify_and_confirm(self, items, destination):
+        expected_files = {}
+        for source, expected, _ in items:
+            for file_name, digest in (expected or {}).items():
+                expected_files[join(basename(source), file_name)] = digest
+        remote_files = self._remote_digests(destination, sorted(expected_files))
+        for source, expected, future in items:
+            mismatched = [
+                file_name
+                for file_name in expected or {}
+                if remote_files.get(join(basename(source), file_name))
+                != expected[file_name]
+            ]
+            if mismatched:
+                future.set_exception(
+                    Exception(
+                        f"Remote copy of [{source}] does not match the manifest: {mismatched}"
+                    )
+                )
+                continue
+            shutil.rmtree(source) if os.path.isdir(source) else os.remove(source)
+            logger.info(f"Deleted source path: [{source}]")
+            future.set_result(source)
+
+    def _remote_digests(self, destination, relative_paths):
+        if not relative_paths:
+            return {}
+        if ":" not in destination:
+            digests = {}
+            for relative_path in relative_paths:
+                path = join(destination, relative_path)
+                if not exists(path):
+                    continue
+                sha256 = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        sha256.update(chunk)
+                digests[relative_path] = (os.stat(path).st_size, sha256.hexdigest())
+            return digests
+        host, remote_path = destination.split(":", 1)
+        quoted_paths = " ".join(shlex.quote(p) for p in relative_paths)
+        remote_command = (
+            f"cd {shlex.quote(remote_path)} && stat -c %s -- {quoted_paths} "
+            f"&& sha256sum -- {quoted_paths}"
+        )
+        result = subprocess.run(
+            ["ssh", *ssh_options(), host, remote_command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            logger.error(f"Remote verification failed: {result.stderr.decode()}")
+            return {}
+        lines = result.stdout.decode().splitlines()
+        sizes = lines[: len(relative_paths)]
+        hashes = lines[len(relative_paths) :]
+        return {
+            relative_path: (int(size), sha256_line.split()[0])
+            for relative_path, size, sha256_line in zip(relative_paths, sizes, hashes)
+        }
+
+    def _rsync(self, sources, destination):
+        # no --checksum: the manifest hash check after the transfer replaces it
+        command = ["rsync", "-avz", "--no-group", "--no-owner"]
+        if ":" in destination:
+            command.extend(["-e", shlex.join(["ssh", *ssh_options()])])
+        command.extend([*sources, destination])
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.returncode, result.stderr.decode()
+
+
+class UploadClient:
+    # submit() for a device worker process; the host's UploadHub ships the item
+    # with everyone else's. Only the queues cross the process boundary.
+    def __init__(self, device_serial, request_queue, result_queue):
+        self.device_serial = device_serial
+        self.request_queue = request_queue
+        self.result_queue = result_queue
+        self._reset()
+
+    def _reset(self):
+        self.futures = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def __getstate__(self):
+        return self.device_serial, self.request_queue, self.result_queue
+
+    def __setstate__(self, state):
+        self.device_serial, self.request_queue, self.result_queue = state
+        self._reset()
+
+    def submit(self, source, destination, expected=None):
+        future = Future()
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self._listen, daemon=True)
+                self.listener.start()
+            # the pid keeps a restarted worker from taking its predecessor's results
+            request_id = (os.getpid(), next(self.request_ids))
+            self.futures[request_id] = future
+        self.request_queue.put(
+            (self.device_serial, request_id, source, destination, expected)
+        )
+        return future
+
+    def _listen(self):
+        while True:
+            request_id, error = self.result_queue.get()
+            with self.lock:
+                future = self.futures.pop(request_id, None)
+            # results for a previous process of this device have no future here
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(Exception(error))
+
+
+class UploadHub:
+    # One UploadService per host, fed by every device worker process, so items
+    # from all devices fill the same batches. With a service per worker no more
+    # than HOST_STAGE_WORKERS items are ever pending and a batch never fills.
+    def __init__(self, device_serials, upload_service):
+        self.upload_service = upload_service
+        self.request_queue = multiprocessing.Queue()
+        self.result_queues = {
+            device_serial: multiprocessing.Queue() for device_serial in device_serials
+        }
+        self.thread = None
+
+    def client(self, device_serial):
+        return UploadClient(
+            device_serial, self.request_queue, self.result_queues[device_serial]
+        )
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.request_queue.put(None)
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            request = self.request_queue.get()
+            if request is None:
+                return
+            device_serial, request_id, source, destination, expected = request
+            future = self.upload_service.submit(source, destination, expected)
+            future.add_done_callback(partial(self._report, device_serial, request_id))
+
+    def _report(self, device_serial, request_id, future):
+        error = future.exception()
+        # the message text travels, it is what the error catalog classifies
+        self.result_queues[device_serial].put(
+            (request_id, None if error is None else str(error))
+        )
@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import sys
+import time
+from copy import deepcopy
+from helpers.Logger import EpochFormatter
+
+logger = logging.getLogger("WorkerSupervisor:")
+formatter = EpochFormatter("[%(asctime)s] [%(name)s] %(message)s")
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(formatter)
+logging.basicConfig(level=logging.INFO, handlers=[stdout_handler])
+
+
+class WorkerSupervisor:
+    def __init__(
+        self,
+        dispatcher,
+        worker_target,
+        base_config,
+        health_check_interval=5,
+        min_restart_delay=5,
+        max_restart_delay=300,
+        stable_run_secs=600,
+        status_log_interval=600,
+    ):
+        self.dispatcher = dispatcher
+        self.worker_target = worker_target
+        self.base_config = base_config
+        self.health_check_interval = health_check_interval
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_run_secs = stable_run_secs
+        self.status_log_interval = status_log_interval
+        self.workers = {}
+        self.last_status_log = 0
+
+    def start_worker(self, device_serial):
+        config_copy = deepcopy(self.base_config)
+        config_copy["pipeline"]["device_serial"] = device_serial
+        p = multiprocessing.Process(
+            target=self.worker_target,
+            args=(device_serial, config_copy, self.dispatcher.client(device_serial)),
+            daemon=True,
+        )
+        p.start()
+        state = self.workers.setdefault(
+            device_serial, dict(restarts=0, consecutive_failures=0)
+        )
+        state.update(process=p, started_at=time.time(), restart_at=None)
+        logger.info(f"Starting worker for device [{device_serial}] (pid: {p.pid})")
+
+    def run(self):
+        for device_serial in self.dispatcher.device_serials:
+            self.start_worker(device_serial)
+        while not self.dispatcher.wait_finished(timeout=self.health_check_interval):
+            self.check_workers()
+            if time.time() - self.last_status_log >= self.status_log_interval:
+                self.log_status()
+        logger.info("All apps are dispatched and processed.")
+
+    def check_workers(self):
+        now = time.time()
+        for device_serial, state in self.workers.items():
+            p = state["process"]
+            if p.is_alive():
+                continue
+            if state["restart_at"] is None:
+                self.handle_dead_worker(device_serial, state, now)
+            if now >= state["restart_at"]:
+                state["restarts"] += 1
+                self.start_worker(device_serial)
+
+    def handle_dead_worker(self, device_serial, state, now):
+        p = state["process"]
+        p.join()
+        if now - state["started_at"] >= self.stable_run_secs:
+            state["consecutive_failures"] = 0
+        state["consecutive_failures"] += 1
+        delay = min(
+            self.min_restart_delay * 2 ** (state["consecutive_failures"] - 1),
+            self.max_restart_delay,
+        )
+        state["restart_at"] = now + delay
+        logger.error(
+            f"Worker [{device_serial}] died with exit code [{p.exitcode}]. "
+            f"Restarting in {delay}s..."
+        )
+        if not self.dispatcher.report_worker_lost(device_serial):
+            logger.error(f"Dispatcher did not release apps of [{device_serial}]")
+
+    def worker_status(self):
+        now = time.time()
+        return {
+            device_serial: dict(
+                alive=state["process"].is_alive(),
+                pid=state["process"].pid,
+                exitcode=state["process"].exitcode,
+                uptime=round(now - state["started_at"]),
+                restarts=state["restarts"],
+            )
+            for device_serial, state in self.workers.items()
+        }
+
+    def log_status(self):
+        self.last_status_log = time.time()
+        for device_serial, status in self.worker_status().items():
+            logger.info(f"Worker [{device_serial}] status: {status}")
+
+    def stop(self):
+        for state in self.workers.values():
+            state["process"].terminate()
+        for state in self.workers.values():
+            state["process"].join()
@@ -1,6 +1,13 @@
 import sqlite3
 from os.path import abspath, join, dirname, realpath
 from config.Config import SQLITE_DB_NAME
+from helpers.ErrorCatalog import (
+    APP_INCOMPATIBLE,
+    APP_PERMANENT,
+    ERROR_NAMES,
+    ERROR_POLICIES,
+    classify_error,
+)
 
 input_apps_path = abspath(join(dirname(dirname(realpath(__file__))), "inputs", ".txt"))
 input_apps_path_v2 = abspath(
@@ -28,7 +35,14 @@ def create_input_apps_table():
             app_id TEXT NOT NULL PRIMARY KEY,
             downloaded BOOLEAN DEFAULT 0,
             metadata BOOLEAN DEFAULT 0,
-            device TEXT DEFAULT NULL
+            device TEXT DEFAULT NULL,
+            lease_expires_at REAL DEFAULT NULL,
+            failed_devices INTEGER DEFAULT 0,
+            incompatible_devices INTEGER DEFAULT 0,
+            metadata_attempted_at REAL DEFAULT NULL,
+            retries INTEGER DEFAULT 0,
+            retry_at REAL DEFAULT NULL,
+            abandoned BOOLEAN DEFAULT 0
         );
         
         CREATE INDEX IF NOT EXISTS idx2_app_id ON input_apps (app_id);
@@ -61,16 +75,292 @@ def create_error_apps_table():
         """
         PRAGMA foreign_keys = ON;
 
+        CREATE TABLE IF NOT EXISTS error_codes (
+            code INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+
         CREATE TABLE IF NOT EXISTS error_apps (
             app_id TEXT NOT NULL,
             device TEXT NOT NULL,
-            error TEXT NOT NULL,
-            PRIMARY KEY (app_id, device, error),
+            error_code INTEGER NOT NULL,
+            PRIMARY KEY (app_id, device, error_code),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE,
+            FOREIGN KEY (error_code) REFERENCES error_codes (code)
+        );
+
+        CREATE TABLE IF NOT EXISTS error_messages (
+            app_id TEXT NOT NULL,
+            device TEXT NOT NULL,
+            error_code INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (app_id, device, error_code),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+        """
+    )
+    cursor.executemany(
+        "INSERT OR REPLACE INTO error_codes (code, name) VALUES (?, ?)",
+        ERROR_NAMES.items(),
+    )
+    conn.commit()
+    conn.close()
+
+
+def normalize_error_apps():
+    # error_apps used to key on the full exception text; classify every row into
+    # its code and keep the text in error_messages
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(error_apps)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "error" in columns:
+        conn.create_function("classify_error", 1, classify_error, deterministic=True)
+        cursor.executescript(
+            """
+            CREATE TABLE error_apps_by_code (
+                app_id TEXT NOT NULL,
+                device TEXT NOT NULL,
+                error_code INTEGER NOT NULL,
+                PRIMARY KEY (app_id, device, error_code),
+                FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE,
+                FOREIGN KEY (error_code) REFERENCES error_codes (code)
+            );
+
+            INSERT OR IGNORE INTO error_apps_by_code (app_id, device, error_code)
+            SELECT app_id, device, classify_error(error)
+            FROM error_apps;
+
+            INSERT OR REPLACE INTO error_messages
+            (app_id, device, error_code, message, recorded_at)
+            SELECT app_id, device, classify_error(error), error,
+                (julianday('now') - 2440587.5) * 86400.0
+            FROM error_apps;
+
+            DROP TABLE error_apps;
+            ALTER TABLE error_apps_by_code RENAME TO error_apps;
+            """
+        )
+        conn.commit()
+        # give back the pages the text keys and their index took
+        conn.execute("VACUUM;")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_error_code ON error_apps (error_code);"
+    )
+    conn.commit()
+    conn.close()
+
+
+def add_lease_columns():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(input_apps)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "lease_expires_at" not in columns:
+        cursor.execute(
+            "ALTER TABLE input_apps ADD COLUMN lease_expires_at REAL DEFAULT NULL"
+        )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_input_apps_lease
+        ON input_apps (downloaded, lease_expires_at);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def add_queue_state_columns():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(input_apps)")
+    columns = {row[1] for row in cursor.fetchall()}
+    for column in ["failed_devices", "incompatible_devices"]:
+        if column not in columns:
+            cursor.execute(
+                f"ALTER TABLE input_apps ADD COLUMN {column} INTEGER DEFAULT 0"
+            )
+    cursor.executescript(
+        f"""
+        UPDATE input_apps
+        SET failed_devices = (
+                SELECT COUNT(DISTINCT e.device)
+                FROM error_apps e
+                WHERE e.app_id = input_apps.app_id
+            ),
+            incompatible_devices = (
+                SELECT COUNT(DISTINCT e.device)
+                FROM error_apps e
+                WHERE e.app_id = input_apps.app_id
+                AND e.error_code = {APP_INCOMPATIBLE}
+            )
+        WHERE app_id IN (SELECT app_id FROM error_apps);
+
+        CREATE INDEX IF NOT EXISTS idx_input_apps_failed_devices
+        ON input_apps (downloaded, failed_devices);
+        CREATE INDEX IF NOT EXISTS idx_input_apps_incompatible_devices
+        ON input_apps (downloaded, incompatible_devices);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_app_stages_table():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+
+        CREATE TABLE IF NOT EXISTS app_stages (
+            app_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            device TEXT NOT NULL,
+            completed_at REAL NOT NULL,
+            PRIMARY KEY (app_id, stage),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_apk_manifest_table():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+
+        CREATE TABLE IF NOT EXISTS apk_manifest (
+            app_id TEXT NOT NULL,
+            split_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            uploaded BOOLEAN DEFAULT 0,
+            PRIMARY KEY (app_id, split_name),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def add_metadata_columns():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(input_apps)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "metadata_attempted_at" not in columns:
+        cursor.execute(
+            "ALTER TABLE input_apps ADD COLUMN metadata_attempted_at REAL DEFAULT NULL"
+        )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_input_apps_metadata
+        ON input_apps (downloaded, metadata);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def add_retry_columns():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(input_apps)")
+    columns = {row[1] for row in cursor.fetchall()}
+    for column, definition in [
+        ("retries", "INTEGER DEFAULT 0"),
+        ("retry_at", "REAL DEFAULT NULL"),
+        ("abandoned", "BOOLEAN DEFAULT 0"),
+    ]:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE input_apps ADD COLUMN {column} {definition}")
+    # apps that failed before the policy existed: permanent errors stay given up,
+    # transient ones get a fresh retry budget
+    app_permanent_codes = ", ".join(
+        str(code) for code, policy in ERROR_POLICIES.items() if policy == APP_PERMANENT
+    )
+    cursor.executescript(
+        f"""
+        UPDATE input_apps
+        SET abandoned = 1
+        WHERE downloaded = 0 AND app_id IN (
+            SELECT app_id FROM error_apps WHERE error_code IN ({app_permanent_codes})
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_input_apps_retry
+        ON input_apps (retry_at) WHERE retry_at IS NOT NULL;
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_metadata_index_table():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+
+        CREATE TABLE IF NOT EXISTS metadata_index (
+            app_id TEXT PRIMARY KEY,
+            shard TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_metadata_index_shard ON metadata_index (shard);
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_staging_table():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executescript(
+        """
+        PRAGMA foreign_keys = ON;
+
+        CREATE TABLE IF NOT EXISTS staging (
+            app_id TEXT PRIMARY KEY,
+            device TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            reserved_at REAL NOT NULL,
+            waited_secs REAL DEFAULT 0,
             FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
         );
+        """
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_app_stage_durations_table():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executescript(
+        """
+        PRAGMA foreign_keys = ON;
 
-        CREATE INDEX IF NOT EXISTS idx_error ON error_apps (error);
-        CREATE INDEX IF NOT EXISTS idx_app_id ON error_apps (app_id);
+        CREATE TABLE IF NOT EXISTS app_stage_durations (
+            app_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            device TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (app_id, stage),
+            FOREIGN KEY (app_id) REFERENCES input_apps (app_id) ON DELETE CASCADE
+        );
         """
     )
     conn.commit()
@@ -83,6 +373,16 @@ def main():
     # insert_input_apps(input_apps_path_v2)
     insert_input_apps(custom_apps_path)
     create_error_apps_table()
+    normalize_error_apps()
+    add_lease_columns()
+    add_queue_state_columns()
+    create_app_stages_table()
+    create_apk_manifest_table()
+    add_metadata_columns()
+    add_retry_columns()
+    create_metadata_index_table()
+    create_staging_table()
+    create_app_stage_durations_table()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+from main.DBDriver import DBDriver
+from main.MetadataEngine import MetadataEngine
+from main.UploadService import UploadService
+
+
+def main():
+    db_driver = DBDriver()
+    upload_service = UploadService()
+    metadata_engine = MetadataEngine(upload_service)
+    total = metadata_engine.backfill(db_driver)
+    metadata_engine.finish(db_driver)
+    upload_service.stop()
+    db_driver.close_connection()
+
+    print(f"{total} apps with downloaded = 1 AND metadata = 0 processed.")
+
+
+if __name__ == "__main__":
+    main()
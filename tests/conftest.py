@@ -0,0 +1,41 @@
+import importlib.util
+import sqlite3
+import sys
+from os.path import dirname, join, realpath
+import pytest
+
+# Run from the repository root: python -m pytest tests
+#
+# The modules import their settings from config/Config.py, which every
+# deployment writes for itself; without one the template's defaults are used.
+
+ROOT = dirname(dirname(realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import config.Config  # noqa: F401
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+        "config.Config", join(ROOT, "config", "Config.env.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["config.Config"] = module
+    spec.loader.exec_module(module)
+
+
+@pytest.fixture
+def create_db(tmp_path):
+    def create(app_ids, downloaded=False):
+        db_path = str(tmp_path / "test.db")
+        conn = sqlite3.connect(db_path)
+        with open(join(ROOT, "databases", "schema.sql")) as f:
+            conn.executescript(f.read())
+        conn.executemany(
+            "INSERT INTO input_apps (app_id, downloaded) VALUES (?, ?)",
+            [(app_id, int(downloaded)) for app_id in app_ids],
+        )
+        conn.commit()
+        conn.close()
+        return db_path
+
+    return create
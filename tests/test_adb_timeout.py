@@ -0,0 +1,43 @@
+import stat
+import time
+from helpers.ADBCommands import ADBCommands
+
+# stands in for the adb client: forks a child that outlives it, then hangs
+SLOW_ADB = """#!/bin/sh
+sleep 30 &
+echo "$$ $!" > "{pid_file}"
+sleep 30
+"""
+
+
+def is_running(pid):
+    # a killed process nobody reaped yet is a zombie, not running
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_timeout_kills_adb_and_its_children(tmp_path):
+    pid_file = tmp_path / "pids"
+    adb_path = tmp_path / "adb"
+    adb_path.write_text(SLOW_ADB.format(pid_file=pid_file))
+    adb_path.chmod(adb_path.stat().st_mode | stat.S_IEXEC)
+    config = {"pipeline": {"ADB_BINARY": str(adb_path), "device_serial": "fake"}}
+    # adb_utils is only used for socket-level calls, which this test does not make
+    adb = ADBCommands(config, adb_utils=object())
+
+    started_at = time.monotonic()
+    returncode, output = adb.adb_simple("install-multiple", "a.apk", timeout_secs=0.5)
+    elapsed = time.monotonic() - started_at
+
+    assert returncode == 1
+    assert output.startswith("Timed out after 0.5s")
+    assert elapsed < 1
+    pids = [int(pid) for pid in pid_file.read_text().split()]
+    deadline = time.monotonic() + 2
+    while any(is_running(pid) for pid in pids) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # the SIGKILL went to the whole process group, the forked child included
+    assert not any(is_running(pid) for pid in pids)
@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+import time
+from helpers.ErrorCatalog import APP_INCOMPATIBLE, LEASE_LOST
+from main.AppDispatcher import AppDispatcher
+from main.DBDriver import DBDriver
+from main.ErrorPolicy import FailureDecision
+
+APP_IDS = [f"com.example.app{i}" for i in range(6)]
+
+
+def exclude(db_path, device_serial, app_ids):
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO error_apps (app_id, device, error_code) VALUES (?, ?, ?)",
+        [(app_id, device_serial, APP_INCOMPATIBLE) for app_id in app_ids],
+    )
+    conn.commit()
+    conn.close()
+
+
+def claim_all(db_driver, device_serial, after_rowid=0):
+    claimed = []
+    while True:
+        app_id, after_rowid = db_driver.claim_next_app(device_serial, 3600, after_rowid)
+        if app_id is None:
+            return claimed, after_rowid
+        claimed.append(app_id)
+
+
+def test_claims_skip_excluded_apps_in_table_order(create_db):
+    db_path = create_db(APP_IDS)
+    exclude(db_path, "devA", APP_IDS[:3])
+    db_driver = DBDriver(db_path)
+    claimed, after_rowid = claim_all(db_driver, "devA")
+    assert claimed == APP_IDS[3:]
+    # a pass that found nothing starts the next one at the front
+    assert after_rowid == 0
+    assert claim_all(db_driver, "devB") == (APP_IDS[:3], 0)
+
+
+def test_cursor_wraps_to_apps_released_behind_it(create_db):
+    db_path = create_db(APP_IDS)
+    db_driver = DBDriver(db_path)
+    first, after_rowid = db_driver.claim_next_app("devA", 3600)
+    second, after_rowid = db_driver.claim_next_app("devA", 3600, after_rowid)
+    db_driver.release_app(first, "devA")
+    claimed, _ = claim_all(db_driver, "devA", after_rowid)
+    assert claimed == APP_IDS[2:] + [first]
+
+
+def test_due_retries_and_expired_leases_come_first(create_db):
+    db_path = create_db(APP_IDS)
+    db_driver = DBDriver(db_path)
+    _, after_rowid = claim_all(db_driver, "devA")
+    db_driver.schedule_app_retry(APP_IDS[1], time.time() + 3600)
+    db_driver.release_app(APP_IDS[1], "devA")
+    db_driver.schedule_app_retry(APP_IDS[2], time.time() - 1)
+    db_driver.release_app(APP_IDS[2], "devA")
+    db_driver.renew_lease(APP_IDS[4], "devA", -1)
+    app_id, _ = db_driver.claim_next_app("devB", 3600, len(APP_IDS))
+    assert app_id == APP_IDS[2]
+    app_id, _ = db_driver.claim_next_app("devB", 3600, len(APP_IDS))
+    assert app_id == APP_IDS[4]
+    # still in backoff
+    assert db_driver.claim_next_app("devB", 3600, len(APP_IDS)) == (None, 0)
+    conn = sqlite3.connect(db_path)
+    retry_at = dict(conn.execute("SELECT app_id, retry_at FROM input_apps"))
+    assert retry_at[APP_IDS[2]] is None
+    assert retry_at[APP_IDS[1]] is not None
+
+
+def test_handed_back_app_goes_to_a_device_past_it(create_db):
+    db_path = create_db(APP_IDS[:3])
+    dispatcher = AppDispatcher(["devA", "devB"], 3600, db_path=db_path)
+    dispatcher.start()
+    try:
+        dev_a, dev_b = dispatcher.client("devA"), dispatcher.client("devB")
+        assert dev_a.next_app() == APP_IDS[0]
+        assert dev_b.next_app() == APP_IDS[1]
+        dev_b.report_done(APP_IDS[1])
+        assert dev_b.next_app() == APP_IDS[2]
+        dev_b.report_done(APP_IDS[2])
+        # incompatible on devA: devB, whose scan is past it, takes it over
+        dev_a.report_failed(
+            APP_IDS[0], FailureDecision(APP_INCOMPATIBLE, False, None, 0)
+        )
+        assert dev_b.next_app() == APP_IDS[0]
+    finally:
+        dispatcher.stop()
+
+
+def test_lost_lease_report_keeps_the_new_holder_in_flight(create_db):
+    db_path = create_db(APP_IDS[:1])
+    dispatcher = AppDispatcher(["devA", "devB"], 0.2, db_path=db_path)
+    dispatcher.start()
+    try:
+        dev_a, dev_b = dispatcher.client("devA"), dispatcher.client("devB")
+        assert dev_a.next_app() == APP_IDS[0]
+        time.sleep(0.3)
+        # devA's lease ran out, devB takes the app over
+        assert dev_b.next_app() == APP_IDS[0]
+        DBDriver(db_path).renew_lease(APP_IDS[0], "devB", 3600)
+        dev_a.report_failed(APP_IDS[0], FailureDecision(LEASE_LOST, False, None, 0))
+        # the app is still devB's, so losing devB frees it for the others
+        assert dispatcher.report_worker_lost("devB", timeout=5)
+        conn = sqlite3.connect(db_path)
+        lease_expires_at = conn.execute(
+            "SELECT lease_expires_at FROM input_apps WHERE app_id = ?", APP_IDS[:1]
+        ).fetchone()[0]
+        conn.close()
+        assert lease_expires_at is None
+    finally:
+        dispatcher.stop()
+
+
+def test_run_finishes_once_the_last_lease_of_its_own_is_released(create_db):
+    db_path = create_db(APP_IDS[:2])
+    dispatcher = AppDispatcher(["devA", "devB"], 3600, db_path=db_path)
+    dispatcher.start()
+    try:
+        clients = [dispatcher.client("devA"), dispatcher.client("devB")]
+        assert [client.next_app() for client in clients] == APP_IDS[:2]
+        # both devices ask for more while the host stages still hold the apps,
+        # the leases they see have an hour to run
+        waiting = [threading.Thread(target=client.next_app) for client in clients]
+        for thread in waiting:
+            thread.start()
+        time.sleep(0.2)
+        db_driver = DBDriver(db_path)
+        for client, app_id in zip(clients, APP_IDS):
+            db_driver.mark_app_downloaded(app_id)
+            client.report_done(app_id)
+        assert dispatcher.wait_finished(timeout=5)
+        for thread in waiting:
+            thread.join(timeout=5)
+    finally:
+        dispatcher.stop()
+
+
+def test_run_finishes_without_a_dead_worker(create_db):
+    db_path = create_db(APP_IDS[:1])
+    dispatcher = AppDispatcher(["devA", "devB"], 3600, db_path=db_path)
+    dispatcher.start()
+    try:
+        dev_a, dev_b = dispatcher.client("devA"), dispatcher.client("devB")
+        assert dev_a.next_app() == APP_IDS[0]
+        # devA's worker dies and never comes back
+        assert dispatcher.report_worker_lost("devA", timeout=5)
+        assert dev_b.next_app() == APP_IDS[0]
+        DBDriver(db_path).mark_app_downloaded(APP_IDS[0])
+        dev_b.report_done(APP_IDS[0])
+        waiting = threading.Thread(target=dev_b.next_app, daemon=True)
+        waiting.start()
+        assert dispatcher.wait_finished(timeout=5)
+        waiting.join(timeout=5)
+        assert not waiting.is_alive()
+    finally:
+        dispatcher.stop()
@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+from helpers.ErrorCatalog import DEVICE_UNREACHABLE, LEASE_LOST, classify_error
+from main.AppDispatcher import AppDispatcher
+from main.DBDriver import DBDriver
+from main.DeviceWorker import run_device_worker
+from main.ErrorPolicy import ErrorPolicy
+
+APP_ID = "com.example.app"
+
+
+def app_state(db_path):
+    conn = sqlite3.connect(db_path)
+    state = conn.execute(
+        "SELECT device, lease_expires_at, retries, retry_at, abandoned FROM input_apps"
+    ).fetchone()
+    errors = conn.execute("SELECT COUNT(*) FROM error_apps").fetchone()[0]
+    conn.close()
+    return state, errors
+
+
+def test_lost_lease_leaves_the_app_to_its_new_holder(create_db):
+    db_path = create_db([APP_ID])
+    db_driver = DBDriver(db_path)
+    db_driver.claim_next_app("devA", -1)
+    # devA's lease ran out and devB took the app over
+    assert db_driver.claim_next_app("devB", 3600)[0] == APP_ID
+    before = app_state(db_path)
+
+    decision = ErrorPolicy(retry_budget=0).record_failure(
+        db_driver, APP_ID, "devA", f"Lost the lease for app: [{APP_ID}]"
+    )
+    db_driver.release_app(APP_ID, "devA")
+
+    assert decision == (LEASE_LOST, False, None, 0)
+    assert app_state(db_path) == before
+    assert before[0][0] == "devB"
+    assert before[1] == 0
+
+
+def test_device_faults_are_told_apart_from_other_adb_failures():
+    for message in (
+        "device 'emulator-5554' not found",
+        "error: device offline",
+        "[Errno 104] Connection reset by peer",
+    ):
+        assert classify_error(message) == DEVICE_UNREACHABLE
+    assert classify_error("Timed out installing multiple APKs") != DEVICE_UNREACHABLE
+
+
+class OfflineSession:
+    def __init__(self, device_serial):
+        self.device_serial = device_serial
+
+    def main_entrypoint(self, app_id):
+        raise Exception(f"device '{self.device_serial}' not found")
+
+    def close(self):
+        pass
+
+
+class HealthySession(OfflineSession):
+    def main_entrypoint(self, app_id):
+        pass
+
+
+class InlineHostStages:
+    def __init__(self, db_driver, dispatch_client):
+        self.db_driver = db_driver
+        self.dispatch_client = dispatch_client
+
+    def submit(self, app_id):
+        self.db_driver.mark_app_downloaded(app_id)
+        self.dispatch_client.report_done(app_id)
+
+    def join(self):
+        pass
+
+
+def test_offline_device_leaves_the_backlog_to_a_healthy_one(create_db):
+    app_ids = [f"com.example.app{i}" for i in range(20)]
+    db_path = create_db(app_ids)
+    dispatcher = AppDispatcher(["offline", "healthy"], 3600, db_path=db_path)
+    error_policy = ErrorPolicy(retry_budget=1, backoff_secs=60, device_pause_secs=0.01)
+
+    def run(device_serial, session):
+        dispatch_client = dispatcher.client(device_serial)
+        db_driver = DBDriver(db_path)
+        run_device_worker(
+            device_serial,
+            dispatch_client,
+            db_driver,
+            session(device_serial),
+            InlineHostStages(db_driver, dispatch_client),
+            2,
+            error_policy,
+        )
+
+    dispatcher.start()
+    workers = [
+        threading.Thread(target=run, args=("offline", OfflineSession), daemon=True),
+        threading.Thread(target=run, args=("healthy", HealthySession), daemon=True),
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        assert dispatcher.wait_finished(timeout=10)
+        for worker in workers:
+            worker.join(timeout=5)
+    finally:
+        dispatcher.stop()
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute(
+        "SELECT SUM(downloaded), SUM(abandoned), SUM(retries), COUNT(retry_at) FROM input_apps"
+    ).fetchone() == (len(app_ids), 0, 0, 0)
+    assert conn.execute("SELECT COUNT(*) FROM error_apps").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,45 @@
+import sqlite3
+from concurrent.futures import Future
+import pytest
+from helpers.ErrorCatalog import LEASE_LOST, classify_error
+from main.DBDriver import DBDriver
+from main.HostStagePool import HostStagePool
+
+APP_ID = "com.example.app"
+
+
+class TakeOverUpload:
+    # devB takes the app over while devA's upload runs
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def submit(self, source, destination, expected=None):
+        db_driver = DBDriver(self.db_path)
+        db_driver.release_app(APP_ID, "devA")
+        assert db_driver.claim_next_app("devB", 3600)[0] == APP_ID
+        db_driver.close_connection()
+        future = Future()
+        future.set_result(source)
+        return future
+
+
+def test_upload_that_outlasts_the_lease_leaves_the_app_to_its_new_holder(
+    create_db,
+):
+    db_path = create_db([APP_ID])
+    db_driver = DBDriver(db_path)
+    assert db_driver.claim_next_app("devA", 3600)[0] == APP_ID
+    pool = HostStagePool(
+        "devA", None, 1, 1, upload_service=TakeOverUpload(db_path), db_path=db_path
+    )
+
+    with pytest.raises(Exception) as error:
+        pool.run_host_stages(APP_ID, db_driver)
+
+    assert classify_error(str(error.value)) == LEASE_LOST
+    conn = sqlite3.connect(db_path)
+    assert conn.execute(
+        "SELECT downloaded, device FROM input_apps WHERE app_id = ?", (APP_ID,)
+    ).fetchone() == (0, "devB")
+    conn.close()
+    db_driver.close_connection()
@@ -0,0 +1,102 @@
+import queue
+import time
+from helpers.GooglePlay import GooglePlay
+from helpers.InstallWatcher import InstallWatcher
+from helpers.UIBackend import FakeBackend
+
+APP_ID = "com.example.app"
+
+
+class ScriptedLogStream:
+    # logcat as InstallWatcher reads it: chunks are fed by the test, close() ends it
+    def __init__(self):
+        self.chunks = queue.Queue()
+
+    def feed(self, *lines):
+        self.chunks.put(b"".join(line + b"\n" for line in lines))
+
+    def fail(self):
+        self.chunks.put(Exception("device offline"))
+
+    def close(self):
+        self.chunks.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+class ScriptedADB:
+    # answers pm path with "installed" from the given probe on
+    def __init__(self, installed_on_probe):
+        self.device_serial = "fake-serial"
+        self.installed_on_probe = installed_on_probe
+        self.probes = 0
+
+    def is_package_installed(self, package_name):
+        self.probes += 1
+        return self.probes >= self.installed_on_probe
+
+
+def google_play(adb, screens=([],)):
+    play = GooglePlay(
+        {"pipeline": {"device_serial": adb.device_serial}},
+        adb=adb,
+        ui_backend=FakeBackend(screens),
+    )
+    play.install_timeout = 5
+    play.install_poll_min_secs = 0.05
+    play.install_poll_max_secs = 0.1
+    return play
+
+
+def test_silent_log_still_probes_the_package_manager():
+    # the logcat stream stays up but never shows the install line
+    stream = ScriptedLogStream()
+    stream.feed(b"I/ActivityManager( 123): Start proc com.android.vending")
+    watcher = InstallWatcher(stream, APP_ID).start()
+    adb = ScriptedADB(installed_on_probe=3)
+    try:
+        started_at = time.monotonic()
+        google_play(adb).check_for_install_complete(APP_ID, watcher)
+        assert time.monotonic() - started_at < 2
+        assert watcher.alive
+        assert adb.probes == 3
+    finally:
+        watcher.stop()
+
+
+def test_install_line_wakes_the_waiter():
+    stream = ScriptedLogStream()
+    watcher = InstallWatcher(stream, APP_ID).start()
+    adb = ScriptedADB(installed_on_probe=1)
+    play = google_play(adb)
+    # a long poll interval: only the log line can end the wait early
+    play.install_poll_min_secs = play.install_poll_max_secs = 3
+    try:
+        stream.feed(
+            b"I/PackageManager( 456): installPackageLI: com.example.other",
+            f"D/PackageManager( 456): PACKAGE_ADDED {APP_ID}".encode(),
+        )
+        started_at = time.monotonic()
+        play.check_for_install_complete(APP_ID, watcher)
+        assert time.monotonic() - started_at < 1
+        assert adb.probes == 1
+    finally:
+        watcher.stop()
+
+
+def test_dead_log_stream_falls_back_to_polling():
+    stream = ScriptedLogStream()
+    stream.fail()
+    watcher = InstallWatcher(stream, APP_ID).start()
+    watcher.thread.join(timeout=5)
+    assert not watcher.alive
+    adb = ScriptedADB(installed_on_probe=2)
+    google_play(adb).check_for_install_complete(APP_ID, watcher)
+    assert adb.probes == 2
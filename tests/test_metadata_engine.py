@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import time
+from benchmarks.fake_play_web import FakePlayWeb
+from main.DBDriver import DBDriver
+from main.MetadataEngine import MetadataEngine
+from main.MetadataShardWriter import MetadataShardWriter
+
+
+def metadata_engine(web, db_path, shard_dir, **kwargs):
+    return MetadataEngine(
+        base_url=web.url,
+        db_path=db_path,
+        shard_writer=MetadataShardWriter(directory=str(shard_dir)),
+        **kwargs,
+    )
+
+
+def test_backfill_stores_canned_pages_and_flags_apps(create_db, tmp_path):
+    app_ids = [f"com.example.app{i}" for i in range(5)]
+    db_path = create_db(app_ids + ["com.example.gone"], downloaded=True)
+    with FakePlayWeb(app_ids) as web:
+        engine = metadata_engine(web, db_path, tmp_path, requests_per_second=100)
+        db_driver = DBDriver(db_path)
+        assert engine.backfill(db_driver) == 6
+        engine.finish(db_driver)
+        db_driver.close_connection()
+
+    conn = sqlite3.connect(db_path)
+    flags = dict(conn.execute("SELECT app_id, metadata FROM input_apps"))
+    assert all(flags[app_id] == 1 for app_id in app_ids)
+    # the unknown app was tried once and waits for its retry window
+    assert flags["com.example.gone"] == 0
+    shards = [path for path in tmp_path.iterdir() if path.suffix == ".jsonl"]
+    assert len(shards) == 1
+    titles = {}
+    with open(shards[0]) as f:
+        for line in f:
+            data = json.loads(line)
+            titles[data["appId"]] = data["title"]
+    assert titles == {app_id: f"Example app {app_id}" for app_id in app_ids}
+
+
+def test_stop_does_not_sweep_the_backlog(create_db, tmp_path):
+    app_ids = [f"com.example.app{i}" for i in range(200)]
+    db_path = create_db(app_ids, downloaded=True)
+    with FakePlayWeb(app_ids) as web:
+        # at 5 requests per second the backlog alone is 40 seconds of fetching
+        engine = metadata_engine(
+            web, db_path, tmp_path, requests_per_second=5, batch_size=50
+        )
+        engine.start()
+        while not web.requests:
+            time.sleep(0.05)
+        started_at = time.monotonic()
+        engine.stop()
+        stop_secs = time.monotonic() - started_at
+        requested = {app_id for app_id, _ in web.requests}
+
+    assert stop_secs < 5
+    assert len(requested) < len(app_ids)
+    conn = sqlite3.connect(db_path)
+    # apps the stop skipped were not charged a failed attempt
+    attempted = {
+        app_id
+        for (app_id,) in conn.execute(
+            "SELECT app_id FROM input_apps WHERE metadata_attempted_at IS NOT NULL"
+        )
+    }
+    assert not attempted
+    assert conn.execute("SELECT SUM(metadata) FROM input_apps").fetchone()[0] == len(
+        requested
+    )
@@ -0,0 +1,29 @@
+import pytest
+from helpers.ErrorCatalog import STAGING_FULL, TRANSIENT, classify_error, error_policy
+from main.DBDriver import DBDriver
+from main.StagingManager import StagingManager
+
+APP_IDS = ["com.example.staged", "com.example.next"]
+
+
+def test_full_staging_area_gives_the_device_back(create_db):
+    db_driver = DBDriver(create_db(APP_IDS))
+    # an app whose upload failed still holds the space until it is claimed again
+    assert db_driver.reserve_staging(APP_IDS[0], "devA", 100, 100, 0)
+    staging_manager = StagingManager(
+        db_driver, "devB", quota_bytes=100, poll_secs=0.01, timeout_secs=0.05
+    )
+    renewals = []
+
+    with pytest.raises(Exception) as error:
+        staging_manager.acquire(
+            APP_IDS[1], 10, keep_alive=lambda: renewals.append(None)
+        )
+
+    assert classify_error(str(error.value)) == STAGING_FULL
+    assert error_policy(STAGING_FULL) == TRANSIENT
+    assert renewals
+    assert db_driver.get_staging_usage() == (1, 100)
+    db_driver.release_staging(APP_IDS[0])
+    assert staging_manager.acquire(APP_IDS[1], 10) >= 0
+    db_driver.close_connection()
@@ -0,0 +1,114 @@
+import pytest
+from helpers.GooglePlay import GooglePlay
+from helpers.UIBackend import FakeBackend
+
+APP_ID = "com.example.app"
+BOUNDS = "[0,0][1080,200]"
+LOADING = []
+DETAILS = [
+    {"text": "Example app"},
+    {"content-desc": "Install", "bounds": "[100,200][300,400]"},
+]
+INSTALLING = [{"text": "Pending..."}]
+INSTALLED = [
+    {"text": "Example app"},
+    {"content-desc": "Uninstall", "bounds": "[100,200][300,400]"},
+]
+
+
+class StoreADB:
+    # records the shell commands; logcat cannot be followed, so the install
+    # wait runs on the UI poll alone
+    def __init__(self):
+        self.device_serial = "fake-serial"
+        self.commands = []
+
+    def adb_simple_shell(self, *args):
+        self.commands.append(args)
+        return 0, ""
+
+    def adb_shell_stream(self, *args, timeout_secs=30):
+        raise Exception("no logcat on this device")
+
+    def forget_package(self, package_name=None):
+        pass
+
+    def is_package_installed(self, package_name):
+        return False
+
+
+def google_play(screens):
+    backend = FakeBackend(screens)
+    play = GooglePlay(
+        {"pipeline": {"device_serial": "fake-serial"}},
+        adb=StoreADB(),
+        ui_backend=backend,
+    )
+    play.store_load_secs = 0
+    play.install_button_poll_secs = 0.01
+    play.install_button_timeout = 0.1
+    play.install_poll_min_secs = 0.01
+    play.install_poll_max_secs = 0.01
+    play.install_timeout = 2
+    return play, backend
+
+
+def test_download_taps_install_and_waits_for_uninstall():
+    play, backend = google_play([LOADING, DETAILS, INSTALLING, INSTALLING, INSTALLED])
+    play.download_from_store(APP_ID)
+    assert play.adb.commands[0] == (
+        "am",
+        "start",
+        "-a",
+        "android.intent.action.VIEW",
+        "-d",
+        f"market://details?id={APP_ID}",
+    )
+    # the middle of the install button's bounds
+    assert backend.taps == [(200, 300)]
+    assert backend.position == 5
+
+
+@pytest.mark.parametrize(
+    "screen, error",
+    [
+        (
+            [{"text": "This phone isn't compatible with this app."}],
+            "App is incompatible",
+        ),
+        (
+            [
+                {
+                    "resource-id": "com.android.vending:id/0_resource_name_obfuscated",
+                    "bounds": BOUNDS,
+                }
+            ],
+            "App is incompatible",
+        ),
+        (
+            [{"text": "This item isn't available in your country."}],
+            "This item isn't available in your country.",
+        ),
+        ([{"text": "Too many attempts. Try again later."}], "Rate limited"),
+    ],
+)
+def test_store_errors_stop_before_the_install(screen, error):
+    play, backend = google_play([LOADING, screen])
+    with pytest.raises(Exception, match=error):
+        play.download_from_store(APP_ID)
+    assert backend.taps == []
+
+
+@pytest.mark.parametrize(
+    "screen, error",
+    [
+        ([{"content-desc": "Update", "bounds": BOUNDS}], "Update available"),
+        ([{"text": "Got it", "bounds": BOUNDS}], "Age verification required"),
+        (INSTALLING, "Installation timeout"),
+    ],
+)
+def test_install_wait_errors(screen, error):
+    play, _ = google_play([INSTALLING, screen])
+    play.install_timeout = 0.2
+    with pytest.raises(Exception, match=error):
+        play.check_for_install_complete(APP_ID)
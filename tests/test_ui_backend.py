@@ -0,0 +1,43 @@
+from helpers.UIBackend import UIAutomatorBackend
+
+DUMP = (
+    '<?xml version="1.0" encoding="UTF-8"?><hierarchy rotation="0">'
+    '<node text="" content-desc="Install" bounds="[100,200][300,400]" />'
+    "</hierarchy>"
+)
+
+
+class NoStreamADB:
+    # the stream cannot even be opened, the file dump still works
+    def __init__(self):
+        self.device_serial = "fake-serial"
+        self.stream_attempts = 0
+
+    def adb_shell_stream(self, *args, timeout_secs=30):
+        self.stream_attempts += 1
+        raise ConnectionResetError("[Errno 104] Connection reset by peer")
+
+    def adb_simple_shell(self, *args):
+        return 0, ""
+
+    def adb_simple(self, command, source, destination):
+        with open(destination, "w") as f:
+            f.write(DUMP)
+        return 0, ""
+
+
+def test_stream_that_fails_to_open_falls_back_to_the_file_dump():
+    adb = NoStreamADB()
+    backend = UIAutomatorBackend(adb, max_stream_failures=2)
+
+    for _ in range(3):
+        hierarchy = backend.snapshot()
+        assert hierarchy.get_coordinates("content-desc", "Install") == [
+            "100",
+            "200",
+            "300",
+            "400",
+        ]
+
+    # after max_stream_failures the stream is not tried anymore
+    assert adb.stream_attempts == 2
@@ -4,7 +4,8 @@ import sqlite3
 import pandas as pd
 from streamlit_autorefresh import st_autorefresh
 from datetime import datetime, timedelta
-from config.Config import SQLITE_DB_NAME
+from config.Config import SQLITE_BUSY_TIMEOUT_SECS, SQLITE_DB_NAME
+from main.DBDriver import DBDriver
 
 st.set_page_config(page_title="GPSD Dashboard")
 st.title("Google Play Store Downloader Dashboard")
@@ -13,7 +14,8 @@ main_db_path = abspath(
     join(dirname(dirname(realpath(__file__))), "databases", SQLITE_DB_NAME)
 )
 
-conn = sqlite3.connect(main_db_path)
+# the pipeline keeps the database in WAL mode, so reads here never block it
+conn = sqlite3.connect(main_db_path, timeout=SQLITE_BUSY_TIMEOUT_SECS)
 cursor = conn.cursor()
 
 # Auto-refresh every 60 seconds
@@ -31,47 +33,50 @@ with col2:
     downloaded_apps = cursor.fetchone()[0]
     st.metric("Downloaded apps", downloaded_apps)
 
+cursor.execute(
+    "SELECT COUNT(*), COALESCE(SUM(bytes), 0), MAX(waited_secs) FROM staging"
+)
+staged_apps, staged_bytes, max_staging_wait = cursor.fetchone()
+col1, col2 = st.columns(2)
+
+with col1:
+    st.metric(
+        "Staged on local disk",
+        f"{staged_bytes / 1024**3:.1f} GB",
+        help=f"{staged_apps} apps waiting for upload",
+    )
+
+with col2:
+    st.metric("Longest staging wait", f"{max_staging_wait or 0:.0f}s")
+
 n = st.number_input("Number of devices used", min_value=1, value=6)
 
 query_download_queue = f"""
 SELECT COUNT(*) AS download_queue_count
-FROM (
-    SELECT DISTINCT i.app_id
-    FROM input_apps i
-    LEFT JOIN error_apps e ON i.app_id = e.app_id
-    WHERE i.downloaded = 0
-    GROUP BY e.error, i.app_id
-    HAVING COUNT(DISTINCT e.device) < {n} OR COUNT(e.device) = 0
-    EXCEPT
-    SELECT DISTINCT ea.app_id
-    FROM error_apps ea
-    WHERE ea.app_id IN (
-        SELECT app_id FROM input_apps WHERE downloaded = 0
-    )
-    AND ea.error = 'App is incompatible'
-    GROUP BY ea.error, ea.app_id
-    HAVING COUNT(DISTINCT ea.device) = {n}
-);
+FROM input_apps
+WHERE downloaded = 0 AND abandoned = 0 AND incompatible_devices < {n};
 """
 
 df_queue = pd.read_sql_query(query_download_queue, conn)
 
 query_incompatible_apps = f"""
 SELECT COUNT(*) AS incompatible_app_count
-FROM (
-    SELECT DISTINCT ea.app_id
-    FROM error_apps ea
-    WHERE ea.app_id IN (
-        SELECT app_id FROM input_apps WHERE downloaded = 0
-    )
-    AND ea.error = 'App is incompatible'
-    GROUP BY ea.error, ea.app_id
-    HAVING COUNT(DISTINCT ea.device) = {n}
-)
+FROM input_apps
+WHERE downloaded = 0 AND abandoned = 0 AND incompatible_devices >= {n};
 """
 
 df_incompatible = pd.read_sql_query(query_incompatible_apps, conn)
 
+query_retry_state = f"""
+SELECT
+    COUNT(*) FILTER (WHERE abandoned = 1) AS abandoned_app_count,
+    COUNT(*) FILTER (WHERE retry_at > {datetime.now().timestamp()}) AS backoff_app_count
+FROM input_apps
+WHERE downloaded = 0;
+"""
+
+df_retry_state = pd.read_sql_query(query_retry_state, conn)
+
 col1, col2 = st.columns(2)
 
 with col1:
@@ -83,29 +88,22 @@ with col2:
         df_incompatible.iloc[0]["incompatible_app_count"],
     )
 
-query_subset = f"""
-SELECT 
-    NOT EXISTS (
-        SELECT DISTINCT i.app_id
-        FROM input_apps i
-        LEFT JOIN error_apps e ON i.app_id = e.app_id
-        WHERE i.downloaded = 0
-        GROUP BY e.error, i.app_id
-        HAVING COUNT(DISTINCT e.device) < {n} OR COUNT(e.device) = 0
-        EXCEPT
-        SELECT DISTINCT ea.app_id
-        FROM error_apps ea
-        WHERE ea.app_id IN (
-            SELECT app_id FROM input_apps WHERE downloaded = 0
-        )
-        AND ea.error = 'App is incompatible'
-        GROUP BY ea.error, ea.app_id
-        HAVING COUNT(DISTINCT ea.device) = {n}
-    ) AS is_subset
-"""
+col1, col2 = st.columns(2)
+
+with col1:
+    st.metric(
+        "Apps given up",
+        df_retry_state.iloc[0]["abandoned_app_count"],
+        help="permanent error, or no retries left",
+    )
+
+with col2:
+    st.metric("Apps waiting for a retry", df_retry_state.iloc[0]["backoff_app_count"])
 
-df_subset = pd.read_sql_query(query_subset, conn)
-is_all_downloaded = bool(df_subset.iloc[0]["is_subset"])
+# the same check the pipeline exits on, so both agree on when the work is done
+db_driver = DBDriver(main_db_path)
+is_all_downloaded = db_driver.check_for_incompatible_apps(n)
+db_driver.close_connection()
 if is_all_downloaded:
     st.subheader("All apps are downloaded.")
 else:
@@ -113,7 +111,9 @@ else:
 
     # ETA Calculation
     T_remaining = total_apps - (
-        downloaded_apps + df_incompatible.iloc[0]["incompatible_app_count"]
+        downloaded_apps
+        + df_incompatible.iloc[0]["incompatible_app_count"]
+        + df_retry_state.iloc[0]["abandoned_app_count"]
     )
     current_time = datetime.now()
 